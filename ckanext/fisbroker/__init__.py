@@ -5,3 +5,18 @@ with open(path.join(here, 'VERSION')) as version_file:
     __version__ = version_file.read().strip()
 
 HARVESTER_ID = 'fisbroker_harvester'
+# MAPPING_REVISION must be increased with every change of
+# FisbrokerHarvester.get_package_dict() (or of anything it calls) that changes the
+# resulting package dicts: `ckan fisbroker reprocess-outdated` compares the
+# MAPPING_VERSION stamped on a package with the current one, so a change without
+# a new revision is never applied to datasets that were already harvested.
+# Revisions:
+#   1: first mapping stamped with a mapping version
+#   2: the extras `fisbroker_guid` and `harvester_type` are written by the mapping
+MAPPING_REVISION = 2
+MAPPING_VERSION = f"{__version__}+{MAPPING_REVISION}"
+MAPPING_VERSION_EXTRA = 'fisbroker_mapping_version'
+# extras with the FIS-Broker guid and the harvester type of a package, so that
+# they can be looked up (and searched for) without the harvest tables
+GUID_EXTRA = 'fisbroker_guid'
+HARVESTER_TYPE_EXTRA = 'harvester_type'
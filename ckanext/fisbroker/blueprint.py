@@ -3,17 +3,26 @@
 This module implements the main controller for ckanext-fisbroker.
 """
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import hashlib
+import json
 import logging
+import threading
+import time
+import uuid
 from urllib3.exceptions import ProtocolError
 
-from flask import Blueprint, make_response, redirect
+from flask import Blueprint, Response, make_response, redirect, stream_with_context
+from rq import get_current_job
 
 # from ckan.common import OrderedDict, _, c, request, response, config
 from ckan import model
 from ckan.common import c, request
 import ckan.lib.base as base
 import ckan.lib.helpers as h
+import ckan.lib.jobs as jobs
 from ckan.model import Package, Session
 from ckan.plugins import toolkit
 
@@ -23,15 +32,19 @@ from ckanext.harvest.model import (
     HarvestJob,
     HarvestObject,
     HarvestObjectExtra,
-    HarvestGatherError
+    HarvestGatherError,
+    HarvestSource,
 )
 from ckanext.spatial.lib.csw_client import CswError
 
 from ckanext.fisbroker import HARVESTER_ID
+import ckanext.fisbroker.model as fbmodel
+import ckanext.fisbroker.reimport_lock as reimport_lock
 from ckanext.fisbroker.csw_client import CswService
 from ckanext.fisbroker.exceptions import (
     ERROR_MESSAGES,
     ERROR_DURING_IMPORT,
+    ERROR_JOB_NOT_FOUND,
     ERROR_MISSING_ID,
     ERROR_NO_CONNECTION,
     ERROR_NO_GUID,
@@ -39,6 +52,8 @@ from ckanext.fisbroker.exceptions import (
     ERROR_NOT_FOUND_IN_FISBROKER,
     ERROR_NOT_HARVESTED,
     ERROR_NOT_HARVESTED_BY_FISBROKER,
+    ERROR_NOT_A_FISBROKER_SOURCE,
+    ERROR_REIMPORT_BUSY,
     ERROR_UNEXPECTED,
     ERROR_WRONG_CONTENT_TYPE,
     ERROR_WRONG_HTTP,
@@ -50,16 +65,30 @@ from ckanext.fisbroker.exceptions import (
     NoConnectionError,
     NotFoundInFisbrokerError,
     FBImportError,
+    InvalidPackageIdsError,
+    ReimportBusyError,
+    ReimportError,
 )
 from ckanext.fisbroker.helper import (
     dataset_was_harvested,
     harvester_for_package,
     fisbroker_guid,
+    fisbroker_sources,
     get_fisbroker_source,
+    harvest_info_for_packages,
     is_reimport_job,
 )
+from ckanext.fisbroker.import_index import ImportIndex
 
 LOG = logging.getLogger(__name__)
+# number of records fetched from FIS-Broker with one GetRecordById request during reimports
+REIMPORT_BATCH_SIZE_DEFAULT = 20
+# number of concurrent GetRecordById requests during reimports
+REIMPORT_FETCH_WORKERS_DEFAULT = 4
+# number of fetched or requested batches per fetching thread that wait to be imported
+REIMPORT_BATCHES_IN_FLIGHT = 2
+# number of packages that are reprocessed at once
+REPROCESS_CHUNK_SIZE = 200
 
 def get_error_dict(error_code):
     '''Return a dict for an error_code, raise ValueError if code doesn't exist.'''
@@ -101,10 +130,52 @@ def open_csw_record(package_id):
 
     return redirect(url, code=307)
 
+def stored_csw_record(package_id):
+    '''Serve the CSW record for `package_id` that is stored with its current
+        harvest object (signified by the use of a /dataset/{name}/csw_record.xml
+        pattern URL), with an ETag and a Last-Modified header, and answer
+        conditional requests with HTTP 304. If no record is stored, redirect to
+        the record on FIS-Broker like open_csw_record().'''
+
+    package = Package.get(package_id)
+    stored = None
+    if package:
+        stored = Session.query(
+            HarvestObject.content,
+            HarvestObject.metadata_modified_date,
+            HarvestObject.import_finished) \
+            .join(HarvestSource, HarvestSource.id == HarvestObject.harvest_source_id) \
+            .filter(HarvestObject.package_id == package.id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestSource.type == HARVESTER_ID) \
+            .first()
+    if not stored or not stored.content:
+        return open_csw_record(package_id)
+
+    response = make_response(stored.content)
+    response.mimetype = 'application/xml'
+    response.set_etag(hashlib.sha1(stored.content.encode('utf-8')).hexdigest())
+    last_modified = stored.metadata_modified_date or stored.import_finished
+    if last_modified:
+        response.last_modified = last_modified
+    # revalidate with the ETag instead of serving an outdated record after a reimport
+    response.cache_control.no_cache = True
+
+    return response.make_conditional(request.environ)
+
 def reimport_through_browser(package_id):
     '''Initiate the reimport action through the browser (signified by
         the use of a /dataset/{name}/reimport pattern URL).'''
 
+    if background_reimport_enabled():
+        if not Package.get(package_id):
+            h.flash_error(_error_response(PackageIdDoesNotExistError(package_id))[1]['message'])
+            return h.redirect_to(controller='dataset', action='read', id=package_id)
+        _check_reimport_access(_user_context(), package_id)
+        enqueue_reimport(package_id, c.user)
+        h.flash_success("Package reimport was started, reload the page in a moment to see the result.")
+        return h.redirect_to(controller='dataset', action='read', id=package_id)
+
     # try to reimport through API
     response_data = reimport(package_id, direct_call=True)
     if response_data['success']:
@@ -133,102 +204,524 @@ def reimport_through_api():
         response_data['error'] = get_error_dict(ERROR_MISSING_ID)
         return _finish(response_code, response_data)
 
+    if background_reimport_enabled():
+        if not Package.get(package_id):
+            response_code, error_dict = _error_response(PackageIdDoesNotExistError(package_id))
+            return _finish(response_code, {
+                'success': False,
+                'error': error_dict,
+                'package_id': package_id
+            })
+        _check_reimport_access(_user_context(), package_id)
+        job_id = enqueue_reimport(package_id, c.user)
+        return _finish(*_enqueued_response(job_id, package_id))
+
     return reimport(package_id)
 
-def reimport_batch(package_ids, context):
-    '''Batch-reimport all packages in `package_ids` from their original
-        harvest source.'''
+def _user_context():
+    '''Return a context for running actions as the user of the current request.'''
+    return {
+        'model': model,
+        'session': model.Session,
+        'user': c.user
+    }
 
-    ckan_fb_mapping = {}
+def _check_reimport_access(context, package_id):
+    '''Raise NotAuthorized if the user of `context` is not allowed to reimport
+        the existing package with `package_id`, i.e. to update the package and to
+        create a harvest job for its FIS-Broker source. Background reimports are
+        checked before they are enqueued, because the job runs them later.'''
+    toolkit.check_access('package_update', context.copy(), {'id': package_id})
+    source = get_fisbroker_source(package_id)
+    if source:
+        toolkit.check_access('harvest_job_create', context.copy(), {'source_id': source['id']})
 
-    # first, do checks that can be done without connection to FIS-Broker
+def daily_reimport_job_enabled():
+    '''Return True if reimports are attached to a rolling reimport job per
+        harvest source and day (`ckanext.fisbroker.reimport.daily_job`).'''
+    return toolkit.asbool(toolkit.config.get('ckanext.fisbroker.reimport.daily_job', False))
+
+def start_reimport_job(context, source_id):
+    '''Return a started harvest job for reimporting records of harvest source
+        `source_id`, recorded as a reimport job. This is either a new job, or,
+        if daily reimport jobs are enabled, the rolling reimport job of today.'''
+
+    if daily_reimport_job_enabled():
+        toolkit.check_access('harvest_job_create', context, {'source_id': source_id})
+        today = datetime.date.today()
+        # concurrent reimports must neither create a second job for the day nor
+        # finish the job while it is being attached to
+        with reimport_lock.source_lock(source_id):
+            harvest_job = fbmodel.daily_reimport_job(source_id, today)
+            if not harvest_job:
+                harvest_job = HarvestJob()
+                harvest_job.source_id = source_id
+                harvest_job.gather_started = datetime.datetime.utcnow()
+                harvest_job.save()
+                fbmodel.record_reimport_job(harvest_job, day=today)
+            harvest_job.status = u'Running'
+            harvest_job.save()
+            reimport_lock.attach_to_job(harvest_job.id)
+    else:
+        job_dict = toolkit.get_action('harvest_job_create')(context, {'source_id': source_id})
+        harvest_job = HarvestJob.get(job_dict['id'])
+        fbmodel.record_reimport_job(harvest_job)
+        harvest_job.gather_started = datetime.datetime.utcnow()
+        harvest_job.save()
+
+    return harvest_job
+
+def _validate_package_ids(package_ids, invalid=None):
+    '''Check that all packages in `package_ids` can be reimported, with a single
+        query. Return a dict mapping the ids of the packages that can be reimported
+        to their PackageHarvestInfo. If one package cannot be reimported,
+        raise the corresponding ReimportError, if several cannot be reimported,
+        raise an InvalidPackageIdsError listing all of them. If `invalid` is a
+        dict, store the errors in it (by package id or name) instead.'''
+
+    infos = harvest_info_for_packages(package_ids)
+    valid = {}
+    errors = []
     for package_id in package_ids:
-        package = Package.get(package_id)
+        info = infos.get(package_id)
+        if not info:
+            errors.append(PackageIdDoesNotExistError(package_id))
+        elif not info.source_id:
+            errors.append(PackageNotHarvestedError(package_id))
+        elif not info.source_type == HARVESTER_ID:
+            errors.append(PackageNotHarvestedInFisbrokerError(package_id))
+        elif not info.guid:
+            errors.append(NoFisbrokerIdError(package_id))
+        else:
+            valid[info.package_id] = info
+
+    if invalid is not None:
+        invalid.update((error.package_id, error) for error in errors)
+    elif len(errors) == 1:
+        raise errors[0]
+    if errors:
+        raise InvalidPackageIdsError(errors)
+
+    return valid
+
+def reimport_bulk():
+    '''Reimport several packages in one batch (signified by a POST request to
+        /api/harvest/reimport/bulk). The packages are specified either by
+        a list of package ids or names (JSON member or form parameter `ids`),
+        or by the id of a FIS-Broker harvest source (`source_id`), in which
+        case all its current datasets are reimported. The result for each
+        package is streamed as a line of JSON (NDJSON): packages that cannot
+        be reimported get their error right away, the others a line as soon as
+        they have been reimported.'''
+
+    params = request.get_json(silent=True) or {}
+    package_ids = params.get('ids') or request.form.getlist('ids')
+    source_id = params.get('source_id') or request.form.get('source_id')
+    if source_id:
+        source = HarvestSource.get(source_id)
+        if not source or source.type != HARVESTER_ID:
+            error_dict = get_error_dict(ERROR_NOT_A_FISBROKER_SOURCE)
+            error_dict['message'] = error_dict['message'].format(source_id)
+            return _finish(404 if not source else 422, {
+                'success': False,
+                'error': error_dict,
+                'source_id': source_id
+            })
+        package_ids = [package_id for (package_id,) in Session.query(HarvestObject.package_id)
+                       .join(Package, Package.id == HarvestObject.package_id)
+                       .filter(HarvestObject.harvest_source_id == source.id)
+                       .filter(HarvestObject.current == True)
+                       .filter(Package.state == model.State.ACTIVE)
+                       .order_by(Package.name)]
+    if not package_ids:
+        return _finish(400, {
+            'success': False,
+            'error': get_error_dict(ERROR_MISSING_ID)
+        })
+
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': c.user
+    }
+    # packages that cannot be reimported get an error line each
+    invalid = {}
+    valid = _validate_package_ids(package_ids, invalid)
+    # check the permissions before taking a slot, so that unauthorized
+    # requests cannot block other reimports
+    fb_sources, mappings = _group_by_source(valid) if valid else ({}, {})
+    for fb_source_id in mappings:
+        toolkit.check_access('harvest_job_create', context.copy(), {'source_id': fb_source_id})
+
+    # the whole bulk reimport takes one of the slots for concurrent reimports
+    token = str(uuid.uuid4())
+    if not reimport_lock.acquire_slot(token):
+        return _finish(429, {
+            'success': False,
+            'error': get_error_dict(ERROR_REIMPORT_BUSY)
+        })
+    streaming = False
+    claimed = []
+    try:
+        # packages that are already being reimported are not reimported again,
+        # their lines point to the reimport in flight
+        in_flight = reimport_lock.claim_packages(list(valid), token)
+        claimed = [package_id for package_id in valid if package_id not in in_flight]
+        status = {'source_ids': list(mappings), 'processed': 0, 'total': len(claimed)}
+        reimport_lock.record_status(token, 'started', **status)
+
+        # datasets that fail are stored in `errors`, they don't abort the batch;
+        # the harvest jobs are only started once the response is streamed
+        errors = {}
+        reimported = iter_reimport_batch(claimed, context, errors) if claimed else iter(())
+
+        def failures(reported):
+            for package_id, error in list(errors.items()):
+                if package_id in reported:
+                    continue
+                reported.add(package_id)
+                if isinstance(error, FBImportError):
+                    from ckan.logic.action.delete import package_delete
+                    package_delete(context.copy(), { "id": package_id })
+                yield json.dumps(_package_error(error)) + "\n"
+
+        def generate():
+            reported = set()
+            last_refresh = time.time()
+            try:
+                for error in invalid.values():
+                    yield json.dumps(_package_error(error)) + "\n"
+                for package_id, other in in_flight.items():
+                    yield json.dumps(_in_flight_response(other, package_id)[1]) + "\n"
+                for package_id, record in reimported:
+                    status['processed'] += 1
+                    # keep the slot and the claims while the bulk reimport is making progress
+                    if time.time() - last_refresh > reimport_lock.lock_timeout() / 4:
+                        reimport_lock.refresh(token, claimed)
+                        reimport_lock.record_status(token, 'started', **status)
+                        last_refresh = time.time()
+                    yield from failures(reported)
+                    yield json.dumps({
+                        'success': True,
+                        'package_id': package_id,
+                        'fisbroker_guid': record.identifier
+                    }) + "\n"
+                yield from failures(reported)
+            except ReimportError as error:
+                # errors that abort the whole batch, like a lost connection to FIS-Broker
+                yield from failures(reported)
+                yield json.dumps(_package_error(error)) + "\n"
+            except GeneratorExit:
+                LOG.info(f"The client of bulk reimport {token} disconnected, aborting the reimport")
+                raise
+            finally:
+                status['processed'] = len(claimed)
+                reimport_lock.record_status(token, 'finished', **status)
+                release()
+
+        def release():
+            # finishes the harvest jobs of the reimport, if they were started
+            close = getattr(reimported, 'close', None)
+            if close:
+                close()
+            reimport_lock.release_packages(claimed, token)
+            reimport_lock.release_slot(token)
+
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        # if the response is never streamed (e.g. the client disconnected before),
+        # the slot and claims are released when it is closed
+        response.call_on_close(release)
+        streaming = True
+        return response
+    finally:
+        if not streaming:
+            reimport_lock.release_packages(claimed, token)
+            reimport_lock.release_slot(token)
+
+def _package_error(error):
+    '''Return the result of the failed reimport of a package, caused by the
+        ReimportError `error`.'''
+    response_code, error_dict = _error_response(error)
+    return {
+        'success': False,
+        'package_id': error.package_id,
+        'error': error_dict
+    }
+
+def reimport_batch(package_ids, context, errors=None):
+    '''Batch-reimport all packages in `package_ids` from their original
+        harvest source. Return a dict mapping the package ids to the
+        reimported records. See iter_reimport_batch() for `errors`.'''
 
-        if not package:
-            raise PackageIdDoesNotExistError(package_id)
+    return dict(iter_reimport_batch(package_ids, context, errors))
 
-        if not dataset_was_harvested(package):
-            raise PackageNotHarvestedError(package_id)
+def iter_reimport_batch(package_ids, context, errors=None):
+    '''Batch-reimport all packages in `package_ids` from their original
+        harvest source. The packages are validated right away, a harvest job
+        is started for each harvest source and the reimport itself happens
+        while iterating over the returned generator, which yields a
+        (package_id, record) tuple for every reimported package. Once the
+        iteration has started, the generator must be consumed or closed, so
+        that the harvest jobs are finished.
+        Packages whose harvest source is no longer an active FIS-Broker source
+        are reimported with the first active one.
+        The records are requested from FIS-Broker in batches of several ids
+        (`ckanext.fisbroker.reimport.batch_size`) by several concurrent threads
+        (`ckanext.fisbroker.reimport.fetch_workers`), while the records that
+        have already arrived are imported.
+        By default, the first package that cannot be reimported aborts the
+        batch with a ReimportError. If `errors` is a dict, the ReimportErrors
+        of such packages are stored in it (by package id or name) and the
+        other packages are reimported nevertheless. Only errors that affect
+        the whole batch (like a lost connection to FIS-Broker) are raised.'''
 
-        harvester = harvester_for_package(package)
-        harvester_url = harvester.url
-        harvester_type = harvester.type
-        if not harvester_type == HARVESTER_ID:
-            raise PackageNotHarvestedInFisbrokerError(package_id)
+    # first, do checks that can be done without connection to FIS-Broker
+    valid = _validate_package_ids(package_ids, errors)
+    fb_sources, mappings = _group_by_source(valid)
 
-        fb_guid = fisbroker_guid(package)
-        if not fb_guid:
-            raise NoFisbrokerIdError(package_id)
+    return _reimport_sources(context, fb_sources, mappings, errors)
 
-        ckan_fb_mapping[package.id] = fb_guid
+def _group_by_source(valid):
+    '''Group the packages in `valid` (a dict mapping package ids to their
+        PackageHarvestInfo) by the FIS-Broker source they are reimported with:
+        their own source if it is still an active FIS-Broker source, else the
+        first active one. Return a dict mapping the ids of the active FIS-Broker
+        sources to the sources, and a dict mapping the source ids to dicts of
+        package ids and FIS-Broker guids. Raise NoFBHarvesterDefined if there
+        is no active FIS-Broker source.'''
 
-    # get the harvest source for FIS-Broker datasets
-    fb_source = get_fisbroker_source()
-    if not fb_source:
+    fb_sources = {source['id']: source for source in fisbroker_sources()}
+    if not fb_sources:
         raise NoFBHarvesterDefined()
-    source_id = fb_source.get('id', None)
+    default_source = next(iter(fb_sources.values()))
+
+    mappings = {}
+    for package_id, info in valid.items():
+        source = fb_sources.get(info.source_id, default_source)
+        mappings.setdefault(source['id'], {})[package_id] = info.guid
+
+    return fb_sources, mappings
+
+def _reimport_sources(context, fb_sources, mappings, errors=None):
+    '''Generator starting a harvest job for each source in `mappings` (see
+        _group_by_source()) and chaining _reimport_records() for them. If the
+        reimport is aborted, the jobs of the sources that were not reached are
+        finished as well.'''
+
+    remaining = deque()
+    try:
+        # Create and start a new harvest job for each source
+        for source_id, ckan_fb_mapping in mappings.items():
+            harvest_job = start_reimport_job(context, source_id)
+            assert harvest_job
+            remaining.append((ckan_fb_mapping, fb_sources[source_id]['url'], harvest_job))
+        while remaining:
+            ckan_fb_mapping, harvester_url, harvest_job = remaining.popleft()
+            yield from _reimport_records(ckan_fb_mapping, harvester_url, harvest_job, errors)
+    finally:
+        for _, _, harvest_job in remaining:
+            _finish_reimport_job(harvest_job)
+
+def _reimport_records(ckan_fb_mapping, harvester_url, harvest_job, errors=None):
+    '''Generator doing the work of iter_reimport_batch().'''
+
+    batch_size = toolkit.asint(toolkit.config.get(
+        'ckanext.fisbroker.reimport.batch_size', REIMPORT_BATCH_SIZE_DEFAULT))
+    fetch_workers = toolkit.asint(toolkit.config.get(
+        'ckanext.fisbroker.reimport.fetch_workers', REIMPORT_FETCH_WORKERS_DEFAULT))
+    mapping = list(ckan_fb_mapping.items())
+    batches = iter([mapping[start:start + batch_size] for start in range(0, len(mapping), batch_size)])
 
-    # Create and start a new harvest job
-    job_dict = toolkit.get_action('harvest_job_create')(context, {'source_id': source_id})
-    harvest_job = HarvestJob.get(job_dict['id'])
-    harvest_job.gather_started = datetime.datetime.utcnow()
-    assert harvest_job
+    from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
 
-    # instatiate the CSW connector (on the reasonable assumption that harvester_url is
-    # the same for all package_ids)
+    harvester = FisbrokerHarvester()
+    harvester.force_import = True
+    # a new index for each reimport, as a (daily) reimport job can be continued by
+    # later reimports
+    index = ImportIndex.load(harvest_job.id)
     package_id = None
-    reimported_packages = {}
+    pending = deque()
     try:
+        # instatiate the CSW connector (on the reasonable assumption that harvester_url is
+        # the same for all package_ids)
         csw = CswService(harvester_url)
-        for package_id, fb_guid in ckan_fb_mapping.items():
-            # query connector to get resource document
-            csw.getrecordbyid([fb_guid])
-
-            # show resource document
-            record = csw.records().get(fb_guid, None)
-            if record:
-                obj = HarvestObject(guid=fb_guid,
-                                    job=harvest_job,
-                                    content=(record.xml).decode('utf-8'),
-                                    package_id=package_id,
-                                    extras=[
-                                        HarvestObjectExtra(key='status',value='change'),
-                                        HarvestObjectExtra(key='type',value='reimport'),
-                                    ])
-                obj.save()
-
-                assert obj, obj.content
-                
-                from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
-
-                harvester = FisbrokerHarvester()
-                harvester.force_import = True
-                harvester.import_stage(obj)
-                rejection_reason = _dataset_rejected(obj)
-                harvester.force_import = False
-                if rejection_reason:
-                    raise FBImportError(package_id, rejection_reason)
-
-                Session.refresh(obj)
-
-                reimported_packages[package_id] = record
-
-            else:
-                msg = ERROR_MESSAGES[ERROR_NOT_FOUND_IN_FISBROKER].format(fb_guid)
-                err = HarvestGatherError(message=msg, job=harvest_job)
-                err.save()
-                raise NotFoundInFisbrokerError(package_id, fb_guid)
+        clients = threading.local()
+
+        def fetch(batch):
+            # every fetching thread gets its own connector
+            if not hasattr(clients, 'csw'):
+                clients.csw = csw.clone()
+            return clients.csw.getrecordsbyid([fb_guid for _, fb_guid in batch])
+
+        with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+            # batches of records are fetched in the background while the records
+            # fetched so far are imported here; at most REIMPORT_BATCHES_IN_FLIGHT
+            # batches per fetching thread are queued
+            def submit_next():
+                batch = next(batches, None)
+                if batch:
+                    pending.append((batch, executor.submit(fetch, batch)))
+
+            for _ in range(REIMPORT_BATCHES_IN_FLIGHT * fetch_workers):
+                submit_next()
+
+            try:
+                while pending:
+                    batch, future = pending.popleft()
+                    package_id = batch[0][0]
+                    records = future.result()
+                    submit_next()
+
+                    for package_id, fb_guid in batch:
+                        record = records.get(fb_guid, None)
+                        if not record:
+                            msg = ERROR_MESSAGES[ERROR_NOT_FOUND_IN_FISBROKER].format(fb_guid)
+                            err = HarvestGatherError(message=msg, job=harvest_job)
+                            err.save()
+                            if errors is None:
+                                raise NotFoundInFisbrokerError(package_id, fb_guid)
+                            errors[package_id] = NotFoundInFisbrokerError(package_id, fb_guid)
+                            continue
+
+                        obj = HarvestObject(guid=fb_guid,
+                                            job=harvest_job,
+                                            content=(record.xml).decode('utf-8'),
+                                            package_id=package_id,
+                                            extras=[
+                                                HarvestObjectExtra(key='status',value='change'),
+                                                HarvestObjectExtra(key='type',value='reimport'),
+                                            ])
+                        obj.save()
+
+                        assert obj, obj.content
+
+                        harvester.import_transformed(obj, None, index)
+                        rejection_reason = _dataset_rejected(obj)
+                        if rejection_reason:
+                            if errors is None:
+                                raise FBImportError(package_id, rejection_reason)
+                            errors[package_id] = FBImportError(package_id, rejection_reason)
+                            continue
+
+                        Session.refresh(obj)
+
+                        yield package_id, record
+            finally:
+                # don't fetch anything else if the reimport was aborted
+                for _, future in pending:
+                    future.cancel()
 
     except (RequestException, ProtocolError, ConnectionError, AttributeError, CswError) as error:
         raise NoConnectionError(package_id, harvester_url, str(error.__class__.__name__))
     finally:
+        harvester.force_import = False
         # finish harvest job, both successfully and unsuccessfully
-        harvest_job.status = u'Finished'
-        harvest_job.finished = datetime.datetime.utcnow()
-        harvest_job.save()
+        _finish_reimport_job(harvest_job)
+
+def _finish_reimport_job(harvest_job):
+    '''Mark the reimport job `harvest_job` as finished. The rolling reimport job
+        of a day is only finished by the last of the reimports that run in it.'''
+    if daily_reimport_job_enabled():
+        with reimport_lock.source_lock(harvest_job.source_id):
+            if reimport_lock.detach_from_job(harvest_job.id):
+                harvest_job.status = u'Finished'
+            harvest_job.finished = datetime.datetime.utcnow()
+            harvest_job.save()
+        return
+    harvest_job.status = u'Finished'
+    harvest_job.finished = datetime.datetime.utcnow()
+    harvest_job.save()
 
-    return reimported_packages
+def reprocess_batch(package_ids, context, workers=None):
+    '''Reprocess all packages in `package_ids` (ids or names) from the content
+        of their current harvest objects, i.e. run the import stage again on
+        the FIS-Broker records that were fetched during the last harvest or
+        reimport, without connecting to FIS-Broker. The records are transformed
+        in a pool of `workers` worker processes (default: one per CPU).
+        The packages are reprocessed in chunks of REPROCESS_CHUNK_SIZE, with one
+        reimport job per harvest source for all chunks.
+        Return a tuple of a dict mapping the ids of the reprocessed packages to
+        their FIS-Broker guids, and a dict mapping the ids or names of the
+        packages that could not be reprocessed to a ReimportError.'''
+
+    from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
+
+    package_ids = list(package_ids)
+    errors = {}
+    reprocessed_packages = {}
+    harvest_jobs = {}
+    harvester = FisbrokerHarvester()
+    harvester.force_import = True
+    try:
+        for start in range(0, len(package_ids), REPROCESS_CHUNK_SIZE):
+            chunk = package_ids[start:start + REPROCESS_CHUNK_SIZE]
+            _reprocess_chunk(chunk, context, workers, harvester, harvest_jobs,
+                             reprocessed_packages, errors)
+    finally:
+        harvester.force_import = False
+        for harvest_job in harvest_jobs.values():
+            _finish_reimport_job(harvest_job)
+
+    return reprocessed_packages, errors
+
+def _reprocess_chunk(package_ids, context, workers, harvester, harvest_jobs, reprocessed_packages, errors):
+    '''Reprocess the packages in the chunk `package_ids` for reprocess_batch().
+        The reimport jobs are taken from (and added to) `harvest_jobs`, a dict
+        mapping harvest source ids to jobs; the results are stored in
+        `reprocessed_packages` and `errors`.'''
+
+    packages = Session.query(Package.id, Package.name) \
+        .filter(Package.id.in_(package_ids) | Package.name.in_(package_ids))
+    package_lookup = {}
+    for package_id, package_name in packages:
+        package_lookup[package_id] = package_id
+        package_lookup[package_name] = package_id
+    for package_id in package_ids:
+        if package_id not in package_lookup:
+            errors[package_id] = PackageIdDoesNotExistError(package_id)
+
+    current_objects = Session.query(HarvestObject) \
+        .join(HarvestSource, HarvestObject.harvest_source_id == HarvestSource.id) \
+        .filter(HarvestSource.type == HARVESTER_ID) \
+        .filter(HarvestObject.current == True) \
+        .filter(HarvestObject.content != None) \
+        .filter(HarvestObject.package_id.in_(set(package_lookup.values())))
+
+    # start the jobs before reading the objects, as this commits
+    for (source_id,) in current_objects.with_entities(HarvestObject.harvest_source_id).distinct():
+        if source_id not in harvest_jobs:
+            harvest_jobs[source_id] = start_reimport_job(context, source_id)
+
+    # one copy of each current harvest object in the job of its source
+    found = set()
+    harvest_objects = []
+    for current_object in current_objects.yield_per(REPROCESS_CHUNK_SIZE):
+        found.add(current_object.package_id)
+        harvest_objects.append(HarvestObject(guid=current_object.guid,
+                                             job=harvest_jobs[current_object.harvest_source_id],
+                                             content=current_object.content,
+                                             package_id=current_object.package_id,
+                                             extras=[
+                                                 HarvestObjectExtra(key='status', value='change'),
+                                                 HarvestObjectExtra(key='type', value='reimport'),
+                                             ]))
+        Session.expunge(current_object)
+    for package_id in package_ids:
+        if package_id in package_lookup and package_lookup[package_id] not in found:
+            errors[package_id] = PackageNotHarvestedInFisbrokerError(package_id)
+    Session.add_all(harvest_objects)
+    Session.commit()
+
+    harvester.import_objects(harvest_objects, workers)
+
+    for obj in harvest_objects:
+        Session.refresh(obj)
+        rejection_reason = _dataset_rejected(obj)
+        if rejection_reason:
+            errors[obj.package_id] = FBImportError(obj.package_id, rejection_reason)
+        else:
+            reprocessed_packages[obj.package_id] = obj.guid
+        Session.expunge(obj)
 
 def reimport(package_id, direct_call=False, context=None):
     '''Reimport package with `package_id` from the original harvest
@@ -239,43 +732,71 @@ def reimport(package_id, direct_call=False, context=None):
             'session': model.Session,
             'user': c.user
         }
-    response_data = {
-        "success": False
-    }
-    response_code = 200
+    response_code, response_data = _coalesced_reimport_response(package_id, context)
+
+    return _finish(response_code, response_data, direct_call)
+
+def _coalescing_key(package_id):
+    '''Return the key under which reimports of `package_id` are coalesced, so
+        that reimports by id and by name of the same package are coalesced.'''
+    package = Package.get(package_id)
+    return package.id if package else package_id
+
+def _coalesced_reimport_response(package_id, context):
+    '''Like _reimport_response(), but if the package is already being reimported,
+        don't reimport it again: attach to the reimport in flight and return
+        its status handle like for an enqueued reimport (HTTP 202). The status
+        of the reimport is recorded, so that requests that attach to it can
+        follow it. A new reimport fails with a ReimportBusyError if the maximum
+        number of concurrent reimports is reached.'''
+    key = _coalescing_key(package_id)
+    token = str(uuid.uuid4())
+    in_flight = reimport_lock.claim_package(key, token)
+    if in_flight:
+        LOG.info(f"Package {package_id} is already being reimported by {in_flight}")
+        return _in_flight_response(in_flight, package_id)
+
+    reimport_lock.record_status(token, 'started', package_id=key)
+    result = None
+    try:
+        if reimport_lock.acquire_slot(token):
+            try:
+                result = _reimport_response(package_id, context)
+            finally:
+                reimport_lock.release_slot(token)
+        else:
+            response_code, error_dict = _error_response(ReimportBusyError(package_id))
+            result = (response_code, {
+                'success': False,
+                'error': error_dict,
+                'package_id': package_id
+            })
+    finally:
+        if result:
+            reimport_lock.record_status(token, 'finished', package_id=key, processed=1,
+                                        response_code=result[0], result=result[1])
+        else:
+            reimport_lock.record_status(token, 'failed', package_id=key)
+        reimport_lock.release_package(key, token)
+
+    return result
+
+def _reimport_response(package_id, context):
+    '''Reimport package with `package_id` and return the HTTP status code and
+        the response data describing the result.'''
     try:
         reimport_batch([package_id], context)
-    except PackageNotHarvestedInFisbrokerError:
-        response_code = 422
-        response_data['error'] = get_error_dict(ERROR_NOT_HARVESTED_BY_FISBROKER)
-    except PackageNotHarvestedError:
-        response_code = 422
-        response_data['error'] = get_error_dict(ERROR_NOT_HARVESTED)
-    except NoFisbrokerIdError:
-        response_code = 500
-        response_data['error'] = get_error_dict(ERROR_NO_GUID)
-    except NoConnectionError as error:
-        response_code = 500
-        response_data['error'] = get_error_dict(ERROR_NO_CONNECTION)
-        message = response_data['error']['message'].format(error.service_url, str(error.__class__.__name__))
-        response_data['error']['message'] = message
-    except NotFoundInFisbrokerError as error:
-        response_code = 404
-        response_data['error'] = get_error_dict(ERROR_NOT_FOUND_IN_FISBROKER)
-        message = response_data['error']['message'].format(error.fb_guid)
-        response_data['error']['message'] = message
-    except PackageIdDoesNotExistError as error:
-        response_code = 404
-        response_data['error'] = get_error_dict(ERROR_NOT_FOUND_IN_CKAN)
-        message = response_data['error']['message'].format(error.package_id)
-        response_data['error']['message'] = message
-    except FBImportError as error:
-        from ckan.logic.action.delete import package_delete
-        response_data['error'] =  get_error_dict(ERROR_DURING_IMPORT)
-        message = response_data['error']['message'].format(error.reason)
-        response_data['error']['message'] = f"{message} – Package will be deactivated."
-        package_delete(context, { "id": package_id })
+    except ReimportError as error:
+        response_code, error_dict = _error_response(error)
+        response_data = {
+            "success": False,
+            "error": error_dict
+        }
+        if isinstance(error, FBImportError):
+            from ckan.logic.action.delete import package_delete
+            package_delete(context, { "id": package_id })
     else:
+        response_code = 200
         response_data = {
             'success': True,
             'message': "Package was successfully re-imported."
@@ -283,7 +804,193 @@ def reimport(package_id, direct_call=False, context=None):
 
     response_data['package_id'] = package_id
 
-    return _finish(response_code, response_data, direct_call)
+    return response_code, response_data
+
+def _error_response(error):
+    '''Return the HTTP status code and the error dict for the ReimportError `error`.'''
+    if isinstance(error, PackageNotHarvestedInFisbrokerError):
+        return 422, get_error_dict(ERROR_NOT_HARVESTED_BY_FISBROKER)
+    if isinstance(error, PackageNotHarvestedError):
+        return 422, get_error_dict(ERROR_NOT_HARVESTED)
+    if isinstance(error, NoFisbrokerIdError):
+        return 500, get_error_dict(ERROR_NO_GUID)
+    if isinstance(error, ReimportBusyError):
+        return 429, get_error_dict(ERROR_REIMPORT_BUSY)
+
+    response_code = 500
+    if isinstance(error, NoConnectionError):
+        error_dict = get_error_dict(ERROR_NO_CONNECTION)
+        message = error_dict['message'].format(error.service_url, str(error.__class__.__name__))
+    elif isinstance(error, NotFoundInFisbrokerError):
+        response_code = 404
+        error_dict = get_error_dict(ERROR_NOT_FOUND_IN_FISBROKER)
+        message = error_dict['message'].format(error.fb_guid)
+    elif isinstance(error, PackageIdDoesNotExistError):
+        response_code = 404
+        error_dict = get_error_dict(ERROR_NOT_FOUND_IN_CKAN)
+        message = error_dict['message'].format(error.package_id)
+    elif isinstance(error, FBImportError):
+        response_code = 200
+        error_dict = get_error_dict(ERROR_DURING_IMPORT)
+        message = f"{error_dict['message'].format(error.reason)} – Package will be deactivated."
+    else:
+        error_dict = get_error_dict(ERROR_UNEXPECTED)
+        message = str(error)
+    error_dict['message'] = message
+
+    return response_code, error_dict
+
+def background_reimport_enabled():
+    '''Return True if reimports requested through the browser or API are run
+        as background jobs (`ckanext.fisbroker.reimport.background`).'''
+    return toolkit.asbool(toolkit.config.get('ckanext.fisbroker.reimport.background', False))
+
+def reimport_job(package_id, user):
+    '''Background job for reimporting package with `package_id` on behalf
+        of `user`. Return the response data of the reimport, the corresponding
+        HTTP status code is stored as `response_code` in the job's meta data.
+        The job waits for a free slot if the maximum number of concurrent
+        reimports is reached.'''
+    context = {
+        'model': model,
+        'session': model.Session,
+        'user': user
+    }
+    job = get_current_job()
+    token = job.id if job else str(uuid.uuid4())
+    _record_progress(job, 0, 1)
+    try:
+        if reimport_lock.acquire_slot(token, wait=reimport_lock.lock_timeout()):
+            try:
+                response_code, response_data = _reimport_response(package_id, context)
+            finally:
+                reimport_lock.release_slot(token)
+        else:
+            response_code, error_dict = _error_response(ReimportBusyError(package_id))
+            response_data = {
+                'success': False,
+                'error': error_dict,
+                'package_id': package_id
+            }
+    finally:
+        reimport_lock.release_package(_coalescing_key(package_id), token)
+    if job:
+        job.meta['response_code'] = response_code
+    _record_progress(job, 1, 1)
+
+    return response_data
+
+def _record_progress(job, processed, total):
+    '''Store the number of `processed` out of `total` packages in the meta
+        data of the reimport `job` (if any), for reimport_status().'''
+    if job:
+        job.meta['processed'] = processed
+        job.meta['total'] = total
+        job.save_meta()
+
+def enqueue_reimport(package_id, user):
+    '''Enqueue a background job for reimporting package with `package_id`,
+        return the id of the job. If a reimport job for the package is already
+        queued or running, or the package is being reimported in a request,
+        return the id of that reimport instead of enqueuing another one (see
+        reimport_status()).'''
+    key = _coalescing_key(package_id)
+    job_id = str(uuid.uuid4())
+    in_flight = reimport_lock.claim_package(key, job_id)
+    if in_flight:
+        job = jobs.get_queue().fetch_job(in_flight)
+        if job and job.get_status() in ('queued', 'started', 'deferred'):
+            LOG.info(f"Package {package_id} is already being reimported by job {job.id}")
+            return job.id
+        state = reimport_lock.get_status(in_flight)
+        if not job and state and state['status'] == 'started':
+            LOG.info(f"Package {package_id} is already being reimported by {in_flight}")
+            return in_flight
+        # the reimport that claimed the package is gone
+        reimport_lock.claim_package(key, job_id, force=True)
+
+    job = toolkit.enqueue_job(reimport_job, [package_id, user],
+                              title=f"Reimport {package_id} from FIS-Broker",
+                              rq_kwargs={'job_id': job_id})
+    job.meta['package_id'] = package_id
+    _record_progress(job, 0, 1)
+    LOG.info(f"Enqueued job {job.id} for reimporting {package_id}")
+
+    return job.id
+
+def _enqueued_response(job_id, package_id, message="Package reimport was started."):
+    '''Return the HTTP status code and response data for a reimport of
+        `package_id` that was enqueued as the job with `job_id`.'''
+    return 202, {
+        'success': True,
+        'message': message,
+        'package_id': package_id,
+        'job_id': job_id,
+        'status_url': h.url_for('reimportapi.reimport_status', job_id=job_id),
+    }
+
+def _in_flight_response(token, package_id):
+    '''Return the HTTP status code and response data for a reimport of
+        `package_id` that attached to the reimport in flight with `token` (a
+        background job, a reimport in another request or a bulk reimport).'''
+    return _enqueued_response(token, package_id, "Package is already being reimported.")
+
+def reimport_status(job_id):
+    '''Report the status and progress of the background reimport job with
+        `job_id` (signified by the use of an /api/harvest/reimport/status/{job_id}
+        URL) to users that are allowed to update the reimported package. Once
+        the job has finished, the response contains its result. Reimports that
+        run in a request (single or bulk reimports) can be followed with their
+        token as `job_id` as well, by the users that are allowed to reimport
+        their package or to reimport from their harvest sources.'''
+
+    job = jobs.get_queue().fetch_job(job_id)
+    # only reimport jobs are reported
+    if job and 'package_id' in job.meta:
+        status = job.get_status()
+        state = dict(job.meta, status=status)
+        if status == 'finished':
+            state['result'] = job.result
+    else:
+        state = reimport_lock.get_status(job_id)
+    if not state:
+        response_data = {
+            'success': False,
+            'job_id': job_id,
+            'error': get_error_dict(ERROR_JOB_NOT_FOUND),
+        }
+        response_data['error']['message'] = response_data['error']['message'].format(job_id)
+        return _finish(404, response_data)
+
+    if state.get('package_id'):
+        toolkit.check_access('package_update', _user_context(), {'id': state['package_id']})
+    for source_id in state.get('source_ids', []):
+        toolkit.check_access('harvest_job_create', _user_context(), {'source_id': source_id})
+
+    status = state['status']
+    response_data = {
+        'success': True,
+        'job_id': job_id,
+        'package_id': state.get('package_id'),
+        'status': status,
+        'progress': {
+            'processed': state.get('processed', 0),
+            'total': state.get('total', 1),
+        },
+    }
+    if status == 'finished':
+        response_data['result'] = state.get('result')
+        return _finish(state.get('response_code', 200), response_data)
+    if status == 'failed':
+        response_data['success'] = False
+        response_data['result'] = {
+            'success': False,
+            'package_id': state.get('package_id'),
+            'error': get_error_dict(ERROR_UNEXPECTED),
+        }
+        return _finish(500, response_data)
+
+    return _finish(200, response_data)
 
 def _dataset_rejected(harvest_object):
     """Look at harvest_object to see if the dataset was rejected during
@@ -321,7 +1028,13 @@ def _finish(status_int, response_data=None, direct_call=False):
 reimportapi = Blueprint('reimportapi', __name__)
 reimportapi.add_url_rule(u'/api/harvest/reimport',
                            methods=['GET', 'POST'], view_func=reimport_through_api)
+reimportapi.add_url_rule(u'/api/harvest/reimport/bulk',
+                           methods=['POST'], view_func=reimport_bulk)
+reimportapi.add_url_rule(u'/api/harvest/reimport/status/<job_id>',
+                           methods=['GET'], view_func=reimport_status)
 reimportapi.add_url_rule(u'/dataset/<package_id>/reimport',
                            methods=['GET'], view_func=reimport_through_browser)
 reimportapi.add_url_rule(u'/dataset/<package_id>/csw_record',
                            methods=['GET'], view_func=open_csw_record)
+reimportapi.add_url_rule(u'/dataset/<package_id>/csw_record.xml',
+                           methods=['GET'], view_func=stored_csw_record)
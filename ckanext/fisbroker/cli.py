@@ -1,10 +1,22 @@
 '''Module to implement a click CLI for the FIS-Broker-Harvester'''
 
+import contextlib
+import csv
 import datetime
+import importlib.util
+import io
 import json
 import logging
+import multiprocessing
+import os
+import resource
+import statistics
 import sys
+import tarfile
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pydoc import doc
 
 import ckan.plugins as plugins
@@ -14,11 +26,16 @@ from ckan import logic, model
 from ckan.lib import mailer
 from ckan.lib.navl.dictization_functions import Missing, validate
 from ckantoolkit import config
+from owslib.etree import etree
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
 
 import ckanext.fisbroker.blueprint as blueprint
-from ckanext.fisbroker import HARVESTER_ID
+import ckanext.fisbroker.helper as helpers
+import ckanext.fisbroker.transform as transform
+from ckanext.fisbroker import HARVESTER_ID, MAPPING_VERSION
 from ckanext.fisbroker.csw_client import CswService
-from ckanext.fisbroker.exceptions import NotFoundInFisbrokerError
+from ckanext.fisbroker.exceptions import FBImportError, NoFBHarvesterDefined, ReimportError
 from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
 from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestSource
 from ckanext.harvest.queue import get_connection
@@ -28,6 +45,16 @@ from ckanext.spatial.harvesters.csw import CSWHarvester
 LOG = logging.getLogger(__name__)
 FISBROKER_SOURCE_NAME = 'harvest-fisbroker'
 JSON_INDENT = 2
+# number of datasets requested from the search index at a time
+SEARCH_PAGE_SIZE = 500
+# number of rows fetched at a time from server-side cursors
+QUERY_CHUNK_SIZE = 1000
+# number of datasets that a reimport worker reimports at a time
+REIMPORT_BATCH_SIZE_DEFAULT = 100
+# number of batches per reimport worker that are handed out in advance
+REIMPORT_BATCHES_PER_WORKER = 2
+# state of a reimport worker process
+_reimport_worker = {}
 
 def _filter_dataset(dataset):
     '''Filter relevant information for an individual dataset.'''
@@ -37,9 +64,36 @@ def _filter_dataset(dataset):
         'title': dataset.get('title')
     }
 
-def _filter_datasets(datasets):
-    '''Generate a list of filtered datasets.'''
-    return [_filter_dataset(dataset) for dataset in datasets]
+def _echo_grouped(groups, output_format: str, fieldnames: list):
+    '''Write the items of {groups}, an iterable of (source id, items) pairs,
+    while they are generated: as a single JSON object with a list of items per
+    source ('json'), or with one item per line ('jsonl' and 'csv'), where each
+    item has the id of its source as `source`.
+    '''
+    indent = ' ' * JSON_INDENT
+    if output_format == 'json':
+        click.echo("{", nl=False)
+    elif output_format == 'csv':
+        click.echo(",".join(['source'] + fieldnames))
+    for group_index, (source, items) in enumerate(groups):
+        if output_format == 'json':
+            separator = "," if group_index else ""
+            click.echo(f"{separator}\n{indent}{json.dumps(source)}: [", nl=False)
+        for item_index, item in enumerate(items):
+            if output_format == 'json':
+                separator = "," if item_index else ""
+                click.echo(f"{separator}\n{indent * 2}{json.dumps(item)}", nl=False)
+            elif output_format == 'jsonl':
+                click.echo(json.dumps({'source': source, **item}))
+            else:
+                row = io.StringIO()
+                csv.writer(row, lineterminator="\n").writerow(
+                    [source] + [item.get(field) for field in fieldnames])
+                click.echo(row.getvalue(), nl=False)
+        if output_format == 'json':
+            click.echo(f"\n{indent}]", nl=False)
+    if output_format == 'json':
+        click.echo("\n}")
 
 def _list_sources() -> list:
     '''List all instances of the FIS-Broker harvester.
@@ -50,58 +104,327 @@ def _list_sources() -> list:
     return [source for source in sources if source['type'] == HARVESTER_ID]
 
 def _list_packages(source_id: str, offset: int = 0, limit: int = -1):
-    '''List the ids and titles of all datasets harvested by the
-    FIS-Broker harvester. Either of all instances or of the
-    one specified by {source-id}.
+    '''Generate the ids, names and titles of the datasets harvested by the
+    harvester instance {source-id}, sorted by name. {offset} and {limit}
+    are passed on to the search index, which is queried one page at a time,
+    so only a single page of datasets is held in memory.
     '''
     click.echo(f"listing datasets for source {source_id} ...", err=True)
 
     filter_query = f'harvest_source_id: "{source_id}"'
     search_dict = {
         'fq': filter_query,
-        'start': 0,
-        'rows': 500,
+        'fl': ['id', 'name', 'title'],
+        'start': offset,
         'sort': 'name asc',
     }
     context = {'model': model, 'session': model.Session}
 
-    total_results = []
-    while True:
-        result = logic.get_action('package_search')(context, search_dict)
-        length = len(result['results'])
-        total_results += result['results']
-        search_dict['start'] = search_dict['start'] + length
-        if len(total_results) >= result['count']:
+    remaining = limit
+    while remaining != 0:
+        search_dict['rows'] = SEARCH_PAGE_SIZE if remaining < 0 else min(remaining, SEARCH_PAGE_SIZE)
+        result = logic.get_action('package_search')(context, search_dict.copy())
+        packages = result['results']
+        for package in packages:
+            yield package
+        if remaining > 0:
+            remaining -= len(packages)
+        search_dict['start'] += len(packages)
+        if not packages or search_dict['start'] >= result['count']:
             break
 
-    if limit < 0:
-        limit = len(total_results)
 
-    return total_results[offset:offset+limit]
+def _select_package_ids(source: str, datasetid: str, offset: int, limit: int, verb: str) -> list:
+    '''Return the names of the datasets selected by the options of the
+    reimport-dataset and reprocess-dataset commands: either the single dataset
+    {datasetid}, or the datasets of the harvester instance {source}, or those of
+    all instances, paged with {offset} and {limit}.
+    '''
+    package_ids = []
+    if datasetid:
+        click.echo(f"{verb} a single dataset ...", err=True)
+        package_ids = [ datasetid ]
+    else:
+        sources = []
+        if source:
+            click.echo(f"{verb} all dataset from a single source: {source} ...", err=True)
+            sources = [ source ]
+        else:
+            click.echo(f"{verb} all dataset from all sources ...", err=True)
+            sources = [ source.get('id') for source in _list_sources() ]
+        for source in sources:
+            package_ids += [package['name'] for package in _list_packages(source, offset, limit)]
+    return package_ids
 
+def _site_user_context() -> dict:
+    '''Return a context for running actions as the site user.'''
+    site_user = logic.get_action(u'get_site_user')({
+        u'model': model,
+        u'ignore_auth': True},
+        {}
+    )
+    return {
+        u'model': model,
+        u'session': model.Session,
+        u'ignore_auth': True,
+        u'user': site_user['name'],
+    }
 
-def _reimport_dataset(dataset_ids, context):
-    '''Reimport all datasets in dataset_ids.'''
+def _read_checkpoint(path: str) -> set:
+    '''Return the ids of the datasets that were reimported successfully
+    according to the checkpoint file at {path}.
+    '''
+    reimported = set()
+    if not os.path.exists(path):
+        return reimported
+    with open(path) as checkpoint:
+        for line in checkpoint:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a line that was cut off when the previous run was killed
+                continue
+            if entry.get('success'):
+                reimported.add(entry['package_id'])
+    return reimported
+
+def _write_checkpoint(checkpoint, package_id: str, error=None):
+    '''Append the result of reimporting {package_id} to the open {checkpoint} file.'''
+    if checkpoint:
+        entry = {'package_id': package_id, 'success': error is None}
+        if error is not None:
+            entry['error'] = str(error)
+        checkpoint.write(json.dumps(entry) + "\n")
+        checkpoint.flush()
+
+def _reimport_dataset(dataset_ids, context, checkpoint=None):
+    '''Reimport all datasets in dataset_ids. Datasets that cannot be reimported
+    are reported in the result's errors, without aborting the reimport of the
+    others. Datasets that were rejected by the harvester are deactivated. The
+    result of each dataset is appended to the open {checkpoint} file.
+    '''
 
     result = {
         'errors': [],
         'datasets': {}
     }
-
+    errors = {}
 
     try:
-        reimported_packages = blueprint.reimport_batch(dataset_ids, context)
-    except NotFoundInFisbrokerError as e:
+        last = time.time()
+        for package_id, record in blueprint.iter_reimport_batch(dataset_ids, context, errors):
+            now = time.time()
+            result['datasets'][package_id] = {
+                'fisbroker_guid': record.identifier ,
+                'title': record.identification.title,
+                'seconds': round(now - last, 3),
+            }
+            last = now
+            _write_checkpoint(checkpoint, package_id)
+    except (ReimportError, NoFBHarvesterDefined) as e:
+        # errors that abort the whole reimport, like a lost connection to FIS-Broker
         result['errors'].append(str(e))
-
-    for package_id, record in reimported_packages.items():
-        result['datasets'][package_id] = {
-            'fisbroker_guid': record.identifier ,
-            'title': record.identification.title
-        }
+    finally:
+        for package_id, error in errors.items():
+            result['errors'].append(str(error))
+            if isinstance(error, FBImportError):
+                logic.get_action('package_delete')(context.copy(), {'id': package_id})
+            _write_checkpoint(checkpoint, package_id, error)
 
     return result
 
+def _init_reimport_worker(flask_app):
+    '''Set up a reimport worker process: push a request context of {flask_app}
+    for the lifetime of the process and create the context for the actions.
+    '''
+    request_context = flask_app.test_request_context()
+    request_context.push()
+    _reimport_worker['request_context'] = request_context
+    _reimport_worker['context'] = _site_user_context()
+
+def _reimport_worker_batch(dataset_ids: list):
+    '''Reimport {dataset_ids} in a reimport worker process. Return the result of
+    `_reimport_dataset()` and the checkpoint lines for the datasets.
+    '''
+    checkpoint = io.StringIO()
+    try:
+        result = _reimport_dataset(dataset_ids, _reimport_worker['context'].copy(), checkpoint)
+    finally:
+        model.Session.remove()
+    return result, checkpoint.getvalue()
+
+def _failed_batch(dataset_ids: list, error: Exception):
+    '''Return the result and the checkpoint lines for a batch whose worker failed.'''
+    checkpoint = io.StringIO()
+    for dataset_id in dataset_ids:
+        _write_checkpoint(checkpoint, dataset_id, error)
+    result = {
+        'errors': [f"{dataset_id}: {error}" for dataset_id in dataset_ids],
+        'datasets': {},
+    }
+    return result, checkpoint.getvalue()
+
+def _reimport_batches(batches: list, flask_app, workers: int = 1, rate: float = 0):
+    '''Reimport the datasets in {batches} (lists of dataset ids) and yield
+    (batch, result, checkpoint lines) for every batch as soon as it is done.
+    With more than one worker, the batches are reimported in a pool of
+    {workers} forked worker processes. With {rate}, the batches are handed out
+    so that no more than {rate} datasets per second are started.
+    '''
+    start = time.time()
+    dispatched = 0
+
+    def throttle(batch):
+        nonlocal dispatched
+        if rate:
+            delay = start + dispatched / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        dispatched += len(batch)
+
+    if workers <= 1:
+        with flask_app.test_request_context():
+            context = _site_user_context()
+            for batch in batches:
+                throttle(batch)
+                checkpoint = io.StringIO()
+                result = _reimport_dataset(batch, context.copy(), checkpoint)
+                yield batch, result, checkpoint.getvalue()
+        return
+
+    # the worker processes must not share the database connections of this process
+    model.Session.remove()
+    model.meta.engine.dispose()
+    queued = list(batches)
+    pending = {}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=_init_reimport_worker, initargs=(flask_app,)) as executor:
+        while queued or pending:
+            while queued and len(pending) < workers * REIMPORT_BATCHES_PER_WORKER:
+                batch = queued.pop(0)
+                throttle(batch)
+                pending[executor.submit(_reimport_worker_batch, batch)] = batch
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                try:
+                    result, checkpoint = future.result()
+                except Exception as e:
+                    # e.g. a worker process that was killed
+                    LOG.error(f"Reimport worker failed: {e}")
+                    result, checkpoint = _failed_batch(batch, e)
+                yield batch, result, checkpoint
+
+def _echo_progress(done: int, total: int, errors: int, start: float):
+    '''Overwrite the progress line on STDERR with the number of reimported
+    datasets, the throughput and the estimated remaining time.
+    '''
+    elapsed = time.time() - start
+    throughput = done / elapsed if elapsed > 0 else 0
+    eta = "?"
+    if throughput:
+        eta = str(datetime.timedelta(seconds=round((total - done) / throughput)))
+    click.echo(f"\rreimported {done}/{total} datasets ({errors} errors), "
+               f"{throughput:.1f} datasets/s, ETA {eta}  ", err=True, nl=False)
+
+def _percentile(values: list, fraction: float) -> float:
+    '''Return the {fraction} percentile of the sorted {values} (nearest rank).'''
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _echo_timing_summary(datasets: dict):
+    '''Write a summary of the time it took to reimport each of {datasets}
+    (the datasets of a reimport result) to STDERR.
+    '''
+    timings = sorted((metadata['seconds'], package_id) for package_id, metadata in datasets.items()
+                     if 'seconds' in metadata)
+    if not timings:
+        return
+    seconds = [timing for timing, _ in timings]
+    click.echo(f"seconds per dataset: mean {statistics.mean(seconds):.3f}, "
+               f"median {statistics.median(seconds):.3f}, p95 {_percentile(seconds, 0.95):.3f}, "
+               f"max {seconds[-1]:.3f}", err=True)
+    click.echo("slowest datasets:", err=True)
+    for timing, package_id in reversed(timings[-5:]):
+        click.echo(f"  {package_id}: {timing:.3f}", err=True)
+
+def _read_tar_records(archive):
+    '''Yield (name, content) for every XML file in the open tar `archive`.'''
+    for member in archive:
+        if member.isfile() and member.name.endswith('.xml'):
+            yield member.name, archive.extractfile(member).read()
+
+def _read_records(path: str):
+    '''Yield (name, content) for every XML file in `path`, which is either a
+    directory (searched recursively), a (compressed) tar archive, a single XML
+    file, or `-` for STDIN (a tar archive or a single XML document).
+    '''
+    if path == '-':
+        data = sys.stdin.buffer.read()
+        if tarfile.is_tarfile(io.BytesIO(data)):
+            with tarfile.open(fileobj=io.BytesIO(data), mode='r:*') as archive:
+                yield from _read_tar_records(archive)
+        else:
+            yield '<stdin>', data
+    elif os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                if filename.endswith('.xml'):
+                    file_path = os.path.join(root, filename)
+                    with open(file_path, 'rb') as f:
+                        yield file_path, f.read()
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path, mode='r|*') as archive:
+            yield from _read_tar_records(archive)
+    else:
+        with open(path, 'rb') as f:
+            yield path, f.read()
+
+def _transform_payloads(records, owner_org: str, names: list, failures: list):
+    '''Generate the payloads for `transform.transform_many()` from the (name, content)
+    tuples in `records`. Every document is named after its file, files that
+    contain more than one document get an index. Names of the payloads are
+    appended to `names`, files that are not well-formed XML to `failures`.
+    '''
+    source = transform.DetachedSource('offline')
+    for name, content in records:
+        try:
+            documents = transform.split_documents(content)
+        except Exception as e:
+            failures.append({'file': name, 'status': 'error', 'error': f"Error parsing XML: {e}"})
+            continue
+        for index, document in enumerate(documents):
+            document_name = name if len(documents) == 1 else f"{name}#{index}"
+            names.append(document_name)
+            harvest_object = transform.DetachedHarvestObject(document_name, None, document, source=source)
+            yield harvest_object, owner_org
+
+def _transform_output(name: str, result: dict, format: str) -> dict:
+    '''Build the output line for the transformation `result` of the document `name`.'''
+    output = {
+        'file': name,
+        'guid': result['guid'],
+        'errors': [message for message, stage in result['errors']],
+    }
+    package_dict = result['package_dict']
+    if result['error']:
+        output['status'] = 'error'
+        output['error'] = result['error']
+    elif package_dict == 'skip':
+        output['status'] = 'skipped'
+        reasons = [json.loads(value) for key, value in result['extras'] if key == 'error']
+        output['reason'] = reasons[0] if reasons else None
+    elif not package_dict:
+        output['status'] = 'error'
+        output['error'] = "Mapping did not produce a package dict"
+    else:
+        output['status'] = 'ok'
+    if format == ISO:
+        output['iso_values'] = result['iso_values']
+    elif output['status'] == 'ok':
+        output['package'] = package_dict
+    return output
+
 def is_harvest_redis_available():
     '''
         Check if harvester has connection to Redis
@@ -176,57 +499,70 @@ def list_sources():
 @click.option("-s",  "--source", help="The source id of the harvester")
 @click.option("-o", "--offset", default=0, help="Index of the first dataset to reimport")
 @click.option("-l", "--limit", default=-1, help="Max number of datasets to reimport")
-def list_datasets(source: str, offset: int, limit: int):
+@click.option("-f", "--format", "output_format", type=click.Choice(['json', 'jsonl']), default='json',
+              help="Output a single JSON object (default) or one JSON object per line")
+def list_datasets(source: str, offset: int, limit: int, output_format: str):
     '''
     List the ids and titles of all datasets harvested by the
     FIS-Broker harvester. Either of all instances or of the
     one specified by {source-id}.
+    The datasets are written while they are read from the search index.
+    With `--format jsonl`, every line is a dataset with the id of its
+    harvester instance as `source`.
     '''
     click.echo("listing datasets harvested by FisbrokerPlugin ...", err=True)
     sources = [_source.get('id') for _source in _list_sources()]
     if source is not None:
         sources = [source]
-    filtered_packages = {}
-    for _source in sources:
+
+    def datasets(_source):
         start = time.time()
-        packages = _list_packages(_source, offset, limit)
-        filtered_packages[_source] = _filter_datasets(packages)
-        click.echo(f"there were {len(filtered_packages[_source])} results ...", err=True)
+        count = 0
+        for package in _list_packages(_source, offset, limit):
+            yield _filter_dataset(package)
+            count += 1
+        click.echo(f"there were {count} results ...", err=True)
         end = time.time()
         click.echo(f"This took {end - start} seconds", err=True)
 
-    click.echo(json.dumps(filtered_packages, indent=JSON_INDENT))
+    _echo_grouped(((_source, datasets(_source)) for _source in sources),
+                  output_format, ['id', 'name', 'title'])
 
 
 @fisbroker.command()
 @click.option("-s",  "--source", help="The source id of the harvester")
-def harvest_objects(source: str):
+@click.option("-g", "--guid-prefix", help="Only show harvest objects whose CSW-guid starts with this prefix")
+@click.option("--status", help="Only show harvest objects with this report status of their last import "
+                               "('added', 'updated' or 'not modified')")
+@click.option("-f", "--format", "output_format", type=click.Choice(['json', 'jsonl', 'csv']), default='json',
+              help="Output a single JSON object (default), one JSON object per line or CSV")
+def harvest_objects(source: str, guid_prefix: str, status: str, output_format: str):
     '''
     Show all harvest objects with their CSW-guids and CKAN package ids, either
     of the harvester instance specified by {source-id}, or of all instances.
+    The harvest objects are read with a server-side cursor and written as they
+    are read.
     '''
     sources = [_source.get('id') for _source in _list_sources()]
     if source is not None:
         sources = [str(source)]
-    output = {}
-    for _source in sources:
-        harvest_job = MockHarvestJob()
-        harvest_job.source = HarvestSource.get(_source)
-        harvest_job.id = 'fakeid'
+
+    def current_objects(_source):
         query = model.Session.query(HarvestObject.guid, HarvestObject.package_id).\
             filter(HarvestObject.current == True).\
-            filter(HarvestObject.harvest_source_id == harvest_job.source.id)
-        harvest_objects = []
-
-        for guid, package_id in query:
-            harvest_objects.append({
+            filter(HarvestObject.harvest_source_id == _source)
+        if guid_prefix:
+            query = query.filter(HarvestObject.guid.startswith(guid_prefix, autoescape=True))
+        if status:
+            query = query.filter(HarvestObject.report_status == status)
+        for guid, package_id in query.order_by(HarvestObject.guid).yield_per(QUERY_CHUNK_SIZE):
+            yield {
                 "csw_guid": guid,
                 "package_id": package_id
-            })
+            }
 
-        output[str(_source)] = harvest_objects
-
-    click.echo(json.dumps(output, indent=JSON_INDENT))
+    _echo_grouped(((_source, current_objects(_source)) for _source in sources),
+                  output_format, ['csw_guid', 'package_id'])
 
 @fisbroker.command()
 @click.option("-s",  "--source", help="The source id of the harvester")
@@ -256,33 +592,48 @@ def last_successful_job(source: str):
 
 @fisbroker.command()
 @click.option("-b", "--berlinsource", default='harvest-fisbroker', help="The value for the 'berlin_source' extra we want to filter by.")
-def list_datasets_berlin_source(berlinsource: str):
+@click.option("-f", "--format", "output_format", type=click.Choice(['json', 'jsonl']), default='json',
+              help="Output a single JSON list (default) or one JSON object per line")
+def list_datasets_berlin_source(berlinsource: str, output_format: str):
     '''
     Show all active datasets for which the 'berlin_source' extra is {berlin_source}
     (default is 'harvest-fisbroker').
     '''
-    query = model.Session.query(model.Package).filter_by(
-        state=model.State.ACTIVE)
-    datasets = [
-        {
-            "name": pkg.name,
-            "title": pkg.title,
-            "id": pkg.id,
-            "extras": {key: value for key, value in pkg.extras.items()}
-        } for pkg in query ]
-
-    datasets = [dataset for dataset in datasets if dataset["extras"].get("berlin_source", "_undefined") == berlinsource]
-    filtered_packages = _filter_datasets(datasets)
-
-    click.echo(json.dumps(filtered_packages, indent=JSON_INDENT))
+    query = model.Session.query(model.Package.id, model.Package.name, model.Package.title) \
+        .join(model.PackageExtra, model.PackageExtra.package_id == model.Package.id) \
+        .filter(model.Package.state == model.State.ACTIVE) \
+        .filter(model.PackageExtra.key == 'berlin_source') \
+        .filter(model.PackageExtra.value == berlinsource) \
+        .filter(model.PackageExtra.state == model.State.ACTIVE) \
+        .order_by(model.Package.name) \
+        .yield_per(QUERY_CHUNK_SIZE)
+
+    indent = ' ' * JSON_INDENT
+    count = 0
+    for package_id, name, title in query:
+        dataset = _filter_dataset({'id': package_id, 'name': name, 'title': title})
+        if output_format == 'jsonl':
+            click.echo(json.dumps(dataset))
+        else:
+            separator = "," if count else "["
+            click.echo(f"{separator}\n{indent}{json.dumps(dataset)}", nl=False)
+        count += 1
+    if output_format == 'json':
+        click.echo("\n]" if count else "[]")
 
 @fisbroker.command()
 @click.option("-s", "--source", help="The source id of the harvester")
 @click.option("-d", "--datasetid", help="The id of the dataset")
 @click.option("-o", "--offset", default=0, help="Index of the first dataset to reimport")
 @click.option("-l", "--limit", default=-1, help="Max number of datasets to reimport")
+@click.option("-c", "--checkpoint", type=click.Path(dir_okay=False), help="File to record the result of each dataset in")
+@click.option("--resume", is_flag=True, help="Skip the datasets that were reimported successfully according to the checkpoint file")
+@click.option("-w", "--workers", default=1, help="Number of worker processes")
+@click.option("-r", "--rate", type=float, default=0, help="Max number of datasets to reimport per second (default: no limit)")
+@click.option("-b", "--batch-size", default=REIMPORT_BATCH_SIZE_DEFAULT, help="Number of datasets a worker reimports at a time")
 @click.pass_context
-def reimport_dataset(ctx: click.Context, source: str, datasetid: str, offset: int, limit: int):
+def reimport_dataset(ctx: click.Context, source: str, datasetid: str, offset: int, limit: int,
+                     checkpoint: str, resume: bool, workers: int, rate: float, batch_size: int):
     '''
     Reimport the specified datasets. The specified datasets are either
     all datasets by all instances of the FIS-Broker harvester (if no options
@@ -290,43 +641,133 @@ def reimport_dataset(ctx: click.Context, source: str, datasetid: str, offset: in
     {source-id}, or the single dataset identified by {dataset-id}.
     To reimport only a subset or page through the complete set of datasets,
     use the --offset,-o and --limit,-l options.
+    Datasets that cannot be reimported are reported in the output's errors
+    and don't stop the reimport of the other datasets. With --checkpoint,-c,
+    the result of each dataset is recorded in a file as soon as it is known,
+    so that an interrupted reimport can be continued with --resume.
+    The datasets are reimported in batches of --batch-size,-b datasets, by
+    --workers,-w worker processes and at most --rate,-r datasets per second.
     '''
+    if resume and not checkpoint:
+        raise click.UsageError("--resume requires --checkpoint")
+    if workers < 1 or batch_size < 1 or rate < 0:
+        raise click.UsageError("--workers and --batch-size must be positive, --rate must not be negative")
+
     click.echo("reimporting datasets ...", err=True)
-    package_ids = []
-    if datasetid:
-        click.echo("reimporting a single dataset ...", err=True)
-        package_ids = [ datasetid ]
-    else:
-        sources = []
-        if source:
-            click.echo(f"reimporting all dataset from a single source: {source} ...", err=True)
-            sources = [ source ]
-        else:
-            click.echo("reimporting all dataset from all sources ...", err=True)
-            sources = [ source.get('id') for source in _list_sources() ]
-        for source in sources:
-            package_ids += [package['name'] for package in _list_packages(source, offset, limit)]
+    package_ids = _select_package_ids(source, datasetid, offset, limit, "reimporting")
+    if resume:
+        reimported = _read_checkpoint(checkpoint)
+        infos = helpers.harvest_info_for_packages(package_ids)
+        selected = len(package_ids)
+        package_ids = [package_id for package_id in package_ids
+                       if package_id not in infos or infos[package_id].package_id not in reimported]
+        click.echo(f"skipping {selected - len(package_ids)} datasets that were already reimported ...", err=True)
 
     start = time.time()
-    site_user = logic.get_action(u'get_site_user')({
-        u'model': model,
-        u'ignore_auth': True},
-        {}
-    )
-    context = {
-        u'model': model,
-        u'session': model.Session,
-        u'ignore_auth': True,
-        u'user': site_user['name'],
-    }
     flask_app = ctx.meta['flask_app']
-    with flask_app.test_request_context():
-        output = _reimport_dataset(package_ids, context)
+    batches = [package_ids[index:index + batch_size] for index in range(0, len(package_ids), batch_size)]
+    output = {
+        'errors': [],
+        'datasets': {}
+    }
+    done = 0
+    checkpoint_file = open(checkpoint, 'a' if resume else 'w') if checkpoint else None
+    try:
+        for batch, result, checkpoint_lines in _reimport_batches(batches, flask_app, workers, rate):
+            output['errors'] += result['errors']
+            output['datasets'].update(result['datasets'])
+            if checkpoint_file:
+                checkpoint_file.write(checkpoint_lines)
+                checkpoint_file.flush()
+            done += len(batch)
+            _echo_progress(done, len(package_ids), len(output['errors']), start)
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
+        click.echo("", err=True)
 
     click.echo(json.dumps(output, indent=JSON_INDENT))
+    _echo_timing_summary(output['datasets'])
     end = time.time()
     click.echo(f"This took {end - start} seconds", err=True)
 
+@fisbroker.command()
+@click.option("-s", "--source", help="The source id of the harvester")
+@click.option("-d", "--datasetid", help="The id of the dataset")
+@click.option("-o", "--offset", default=0, help="Index of the first dataset to reprocess")
+@click.option("-l", "--limit", default=-1, help="Max number of datasets to reprocess")
+@click.option("-w", "--workers", type=int, help="Number of worker processes. Default is one per CPU.")
+def reprocess_dataset(source: str, datasetid: str, offset: int, limit: int, workers: int):
+    '''
+    Reprocess the specified datasets from the CSW records stored with their
+    current harvest objects, without fetching anything from FIS-Broker. Use
+    this to apply changes of the mapping to already harvested datasets.
+    The datasets are selected like in `reimport-dataset`, the records are
+    transformed in parallel worker processes.
+    '''
+    click.echo("reprocessing datasets ...", err=True)
+    package_ids = _select_package_ids(source, datasetid, offset, limit, "reprocessing")
+
+    start = time.time()
+    reprocessed_packages, errors = blueprint.reprocess_batch(package_ids, _site_user_context(), workers)
+    output = {
+        'errors': [str(error) for error in errors.values()],
+        'datasets': {
+            package_id: {'fisbroker_guid': guid} for package_id, guid in reprocessed_packages.items()
+        }
+    }
+
+    click.echo(json.dumps(output, indent=JSON_INDENT))
+    end = time.time()
+    click.echo(f"This took {end - start} seconds", err=True)
+
+@fisbroker.command()
+@click.option("-b", "--batch-size", default=100, help="Number of datasets to reprocess per harvest job")
+@click.option("-l", "--limit", default=-1, help="Max number of datasets to reprocess")
+@click.option("-w", "--workers", type=int, help="Number of worker processes. Default is one per CPU.")
+def reprocess_outdated(batch_size: int, limit: int, workers: int):
+    '''
+    Reprocess all FIS-Broker datasets that were not mapped by the current
+    mapping version (see `fisbroker_mapping_version` extra), from the CSW records
+    stored with their current harvest objects. Datasets without a mapping version
+    come first, then those with the oldest versions. The datasets are reprocessed
+    in batches of {batch-size}, the records of each batch in parallel worker processes.
+    '''
+    click.echo(f"finding datasets not mapped by {MAPPING_VERSION} ...", err=True)
+    package_ids = helpers.outdated_packages()
+    if limit >= 0:
+        package_ids = package_ids[:limit]
+    click.echo(f"reprocessing {len(package_ids)} datasets ...", err=True)
+
+    start = time.time()
+    context = _site_user_context()
+    output = {
+        'errors': [],
+        'datasets': {}
+    }
+    for batch_start in range(0, len(package_ids), batch_size):
+        batch = package_ids[batch_start:batch_start + batch_size]
+        reprocessed_packages, errors = blueprint.reprocess_batch(batch, context, workers)
+        output['errors'] += [str(error) for error in errors.values()]
+        for package_id, guid in reprocessed_packages.items():
+            output['datasets'][package_id] = {'fisbroker_guid': guid}
+        click.echo(f"reprocessed {batch_start + len(batch)} of {len(package_ids)} datasets ...", err=True)
+
+    click.echo(json.dumps(output, indent=JSON_INDENT))
+    end = time.time()
+    click.echo(f"This took {end - start} seconds", err=True)
+
+@fisbroker.command()
+def backfill_extras():
+    '''
+    Add the extras `fisbroker_guid` and `harvester_type` to all datasets
+    harvested by a FIS-Broker harvester that don't have them yet, from their
+    current harvest objects and without mapping them again, and reindex them.
+    '''
+    click.echo("adding FIS-Broker extras to datasets ...", err=True)
+    changed = helpers.backfill_fisbroker_extras()
+    click.echo(json.dumps({'datasets': changed}, indent=JSON_INDENT))
+
 @fisbroker.command()
 def check_harvest_status():
     """
@@ -430,14 +871,127 @@ PACKAGE_BASE = 'package_base'
 PACKAGE = 'package'
 RECORD_FORMATS = [ XML, ISO, PACKAGE_BASE, PACKAGE ]
 DEFAULT_RECORD_FORMAT = PACKAGE
+# the key of the output in the JSON Lines of get-record, by format
+RECORD_OUTPUT_KEYS = {
+    XML: 'xml',
+    ISO: 'iso_values',
+    PACKAGE_BASE: 'package',
+    PACKAGE: 'package',
+}
+
+def _fetch_records(csw, record_ids: list, batch_size: int, workers: int):
+    '''Yield (record id, record) for all {record_ids} in their order, where
+    record is None if there is no record with that id. The records are fetched
+    with one GetRecordById request per {batch_size} ids by {workers} concurrent
+    threads, which use clones of the CswService {csw}.
+    '''
+    batches = iter([record_ids[start:start + batch_size] for start in range(0, len(record_ids), batch_size)])
+    clients = threading.local()
+
+    def fetch(batch):
+        if not hasattr(clients, 'csw'):
+            clients.csw = csw.clone()
+        return clients.csw.getrecordsbyid(batch)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch:
+                pending.append((batch, executor.submit(fetch, batch)))
+
+        for _ in range(blueprint.REIMPORT_BATCHES_IN_FLIGHT * workers):
+            submit_next()
+        try:
+            while pending:
+                batch, future = pending.popleft()
+                records = future.result()
+                submit_next()
+                for record_id in batch:
+                    yield record_id, records.get(record_id)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+@contextlib.contextmanager
+def _record_mapper(format: str):
+    '''Provide a function that maps a CSW record to the output for {format}.
+    The harvesters, the dataset schema and the mocks for CKAN's harvesting
+    infrastructure are set up once for all records.
+    '''
+    # get_package_dict() is coupled to CKAN's harvesting infrastructure
+    from unittest.mock import Mock, patch
+
+    harvest_object = Mock()
+    harvest_object.source.id = "source-id"
+    csw_harvester = CSWHarvester()
+    harvester = FisbrokerHarvester()
+    context = {
+        "model": model,
+        "session": model.Session,
+        "user": "test-user",
+    }
+    schema = None
+    if format == PACKAGE:
+        schema_plugin = plugins.get_plugin(config['ckanext.geoharvester.datasetschema'])
+        click.echo(schema_plugin, err=True)
+        schema = schema_plugin.show_package_schema()
+
+    def map_record(record):
+        xml_tree = etree.ElementTree(etree.fromstring(record.xml))
+        if format == XML:
+            return '<?xml version="1.0" encoding="UTF-8"?>\n' + \
+                etree.tostring(xml_tree, pretty_print=True, encoding=str)
+        iso_document = ISODocument(xml_tree=xml_tree)
+        iso_values = iso_document.read_values()
+        if format == ISO:
+            return iso_values
+        # the mapping puts the harvest object's guid into the package extras
+        harvest_object.guid = iso_values['guid']
+        package_dict = csw_harvester.get_package_dict(iso_values, harvest_object)
+        if format == PACKAGE_BASE:
+            return package_dict
+        package_dict = harvester.get_package_dict(None, {
+            'package_dict': package_dict,
+            'iso_values': iso_values,
+            'harvest_object': harvest_object,
+            'xml_tree': iso_document.xml_tree
+        })
+        result, errors = validate(package_dict, schema, context.copy())
+        return clean_missing(result)
+
+    with patch("ckan.model.Package.get") as mock_get, \
+            patch.object(csw_harvester, "_save_object_error", lambda *a, **k: None):
+        mock_dataset = Mock()
+        mock_dataset.owner_org = "test-org-id"
+        mock_get.return_value = mock_dataset
+        yield map_record
+
 @fisbroker.command()
 @click.option("-s",  "--source", help="The source id of the harvester. Default is the first one we find.")
-@click.option("-r",  "--record", help="The id of the record to get", required=True)
+@click.option("-r",  "--record", multiple=True, help="The id of a record to get (can be repeated)")
+@click.option("-i",  "--records-file", type=click.Path(dir_okay=False, allow_dash=True),
+              help="File with the ids of records to get, one per line, or `-` for STDIN")
 @click.option("-f",  "--format", help=f"output format, one of [{'|'.join(RECORD_FORMATS)}]", default=PACKAGE)
-def get_record(source: str, record: str, format: str):
+@click.option("-w", "--workers", default=blueprint.REIMPORT_FETCH_WORKERS_DEFAULT, help="Number of concurrent requests to FIS-Broker")
+@click.option("-b", "--batch-size", default=blueprint.REIMPORT_BATCH_SIZE_DEFAULT, help="Number of records per GetRecordById request")
+def get_record(source: str, record: tuple, records_file: str, format: str, workers: int, batch_size: int):
     """
-        Get the document for `record` from `source`.
+        Get the documents for the records `record` (and those in `records-file`)
+        from `source`. A single record is written as it is. Several records are
+        written while they arrive, as JSON Lines (one object per record, with the
+        record's `guid`, a `status` and the output in the requested format).
     """
+    record_ids = list(record)
+    if records_file:
+        with click.open_file(records_file) as ids_file:
+            record_ids += [line.strip() for line in ids_file if line.strip()]
+    if not record_ids:
+        raise click.UsageError("Use --record or --records-file to specify the records to get")
+    if format not in RECORD_FORMATS:
+        raise click.UsageError(f"Unknown format '{format}', use one of [{'|'.join(RECORD_FORMATS)}]")
+
     sources = _list_sources()
     if source:
         source_lookup = { source['id']: source for source in sources }
@@ -445,53 +999,246 @@ def get_record(source: str, record: str, format: str):
     else:
         source_obj = sources[0]
     endpoint = source_obj['url']
-    click.echo(f"getting {record} from {endpoint}", err=True)
+    click.echo(f"getting {len(record_ids)} records from {endpoint}", err=True)
     csw = CswService(endpoint=endpoint)
-    document = csw.getrecordbyid([record])
-    iso_document = ISODocument(xml_tree=document['tree'])
-    iso_values = iso_document.read_values()
-    if format == XML:
-        click.echo(document['xml'])
-    elif format == ISO:
-        click.echo(json.dumps(iso_values, indent=JSON_INDENT))
-    else:
-        # get_package_dict() is coupled to CKAN's harvesting infrastructure
-        from unittest.mock import Mock, patch
-
-        harvest_object = Mock()
-        harvest_object.source.id = "source-id"
-
-        harvester = CSWHarvester()
-        with patch("ckan.model.Package.get") as mock_get:
-            mock_dataset = Mock()
-            mock_dataset.owner_org = "test-org-id"
-            mock_get.return_value = mock_dataset
-
-            # optionally patch error logging too
-            with patch.object(harvester, "_save_object_error", lambda *a, **k: None):
-                package_dict = harvester.get_package_dict(iso_values, harvest_object)
-                if format == PACKAGE_BASE:
-                    click.echo(json.dumps(package_dict, indent=JSON_INDENT))
-                else:
-                    harvester = FisbrokerHarvester()
-                    package_dict = harvester.get_package_dict(None, {
-                        'package_dict': package_dict,
-                        'iso_values': iso_values,
-                        'harvest_object': harvest_object,
-                        'xml_tree': iso_document.xml_tree
-                    })
-                    context = {
-                        "model": model,
-                        "session": model.Session,
-                        "user": "test-user",
-                    }
-                    schema_plugin = plugins.get_plugin(config['ckanext.geoharvester.datasetschema'])
-                    click.echo(schema_plugin, err=True)
-                    schema = schema_plugin.show_package_schema()
-                    result, errors = validate(package_dict, schema, context)
-                    cleaned = clean_missing(result)
-                    # click.echo(cleaned)
-                    click.echo(json.dumps(cleaned, indent=JSON_INDENT))
+    single = len(record_ids) == 1
+
+    with _record_mapper(format) as map_record:
+        for record_id, csw_record in _fetch_records(csw, record_ids, batch_size, workers):
+            if single:
+                if csw_record is None:
+                    raise click.ClickException(f"Record {record_id} was not found")
+                output = map_record(csw_record)
+                click.echo(output if format == XML else json.dumps(output, indent=JSON_INDENT))
+                continue
+            output = {'guid': record_id}
+            if csw_record is None:
+                output['status'] = 'not_found'
+            else:
+                try:
+                    output[RECORD_OUTPUT_KEYS[format]] = map_record(csw_record)
+                    output['status'] = 'ok'
+                except Exception as e:
+                    output['status'] = 'error'
+                    output['error'] = str(e)
+            click.echo(json.dumps(output, default=str))
+
+@fisbroker.command(name="transform")
+@click.argument("path")
+@click.option("-w", "--workers", type=int, help="Number of worker processes. Default is one per CPU.")
+@click.option("-f", "--format", type=click.Choice([ISO, PACKAGE]), default=PACKAGE,
+              help=f"output format, one of [{ISO}|{PACKAGE}]")
+@click.option("--owner-org", help="The owner organization to put into the package dicts.")
+def transform_records(path: str, workers: int, format: str, owner_org: str):
+    """
+        Map the CSW records in PATH to package dicts, without fetching anything
+        from FIS-Broker or writing anything to the database. PATH is a directory
+        of XML files, a (compressed) tar archive of XML files, a single XML file
+        or `-` for STDIN. Every XML file can contain one ISO document or wrap several
+        (like a CSW response). The records are mapped in parallel worker processes,
+        the result is written as JSON Lines (one object per document) to STDOUT.
+    """
+    start = time.time()
+    names = []
+    failures = []
+    counts = {'ok': 0, 'skipped': 0, 'error': 0}
+    payloads = _transform_payloads(_read_records(path), owner_org, names, failures)
+    for position, result in enumerate(transform.transform_many(payloads, workers)):
+        while failures:
+            output = failures.pop(0)
+            counts[output['status']] += 1
+            click.echo(json.dumps(output))
+        output = _transform_output(names[position], result, format)
+        counts[output['status']] += 1
+        click.echo(json.dumps(output, default=str))
+    for output in failures:
+        counts[output['status']] += 1
+        click.echo(json.dumps(output))
+    end = time.time()
+    click.echo(f"transformed {sum(counts.values())} records ({counts['ok']} ok, "
+               f"{counts['skipped']} skipped, {counts['error']} errors) "
+               f"in {end - start} seconds", err=True)
+
+BENCHMARK_STAGES = ['gather', 'fetch', 'import']
+
+def _load_mock_fis_broker():
+    '''Load the mock FIS-Broker module from the tests without importing the
+    tests package (which starts the servers for the tests).
+    '''
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'mock_fis_broker.py')
+    if not os.path.exists(path):
+        raise click.ClickException("The benchmark needs the tests of ckanext-fisbroker (install it from a source checkout)")
+    spec = importlib.util.spec_from_file_location('ckanext.fisbroker.benchmark_mock', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def _peak_rss_kb() -> int:
+    '''Return the peak RSS of this process so far (in KB on Linux).'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class _StageTimer:
+    '''Collect the durations of the calls in a benchmark stage, the number
+    of database queries they make and how much they raise the peak RSS of the
+    process.
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.durations = []
+        self.queries = 0
+        self.failures = 0
+        # the number of records handled, if it isn't one per call
+        self.records = None
+        # the peak RSS of the process before the first and after the last call
+        self.rss_start = None
+        self.rss_end = None
+
+    def _count_query(self, *args, **kwargs):
+        self.queries += 1
+
+    @contextlib.contextmanager
+    def measure(self):
+        '''Measure the duration and the database queries of the enclosed call.'''
+        if self.rss_start is None:
+            self.rss_start = _peak_rss_kb()
+        event.listen(model.meta.engine, 'before_cursor_execute', self._count_query)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations.append(time.perf_counter() - start)
+            event.remove(model.meta.engine, 'before_cursor_execute', self._count_query)
+            self.rss_end = _peak_rss_kb()
+
+    def result(self) -> dict:
+        '''Return the statistics of the stage.'''
+        durations = sorted(self.durations)
+        seconds = sum(durations)
+        records = len(durations) if self.records is None else self.records
+        return {
+            'records': records,
+            'failures': self.failures,
+            'seconds': round(seconds, 3),
+            'records_per_second': round(records / seconds, 2) if seconds else None,
+            'latency_p50': round(_percentile(durations, 0.5), 4) if durations else None,
+            'latency_p95': round(_percentile(durations, 0.95), 4) if durations else None,
+            'queries': self.queries,
+            'peak_rss_growth_kb': self.rss_end - self.rss_start if durations else None,
+        }
+
+def _run_benchmark(harvest_job: HarvestJob, stages: list) -> dict:
+    '''Run the gather, fetch and import stages for {harvest_job} and return the
+    statistics of the stages in {stages}. The other stages are run as well if
+    the measured stages depend on them, but are not measured.
+    '''
+    harvester = FisbrokerHarvester()
+    timers = {stage: _StageTimer(stage) for stage in BENCHMARK_STAGES}
+    last_stage = max(BENCHMARK_STAGES.index(stage) for stage in stages)
+
+    def measure(stage):
+        if stage in stages:
+            return timers[stage].measure()
+        return contextlib.nullcontext()
+
+    with measure('gather'):
+        object_ids = harvester.gather_stage(harvest_job) or []
+    timers['gather'].records = len(object_ids)
+    if last_stage >= BENCHMARK_STAGES.index('fetch'):
+        harvest_objects = [HarvestObject.get(object_id) for object_id in object_ids]
+        fetched = []
+        for harvest_object in harvest_objects:
+            with measure('fetch'):
+                success = harvester.fetch_stage(harvest_object)
+            if success:
+                fetched.append(harvest_object)
+            else:
+                timers['fetch'].failures += 1
+        if last_stage >= BENCHMARK_STAGES.index('import'):
+            for harvest_object in fetched:
+                with measure('import'):
+                    success = harvester.import_stage(harvest_object)
+                if not success:
+                    timers['import'].failures += 1
+
+    return {stage: timers[stage].result() for stage in stages}
+
+@fisbroker.command()
+@click.option("-n", "--records", default=100, help="Number of synthetic records served by the mock FIS-Broker")
+@click.option("--stage", type=click.Choice(['all'] + BENCHMARK_STAGES), default='all',
+              help="Measure all stages end to end (default) or a single stage")
+@click.option("-p", "--port", default=8998, help="Port of the mock FIS-Broker")
+@click.option("--owner-org", help="The owner organization of the benchmark harvest source")
+@click.option("--keep", is_flag=True, help="Keep the benchmark harvest source and its datasets")
+@click.option("-y", "--yes", is_flag=True, help="Don't ask before writing to the configured database and search index")
+@click.pass_context
+def benchmark(ctx: click.Context, records: int, stage: str, port: int, owner_org: str, keep: bool, yes: bool):
+    '''
+    Benchmark the harvester against the mock FIS-Broker from the tests, which
+    serves {records} synthetic records. A temporary harvest source and job are
+    created, the stages are run in this process and the results are written as
+    JSON to STDOUT: records per second, p50 and p95 latency of the calls,
+    database queries and the growth of the peak RSS for each stage, and the
+    peak RSS of the process.
+
+    WARNING: the datasets are written to the database and search index of the
+    CKAN config that is used, so run the benchmark with a dedicated config,
+    not against a production site. The command asks for confirmation unless
+    --yes is used. The datasets are removed with the harvest source afterwards,
+    unless --keep is used.
+    '''
+    if not yes:
+        click.confirm(
+            f"The benchmark writes {records} datasets to the database "
+            f"{make_url(config.get('sqlalchemy.url'))!r} and the search index "
+            f"{config.get('solr_url')}. Continue?",
+            abort=True,
+            err=True,
+        )
+    mock = _load_mock_fis_broker()
+    mock.add_synthetic_records(records, prefix="benchmark")
+    stages = BENCHMARK_STAGES if stage == 'all' else [stage]
+    context = _site_user_context()
+    source_dict = {
+        'title': f"FIS-Broker Benchmark {int(time.time())}",
+        'name': f"fisbroker-benchmark-{int(time.time())}",
+        'source_type': HARVESTER_ID,
+        'url': f"http://127.0.0.1:{port}/csw",
+    }
+    if owner_org:
+        source_dict['owner_org'] = owner_org
+    source = None
+    mock_server = mock.start_mock_server(port)
+    try:
+        source = logic.get_action('harvest_source_create')(context.copy(), source_dict)
+        job_dict = logic.get_action('harvest_job_create')(context.copy(), {'source_id': source['id']})
+        harvest_job = HarvestJob.get(job_dict['id'])
+        click.echo(f"benchmarking {', '.join(stages)} with {records} records ...", err=True)
+
+        start = time.perf_counter()
+        with ctx.meta['flask_app'].test_request_context():
+            results = _run_benchmark(harvest_job, stages)
+        end = time.perf_counter()
+        harvest_job.status = 'Finished'
+        harvest_job.finished = datetime.datetime.utcnow()
+        harvest_job.save()
+
+        output = {
+            'records': records,
+            'stages': results,
+            'seconds': round(end - start, 3),
+            'process_peak_rss_kb': _peak_rss_kb(),
+        }
+        click.echo(json.dumps(output, indent=JSON_INDENT))
+    finally:
+        try:
+            if source and not keep:
+                click.echo(f"removing harvest source {source['name']} and its datasets ...", err=True)
+                logic.get_action('harvest_source_clear')(context.copy(), {'id': source['id']})
+                logic.get_action('harvest_source_delete')(context.copy(), {'id': source['id']})
+        finally:
+            mock_server.shutdown()
+            mock_server.server_close()
 
 def clean_missing(data):
     if isinstance(data, dict):
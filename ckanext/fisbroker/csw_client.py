@@ -159,6 +159,22 @@ class CswService(csw_client.CswService):
         record["tree"] = mdtree
         return record
 
+    def getrecordsbyid(self, ids, **kw):
+        '''Get all records in `ids` with a single GetRecordById request (with
+           retries, like getrecordbyid()). Return a dict mapping the identifiers
+           of the records that were found to the record objects.'''
+        self.getrecordbyid(ids, **kw)
+        return dict(self.records())
+
+    def clone(self):
+        '''Return a new CswService for the same endpoint that shares no state
+           with this one, so that it can be used in another thread. The
+           capabilities of the service are not requested again.'''
+        ows = self._ows()
+        service = CswService()
+        service.__ows_obj__ = self._Implementation(ows.url, timeout=ows.timeout, skip_caps=True)
+        return service
+
     def records(self):
         '''Provide access the records attribute of the wrapped CatalogueServiceWeb object.'''
         return self._ows().records
\ No newline at end of file
@@ -16,6 +16,9 @@ ERROR_NO_CONNECTION = 8
 ERROR_NO_CONNECTION_PACKAGE = 9
 ERROR_NOT_FOUND_IN_FISBROKER = 10
 ERROR_DURING_IMPORT = 11
+ERROR_JOB_NOT_FOUND = 12
+ERROR_REIMPORT_BUSY = 13
+ERROR_NOT_A_FISBROKER_SOURCE = 14
 ERROR_UNEXPECTED = 20
 
 ERROR_MESSAGES = {
@@ -30,6 +33,9 @@ ERROR_MESSAGES = {
     ERROR_NO_CONNECTION_PACKAGE: "Failed to establish connection to FIS-Broker service at {} ({}) while reimporting package '{}'.",
     ERROR_NOT_FOUND_IN_FISBROKER: "Package could not be re-imported because GUID '{}' was not found on FIS-Broker.",
     ERROR_DURING_IMPORT: "Package could not be re-imported because the FIS-Broker data is no longer valid. Reason: {}. Package will be deactivated.",
+    ERROR_JOB_NOT_FOUND: "Reimport job '{}' does not exist.",
+    ERROR_REIMPORT_BUSY: "Too many reimports are running at the moment, please try again later.",
+    ERROR_NOT_A_FISBROKER_SOURCE: f"Harvest source '{{}}' does not exist or is not a '{HARVESTER_ID}' harvest source.",
     ERROR_UNEXPECTED: "Unexpected error"
 }
 
@@ -128,3 +134,24 @@ class FBImportError(ReimportError):
         )
 
         self.reason = reason
+
+class ReimportBusyError(ReimportError):
+    '''Exception raised when a reimport cannot start because the maximum number
+       of concurrent reimports is reached.'''
+
+    def __init__(self, package_id):
+        super(ReimportBusyError, self).__init__(
+            package_id,
+            ERROR_REIMPORT_BUSY,
+            ERROR_MESSAGES[ERROR_REIMPORT_BUSY]
+        )
+
+class InvalidPackageIdsError(Exception):
+    '''Exception for a batch reimport that contains several package ids which
+       cannot be reimported. `errors` is the list of ReimportErrors for them.'''
+
+    def __init__(self, errors):
+        super(InvalidPackageIdsError, self).__init__(
+            f"{len(errors)} packages cannot be reimported: " +
+            " ".join(f"{error.package_id}: {error}" for error in errors))
+        self.errors = errors
@@ -13,10 +13,10 @@ import six
 from time import sleep
 import uuid
 import hashlib
-import dateutil
+import itertools
 
 from owslib.fes import PropertyIsGreaterThanOrEqualTo
-from sqlalchemy import exists
+from sqlalchemy import exists, func, or_
 
 from ckan import logic, model
 from ckan.lib.munge import munge_title_to_name
@@ -37,13 +37,21 @@ from ckanext.harvest.model import (
 
 from ckanext.spatial.interfaces import ISpatialHarvester
 from ckanext.spatial.harvesters.base import text_traceback
-from ckanext.spatial.harvested_metadata import ISODocument
 from ckanext.spatial.harvesters.csw import CSWHarvester
 from ckanext.spatial.validation.validation import BaseValidator
 
-from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker import (
+    HARVESTER_ID,
+    GUID_EXTRA,
+    HARVESTER_TYPE_EXTRA,
+    MAPPING_VERSION,
+    MAPPING_VERSION_EXTRA,
+)
 from ckanext.fisbroker.csw_client import CswService
 from ckanext.fisbroker.fisbroker_resource_annotator import FISBrokerResourceAnnotator
+from ckanext.fisbroker.import_index import ImportIndex
+import ckanext.fisbroker.model as fbmodel
+import ckanext.fisbroker.transform as transform
 from ckanext.fisbroker.hvd_extractor import extract_hvd_categories, HVD_PREFIX
 import ckanext.fisbroker.helper as helpers
 
@@ -51,6 +59,10 @@ import ckanext.fisbroker.helper as helpers
 LOG = logging.getLogger(__name__)
 TIMEDELTA_DEFAULT = 0
 TIMEOUT_DEFAULT = 20
+# number of transformed objects whose package names are looked up at a time
+IMPORT_BATCH_SIZE = 100
+# harvest source id -> (fingerprint of the source's finished jobs, id of the last error-free job)
+LAST_ERROR_FREE_JOBS = {}
 
 # Mapping from various versions of DL ids in incoming data to our
 # internal ones.
@@ -293,7 +305,7 @@ class FisbrokerHarvester(CSWHarvester):
     plugins.implements(IHarvester, inherit=True)
     plugins.implements(ISpatialHarvester, inherit=True)
 
-    import_since_keywords = ["last_error_free", "big_bang"]
+    import_since_keywords = ["last_error_free", "watermark", "big_bang"]
 
     def extras_dict(self, extras_list):
         '''Convert input `extras_list` to a conventional extras dict.'''
@@ -305,27 +317,92 @@ class FisbrokerHarvester(CSWHarvester):
     def get_import_since_date(self, harvest_job):
         '''Get the `import_since` config as a string (property of
            the query constraint). Handle special values such as
-           `last_error_free` and `big bang`.'''
+           `last_error_free`, `watermark` and `big bang`.'''
 
         self.force_import = False
         if 'import_since' not in self.source_config:
             return None
         import_since = self.source_config['import_since']
         if import_since == 'last_error_free':
-            last_error_free_job = self.last_error_free_job(harvest_job)
-            LOG.info('Last error-free job: %r', last_error_free_job)
-            if last_error_free_job:
-                gather_time = (last_error_free_job.gather_started +
-                               timedelta(hours=self.get_timedelta()))
-                return gather_time.strftime("%Y-%m-%dT%H:%M:%S%z")
-            else:
-                return None
+            return self._last_error_free_date(harvest_job)
+        elif import_since == 'watermark':
+            watermark = self.advance_watermark(harvest_job)
+            LOG.info('Harvest watermark: %r', watermark)
+            if watermark:
+                return watermark.strftime("%Y-%m-%dT%H:%M:%S")
+            # no job has been settled yet
+            return self._last_error_free_date(harvest_job)
         elif import_since == 'big_bang':
             # looking since big bang means no date constraint
             self.force_import = True
             return None
         return import_since
 
+    def _last_error_free_date(self, harvest_job):
+        '''Return the gather time of the last error-free job before `harvest_job`
+           (in the timezone of the harvest source) as a string, or None.'''
+        last_error_free_job = self.last_error_free_job(harvest_job)
+        LOG.info('Last error-free job: %r', last_error_free_job)
+        if last_error_free_job:
+            gather_time = (last_error_free_job.gather_started +
+                           timedelta(hours=self.get_timedelta()))
+            return gather_time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        return None
+
+    @classmethod
+    def advance_watermark(cls, harvest_job):
+        '''Advance the harvest watermark of the source of `harvest_job` over the
+           results of the previous job of the source, start recording the results
+           of `harvest_job` and return the watermark. The results of a job are
+           recorded while its records are fetched and imported (see
+           `record_watermark_result()`): the watermark is the latest metadata
+           modified date of the records that were imported successfully, but
+           stays below the earliest record that failed, so that the next job
+           fetches the failed records again.
+           Return None if the source has no watermark yet.'''
+
+        source_id = harvest_job.source.id
+        current = fbmodel.harvest_watermark(source_id)
+        if current and current.harvest_job_id == harvest_job.id:
+            return current.modified
+
+        watermark = current.modified if current else None
+        if current and current.job_modified and not current.job_failed:
+            status, gather_failed = model.Session.query(
+                HarvestJob.status,
+                exists().where(HarvestGatherError.harvest_job_id == HarvestJob.id)) \
+                .filter(HarvestJob.id == current.harvest_job_id) \
+                .one()
+            # with gather errors, there might be records that weren't gathered at all
+            if status == 'Finished' and not gather_failed and \
+                    (watermark is None or current.job_modified > watermark):
+                watermark = current.job_modified
+
+        fbmodel.set_harvest_watermark(source_id, watermark, harvest_job.id)
+        model.Session.commit()
+
+        return watermark
+
+    @classmethod
+    def record_watermark_result(cls, harvest_object, success):
+        '''Record the result of fetching or importing `harvest_object` for the
+           watermark of its harvest source (see `advance_watermark()`). Don't
+           commit, the result is written with the next commit.'''
+        fbmodel.record_harvest_result(harvest_object.harvest_source_id,
+                                      harvest_object.harvest_job_id,
+                                      harvest_object.metadata_modified_date,
+                                      success)
+
+    def _record_watermark_failure(self, harvest_object):
+        '''Record that fetching or importing `harvest_object` failed, if its
+           harvest source is harvested from the watermark. Failures are rare,
+           so they are committed on their own.'''
+        self._set_source_config(harvest_object.source.config)
+        if self.source_config.get('import_since') != 'watermark':
+            return
+        self.record_watermark_result(harvest_object, False)
+        model.Session.commit()
+
     def get_constraints(self, harvest_job):
         '''Compute and get the query constraint for requesting datasets from
            FIS-Broker.'''
@@ -518,7 +595,13 @@ class FisbrokerHarvester(CSWHarvester):
 
         return ids
 
-    def fetch_stage(self,harvest_object, retries=3, wait_time=5.0):
+    def fetch_stage(self, harvest_object, retries=3, wait_time=5.0):
+        fetched = self._fetch(harvest_object, retries, wait_time)
+        if not fetched:
+            self._record_watermark_failure(harvest_object)
+        return fetched
+
+    def _fetch(self, harvest_object, retries, wait_time):
 
         # Check harvest object status
         status = self._get_object_extra(harvest_object, 'status')
@@ -579,6 +662,54 @@ class FisbrokerHarvester(CSWHarvester):
         return True
 
     def import_stage(self, harvest_object):
+        try:
+            imported = self._import(harvest_object)
+        except Exception:
+            # don't commit what the failed import left in the session
+            model.Session.rollback()
+            self._record_watermark_failure(harvest_object)
+            raise
+        if not imported:
+            self._record_watermark_failure(harvest_object)
+        return imported
+
+    def import_transformed(self, harvest_object, transformed, index=None):
+        '''Import `harvest_object`, using the result `transformed` of
+           `transform.transform_detached()` instead of parsing and mapping the
+           content again. If `transformed` is None, the content is transformed
+           in this process. `index` is the `ImportIndex` of the object's job; if
+           it is None, the index of the job is loaded for the current thread.'''
+        return self._import(harvest_object, transformed, index)
+
+    def import_objects(self, harvest_objects, workers=None):
+        '''Import all `harvest_objects`. Their content is transformed in a pool
+           of `workers` worker processes, the results are written to the database
+           in this process. Return a dict mapping the ids of the harvest objects
+           to the results of their import.'''
+        results = {}
+        indexes = {}
+        transformed_objects = transform.transform_objects(harvest_objects, workers)
+        while True:
+            batch = list(itertools.islice(transformed_objects, IMPORT_BATCH_SIZE))
+            if not batch:
+                break
+            # load the packages with the names of the batch in one query
+            names = {}
+            for harvest_object, transformed in batch:
+                job_id = harvest_object.harvest_job_id
+                if job_id not in indexes:
+                    indexes[job_id] = ImportIndex.load(job_id)
+                package_dict = transformed and transformed['package_dict']
+                if isinstance(package_dict, dict):
+                    names.setdefault(job_id, []).append(package_dict.get('name'))
+            for job_id, job_names in names.items():
+                indexes[job_id].load_names(job_names)
+            for harvest_object, transformed in batch:
+                job_id = harvest_object.harvest_job_id
+                results[harvest_object.id] = self.import_transformed(harvest_object, transformed, indexes[job_id])
+        return results
+
+    def _import(self, harvest_object, transformed=None, index=None):
         context = {
             'model': model,
             'session': model.Session,
@@ -593,6 +724,8 @@ class FisbrokerHarvester(CSWHarvester):
             return False
 
         self._set_source_config(harvest_object.source.config)
+        if index is None:
+            index = ImportIndex.for_job(harvest_object.harvest_job_id)
 
         if self.force_import:
             status = 'change'
@@ -600,18 +733,30 @@ class FisbrokerHarvester(CSWHarvester):
             status = self._get_object_extra(harvest_object, 'status')
 
         # Get the last harvested object (if any)
-        previous_object = model.Session.query(HarvestObject) \
-                          .filter(HarvestObject.guid==harvest_object.guid) \
-                          .filter(HarvestObject.current==True) \
-                          .first()
+        previous_object = index.previous_object(harvest_object.guid)
 
         if status == 'delete':
-            # Delete package
-            context.update({
-                'ignore_auth': True,
-            })
-            toolkit.get_action('package_delete')(context, {'id': harvest_object.package_id})
-            LOG.info(f"Deleted package {harvest_object.package_id} with guid {harvest_object.guid}")
+            # Delete package. All packages that are deleted by this job are deleted
+            # in bulk when the first delete object of the job is imported, the
+            # remaining delete objects only have to confirm this.
+            package = index.package_by_id(harvest_object.package_id)
+            if package and package.state == model.State.DELETED:
+                LOG.info(f"Package {harvest_object.package_id} with guid {harvest_object.guid} is already deleted")
+                return True
+
+            package_ids = index.take_pending_deletions()
+            if harvest_object.package_id:
+                package_ids.add(harvest_object.package_id)
+            deleted_ids = helpers.delete_packages(package_ids, context)
+            for package_id in package_ids:
+                package = index.package_by_id(package_id)
+                if package:
+                    index.package_saved(package.id, package.name, model.State.DELETED)
+            model.Session.commit()
+            # only remove what was actually deleted from the search index
+            helpers.unindex_packages(deleted_ids)
+            LOG.info(f"Deleted package {harvest_object.package_id} with guid {harvest_object.guid} "
+                     f"({len(deleted_ids)} packages deleted in bulk)")
 
             return True
 
@@ -631,6 +776,7 @@ class FisbrokerHarvester(CSWHarvester):
 
             if content:
                 harvest_object.content = content
+                transformed = None
             else:
                 self._save_object_error("Transformation to ISO failed", harvest_object, 'Import')
                 return False
@@ -639,8 +785,14 @@ class FisbrokerHarvester(CSWHarvester):
                 self._save_object_error(f"Empty content for object {harvest_object.id}", harvest_object, 'Import')
                 return False
 
-            # Validate ISO document
-            is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object)
+            # Validate ISO document (documents transformed in a worker process
+            # were validated there)
+            if transformed is None:
+                is_valid, profile, errors = self._validate_document(harvest_object.content, harvest_object)
+            else:
+                is_valid = transformed['valid']
+                for message, stage in transformed['validation_errors']:
+                    self._save_object_error(message, harvest_object, stage)
             if not is_valid:
                 # If validation errors were found, import will stop unless
                 # configuration per source or per instance says otherwise
@@ -650,29 +802,33 @@ class FisbrokerHarvester(CSWHarvester):
                     return False
 
         # Parse ISO document
-        try:
-            iso_parser = ISODocument(harvest_object.content)
-            iso_values = iso_parser.read_values()
-        except Exception as e:
-            self._save_object_error(f"Error parsing ISO document for object {harvest_object.id}: {six.text_type(e)}", harvest_object, 'Import')
+        if transformed is None:
+            try:
+                iso_values, xml_tree = transform.parse_document(harvest_object.content)
+            except Exception as e:
+                self._save_object_error(f"Error parsing ISO document for object {harvest_object.id}: {six.text_type(e)}", harvest_object, 'Import')
+                return False
+        elif transformed['error']:
+            self._save_object_error(transformed['error'], harvest_object, 'Import')
             return False
+        else:
+            iso_values = transformed['iso_values']
 
         # Flag previous object as not current anymore
         if previous_object and not self.force_import:
-            previous_object.current = False
-            previous_object.add()
+            model.Session.query(HarvestObject) \
+                .filter(HarvestObject.id==previous_object.id) \
+                .update({'current': False}, False)
+            index.object_replaced(harvest_object.guid)
 
         # Update GUID with the one on the document
         iso_guid = iso_values['guid']
         if iso_guid and harvest_object.guid != iso_guid:
             # First make sure there already aren't current objects
             # with the same guid
-            existing_object = model.Session.query(HarvestObject.id) \
-                            .filter(HarvestObject.guid==iso_guid) \
-                            .filter(HarvestObject.current==True) \
-                            .first()
-            if existing_object:
-                self._save_object_error(f"Object {existing_object.id} already has this guid {iso_guid}", harvest_object, 'Import')
+            existing_object_id = index.current_object_id(iso_guid)
+            if existing_object_id:
+                self._save_object_error(f"Object {existing_object_id} already has this guid {iso_guid}", harvest_object, 'Import')
                 return False
 
             harvest_object.guid = iso_guid
@@ -687,7 +843,7 @@ class FisbrokerHarvester(CSWHarvester):
 
         # Get document modified date
         try:
-            metadata_modified_date = dateutil.parser.parse(iso_values['metadata-date'], ignoretz=True)
+            metadata_modified_date = transform.metadata_modified_date(iso_values)
         except ValueError:
             self._save_object_error(f"Could not extract reference date for object {harvest_object.id} ({iso_values['metadata-date']})", harvest_object, 'Import')
             return False
@@ -697,14 +853,14 @@ class FisbrokerHarvester(CSWHarvester):
 
 
         # Build the package dict
-        package_dict = self.get_package_dict(iso_values, harvest_object)
-        for harvester in plugins.PluginImplementations(ISpatialHarvester):
-            package_dict = harvester.get_package_dict(context, {
-                'package_dict': package_dict,
-                'iso_values': iso_values,
-                'xml_tree': iso_parser.xml_tree,
-                'harvest_object': harvest_object,
-            })
+        if transformed is None:
+            package_dict = transform.map_document(self, context, iso_values, xml_tree, harvest_object)
+        else:
+            package_dict = transformed['package_dict']
+            for key, value in transformed['extras']:
+                harvest_object.extras.append(HarvestObjectExtra(key=key, value=value))
+            for message, stage in transformed['errors']:
+                self._save_object_error(message, harvest_object, stage)
         if not package_dict:
             LOG.error(f"No package dict returned, aborting import for object {harvest_object.id}")
             return False
@@ -730,9 +886,10 @@ class FisbrokerHarvester(CSWHarvester):
         # Flag this object as the current one
         harvest_object.current = True
         harvest_object.add()
+        index.object_imported(harvest_object)
 
         package_name = package_dict['name']
-        package = model.Package.get(package_name)
+        package = index.package_by_name(package_name)
 
         # there are cases where a harvested dataset with a name identical to 
         # that of a record in FIS-Broker, but there is no previous harvest object with
@@ -745,12 +902,12 @@ class FisbrokerHarvester(CSWHarvester):
         if status == 'new' and package:
             LOG.info(f"Resource with guid {harvest_object.guid} looks new, but there is a package with the same name: '{package_name}'. Changing that package instead of creating a new one.")
             status = 'change'
-            harvest_object.package_id = package.as_dict()['id']
+            harvest_object.package_id = package.id
             harvest_object.add()
 
         # if we cannot find the package by name, maybe we can find it by id
         if not package:
-            package = model.Package.get(harvest_object.package_id)
+            package = index.package_by_id(harvest_object.package_id)
 
         # It can also happen that gather_stage set `status = 'change'`, because there
         # already is a previous HarvestObject with a guid identical to the one
@@ -786,6 +943,7 @@ class FisbrokerHarvester(CSWHarvester):
             try:
                 package_id = toolkit.get_action('package_create')(context, package_dict)
                 LOG.info('Created new package %s with guid %s', package_id, harvest_object.guid)
+                index.package_saved(package_dict['id'], package_name)
             except toolkit.ValidationError as e:
                 self._save_object_error('Validation Error: %s' % six.text_type(e.error_summary), harvest_object, 'Import')
                 return False
@@ -796,7 +954,10 @@ class FisbrokerHarvester(CSWHarvester):
             # precedence)
             if package.state == "deleted":
                 LOG.info(f"The package named {package_dict['name']} was deleted, activating it again.")
-                package.state = "active"
+                model.Session.query(model.Package) \
+                    .filter(model.Package.id==package.id) \
+                    .update({'state': 'active'}, 'evaluate')
+                index.package_saved(package.id, package.name)
 
             # If the incoming date (harvest_object) is not younger (<=) than the date we already have,
             # we assume that the document is unchanged, and we're skipping it.
@@ -806,11 +967,12 @@ class FisbrokerHarvester(CSWHarvester):
                 harvest_object.metadata_modified_date <= previous_object.metadata_modified_date:
                 # Assign the previous job id to the new object to
                 # avoid losing history
-                harvest_object.harvest_job_id = previous_object.job.id
+                harvest_object.harvest_job_id = previous_object.harvest_job_id
                 harvest_object.add()
+                index.object_imported(harvest_object)
 
                 # Delete the previous object to avoid cluttering the object table
-                previous_object.delete()
+                HarvestObject.get(previous_object.id).delete()
 
                 # Reindex the corresponding package to update the reference to the
                 # harvest object
@@ -841,10 +1003,14 @@ class FisbrokerHarvester(CSWHarvester):
                 try:
                     package_id = toolkit.get_action('package_update')(context, package_dict)
                     LOG.info(f"Updated package {package_id} with guid {harvest_object.guid}")
+                    index.package_saved(harvest_object.package_id, package_name)
                 except toolkit.ValidationError as e:
                     self._save_object_error(f"Validation Error: {six.text_type(e.error_summary)}", harvest_object, 'Import')
                     return False
 
+        if self.source_config.get('import_since') == 'watermark':
+            # written with the import
+            self.record_watermark_result(harvest_object, True)
         model.Session.commit()
 
         return True
@@ -991,6 +1157,15 @@ class FisbrokerHarvester(CSWHarvester):
 
             extras['berlin_source'] = 'harvest-fisbroker'
 
+            # version of the mapping that produced this package dict:
+
+            extras[MAPPING_VERSION_EXTRA] = MAPPING_VERSION
+
+            # FIS-Broker guid and harvester type:
+
+            extras[GUID_EXTRA] = (harvest_object and harvest_object.guid) or iso_values['guid']
+            extras[HARVESTER_TYPE_EXTRA] = HARVESTER_ID
+
             # always put in 'geo' group
 
             package_dict['groups'] = [{'name': 'geo'}]
@@ -1040,30 +1215,41 @@ class FisbrokerHarvester(CSWHarvester):
     def last_error_free_job(cls, harvest_job) -> HarvestJob:
         '''Override last_error_free_job() from
            ckanext.harvest.harvesters.base.HarvesterBase to filter out
-           jobs that were created by a reimport action.'''
+           jobs that were created by a reimport action.
+           The job is determined with a single query, and remembered for the
+           harvest source until another job of the source has finished.'''
 
-        jobs = (model.Session.query(HarvestJob)
-            .filter(HarvestJob.source == harvest_job.source)
+        source_id = harvest_job.source.id
+        fingerprint = tuple(model.Session.query(func.count(HarvestJob.id), func.max(HarvestJob.finished))
+            .filter(HarvestJob.source_id == source_id)
+            .filter(HarvestJob.status == 'Finished')
+            .one())
+        cached = LAST_ERROR_FREE_JOBS.get(source_id)
+        if cached and cached[0] == fingerprint and cached[1] != harvest_job.id:
+            return HarvestJob.get(cached[1]) if cached[1] else None
+
+        failed_objects = exists() \
+            .where(HarvestObject.harvest_job_id == HarvestJob.id) \
+            .where(HarvestObject.current == False) \
+            .where(or_(HarvestObject.report_status == None,
+                       ~HarvestObject.report_status.in_(['not modified', 'deleted'])))
+        job = (model.Session.query(HarvestJob)
+            .filter(HarvestJob.source_id == source_id)
             .filter(HarvestJob.gather_started != None)
             .filter(HarvestJob.status == 'Finished')
             .filter(HarvestJob.id != harvest_job.id)
             .filter(
                 ~exists().where(HarvestGatherError.harvest_job_id == HarvestJob.id))
-            .order_by(HarvestJob.gather_started.desc()))
-
-        # now check them until we find one with no fetch/import errors,
-        # which isn't a reimport job
-        for job in jobs:
-            if helpers.is_reimport_job(job):
-                continue
-            for obj in job.objects:
-                if obj.current is False and \
-                        obj.report_status not in(['not modified', 'deleted']):
-                    # this job is not error_free, so go onto the next job
-                    break
-            else:
-                # there was no break in the for-loop
-                return job
+            # no reimport jobs
+            .filter(
+                ~exists().where(fbmodel.reimport_job_table.c.harvest_job_id == HarvestJob.id))
+            # no fetch/import errors
+            .filter(~failed_objects)
+            .order_by(HarvestJob.gather_started.desc())
+            .first())
+
+        LAST_ERROR_FREE_JOBS[source_id] = (fingerprint, job.id if job else None)
+        return job
 
 
 class AlwaysValid(BaseValidator):
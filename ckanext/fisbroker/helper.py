@@ -1,18 +1,41 @@
 # coding: utf-8
 """A collection of helper methods for the CKAN FIS-Broker harvester."""
 
+from collections import namedtuple
 import logging
+import threading
+import time
 from urllib.parse import urlparse, urlunparse, parse_qs
 
+from flask import g, has_request_context
+
 from ckan import model
+from ckan.lib.search.common import make_connection
 from ckan.model.package import Package
+import ckan.plugins as plugins
 from ckan.plugins import toolkit
 
-from ckanext.harvest.model import HarvestJob
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestSource
 
-from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker import (
+    HARVESTER_ID,
+    GUID_EXTRA,
+    HARVESTER_TYPE_EXTRA,
+    MAPPING_VERSION,
+    MAPPING_VERSION_EXTRA,
+)
+import ckanext.fisbroker.model as fbmodel
 
 LOG = logging.getLogger(__name__)
+SOLR_DELETE_BATCH_SIZE = 500
+# seconds after which the cached FIS-Broker sources are looked up again, to
+# notice changes made by other processes
+SOURCE_CACHE_TTL_DEFAULT = 300
+_source_cache = {'sources': None, 'expires': 0}
+_source_cache_lock = threading.Lock()
+
+PackageHarvestInfo = namedtuple('PackageHarvestInfo',
+                                ['package_id', 'name', 'guid', 'source_id', 'source_type', 'source_url'])
 
 def normalize_url(url):
     """Normalize URL by sorting query parameters and lowercasing the values
@@ -48,6 +71,10 @@ def is_fisbroker_package(package):
        False if not."""
 
     if package:
+        harvester_type = package.extras.get(HARVESTER_TYPE_EXTRA)
+        if harvester_type:
+            return harvester_type == HARVESTER_ID
+        # packages that were harvested before the extra was introduced
         harvester = harvester_for_package(package)
         if harvester:
             return bool(harvester.type == HARVESTER_ID)
@@ -58,6 +85,10 @@ def fisbroker_guid(package):
        there is none."""
 
     if package:
+        guid = package.extras.get(GUID_EXTRA)
+        if guid:
+            return guid
+        # packages that were harvested before the extra was introduced
         if dataset_was_harvested(package):
             harvest_object = package.harvest_objects[0]
             if hasattr(harvest_object, 'guid'):
@@ -76,33 +107,250 @@ def harvester_for_package(package):
         return harvest_object.source
     return None
 
+def harvest_info_for_packages(package_ids):
+    """Resolve all `package_ids` (ids or names) with a single query. Return a dict
+       mapping every id or name of an existing package to a PackageHarvestInfo.
+       The guid and harvest source are taken from the package's current harvest
+       object, or from its most recent one if none is current. They are None for
+       packages that were not harvested. Ids of packages that don't exist are
+       missing from the result."""
+
+    package_ids = list(package_ids)
+    if not package_ids:
+        return {}
+
+    query = model.Session.query(
+        Package.id,
+        Package.name,
+        HarvestObject.guid,
+        HarvestSource.id,
+        HarvestSource.type,
+        HarvestSource.url) \
+        .outerjoin(HarvestObject, HarvestObject.package_id == Package.id) \
+        .outerjoin(HarvestSource, HarvestSource.id == HarvestObject.harvest_source_id) \
+        .filter(Package.id.in_(package_ids) | Package.name.in_(package_ids)) \
+        .distinct(Package.id) \
+        .order_by(Package.id,
+                  HarvestObject.current.desc().nullslast(),
+                  HarvestObject.gathered.desc().nullslast())
+
+    infos = {}
+    for row in query:
+        info = PackageHarvestInfo(*row)
+        infos[info.package_id] = info
+        infos[info.name] = info
+
+    return infos
+
+def fisbroker_package_info(package_id):
+    """Return the PackageHarvestInfo of the package with `package_id` (id or name)
+       if it was harvested by the FIS-Broker harvester, else None. The result is
+       looked up with a single query and memoised for the current request, so
+       that templates can call this as often as they like."""
+
+    infos = None
+    if has_request_context():
+        infos = g.setdefault('fisbroker_package_infos', {})
+        if package_id in infos:
+            return infos[package_id]
+
+    info = harvest_info_for_packages([package_id]).get(package_id)
+    if info and info.source_type != HARVESTER_ID:
+        info = None
+    if infos is not None:
+        infos[package_id] = info
+
+    return info
+
 def get_package_object(package_dict):
     """Return an instance of ckan.model.package.Package for
        `package_dict` or None if there isn't one."""
 
     return Package.get(package_dict.get('name'))
 
-def get_fisbroker_source():
-    """Return the HarvestSource object that is responsible for harvesting the FIS-Broker.
-       Return None if no FIS-Broker source is found."""
+def fisbroker_sources():
+    """Return a list of dicts (with `id`, `url`, `title`, `type` and `config`)
+       for all active harvest sources of the FIS-Broker harvester, oldest first.
+       The list is cached until a harvest source is created, updated or deleted
+       in this process (see `invalidate_fisbroker_sources()`), but at most
+       `ckanext.fisbroker.source_cache_ttl` seconds."""
+
+    with _source_cache_lock:
+        if _source_cache['sources'] is not None and time.monotonic() < _source_cache['expires']:
+            return _source_cache['sources']
+
+        query = model.Session.query(HarvestSource) \
+            .filter(HarvestSource.type == HARVESTER_ID) \
+            .filter(HarvestSource.active == True) \
+            .order_by(HarvestSource.created)
+        sources = [{
+            'id': source.id,
+            'url': source.url,
+            'title': source.title,
+            'type': source.type,
+            'config': source.config,
+        } for source in query]
+        ttl = toolkit.asint(toolkit.config.get('ckanext.fisbroker.source_cache_ttl',
+                                               SOURCE_CACHE_TTL_DEFAULT))
+        _source_cache['sources'] = sources
+        _source_cache['expires'] = time.monotonic() + ttl
 
-    context = {'model': model, 'session': model.Session, 'ignore_auth': True}
-    sources = toolkit.get_action('harvest_source_list')(context, {})
+        return sources
 
-    for source in sources:
-        if source.get('type', None) == HARVESTER_ID:
-            return source
+def invalidate_fisbroker_sources():
+    """Forget the cached FIS-Broker sources."""
+
+    with _source_cache_lock:
+        _source_cache['sources'] = None
+
+def get_fisbroker_source(package_id=None):
+    """Return a dict for the harvest source that is responsible for harvesting
+       the FIS-Broker: the source that harvested the package with `package_id`
+       if it is an active FIS-Broker source, else the oldest one. Return None
+       if no FIS-Broker source is found."""
+
+    sources = fisbroker_sources()
+    if package_id:
+        info = harvest_info_for_packages([package_id]).get(package_id)
+        for source in sources:
+            if info and source['id'] == info.source_id:
+                return source
+    if sources:
+        return sources[0]
 
     return None
 
 def is_reimport_job(harvest_job):
-    '''Return `True` if `harvest_job_dict` was a reimport job.'''
+    '''Return `True` if `harvest_job` was a reimport job.'''
+
+    return fbmodel.is_reimport_job_id(harvest_job.id)
+
+def delete_packages(package_ids, context):
+    """Mark all packages in `package_ids` as deleted with a single UPDATE,
+       together with their group memberships. Like the `package_delete`
+       action, create a 'deleted package' activity on behalf of the user of
+       `context` and call the `delete()` and `after_delete()` hooks of all
+       IPackageController plugins for each package. Don't commit and don't
+       touch the search index: call unindex_packages() after the commit.
+       Return the ids of the packages that were deleted."""
+
+    package_ids = list(package_ids)
+    if not package_ids:
+        return []
+
+    packages = model.Session.query(model.Package) \
+        .filter(model.Package.id.in_(package_ids)) \
+        .filter(model.Package.state != model.State.DELETED) \
+        .all()
+    deleted_ids = [package.id for package in packages]
+    if not deleted_ids:
+        return []
+    model.Session.query(model.Package) \
+        .filter(model.Package.id.in_(deleted_ids)) \
+        .update({'state': model.State.DELETED}, synchronize_session='fetch')
+    model.Session.query(model.Member) \
+        .filter(model.Member.table_name == 'package') \
+        .filter(model.Member.table_id.in_(deleted_ids)) \
+        .filter(model.Member.state == model.State.ACTIVE) \
+        .update({'state': model.State.DELETED}, synchronize_session='fetch')
+
+    user = model.User.by_name(context.get('user'))
+    user_id = user.id if user else 'not logged in'
+    for package in packages:
+        activity = package.activity_stream_item('deleted', user_id)
+        if activity:
+            model.Session.add(activity)
+    for plugin in plugins.PluginImplementations(plugins.IPackageController):
+        for package in packages:
+            plugin.delete(package)
+            plugin.after_delete(context, {'id': package.id})
+
+    LOG.info(f"Deleted {len(deleted_ids)} packages in bulk")
+
+    return deleted_ids
+
+def unindex_packages(package_ids):
+    """Remove all packages in `package_ids` from the search index, with one
+       delete-by-query request per SOLR_DELETE_BATCH_SIZE packages."""
+
+    package_ids = list(package_ids)
+    conn = make_connection()
+    site_id = toolkit.config.get('ckan.site_id')
+    commit = toolkit.asbool(toolkit.config.get('ckan.search.solr_commit', 'true'))
+    for start in range(0, len(package_ids), SOLR_DELETE_BATCH_SIZE):
+        batch = package_ids[start:start + SOLR_DELETE_BATCH_SIZE]
+        ids = " OR ".join(f'"{package_id}"' for package_id in batch)
+        query = f'+entity_type:package AND +id:({ids}) AND +site_id:"{site_id}"'
+        conn.delete(q=query, commit=commit)
+
+def backfill_fisbroker_extras():
+    """Add the extras with the FIS-Broker guid and harvester type to all active
+       packages that have a current harvest object of a FIS-Broker harvester,
+       but don't have the extras (or have outdated values), without mapping
+       the packages again. Reindex the changed packages and return their ids."""
+
+    query = model.Session.query(HarvestObject.package_id, HarvestObject.guid) \
+        .join(HarvestSource, HarvestObject.harvest_source_id == HarvestSource.id) \
+        .join(model.Package, model.Package.id == HarvestObject.package_id) \
+        .filter(HarvestSource.type == HARVESTER_ID) \
+        .filter(HarvestObject.current == True) \
+        .filter(model.Package.state == model.State.ACTIVE)
+    existing = {(extra.package_id, extra.key): extra for extra in
+                model.Session.query(model.PackageExtra)
+                .filter(model.PackageExtra.key.in_([GUID_EXTRA, HARVESTER_TYPE_EXTRA]))}
+
+    changed = []
+    for package_id, guid in query:
+        package_changed = False
+        for key, value in ((GUID_EXTRA, guid), (HARVESTER_TYPE_EXTRA, HARVESTER_ID)):
+            extra = existing.get((package_id, key))
+            if extra is None:
+                model.Session.add(model.PackageExtra(package_id=package_id, key=key, value=value))
+                package_changed = True
+            elif extra.value != value:
+                extra.value = value
+                package_changed = True
+        if package_changed:
+            changed.append(package_id)
+    model.Session.commit()
+
+    if changed:
+        from ckan.lib.search import commit, rebuild
+        rebuild(package_ids=changed, defer_commit=True)
+        commit()
+    LOG.info(f"Added FIS-Broker extras to {len(changed)} packages")
+
+    return changed
+
+def mapping_version_key(version):
+    """Sort key for mapping versions like '1.5.2+1' (release and mapping
+       revision). Missing versions sort before all others."""
+
+    if not version:
+        return (0,)
+    release, _, revision = version.partition('+')
+    parts = []
+    for part in release.split('.') + [revision or '0']:
+        try:
+            parts.append(int(part))
+        except ValueError:
+            parts.append(0)
+    return (1, *parts)
+
+def outdated_packages(mapping_version=MAPPING_VERSION):
+    """Return the ids of all active packages harvested by a FIS-Broker harvester
+       which were not mapped by `mapping_version`: first those without a mapping
+       version, then the others from the oldest mapping version to the newest."""
 
-    # if isinstance(harvest_job, dict):
-    #     harvest_job = HarvestJob.get(harvest_job['id'])
+    query = model.Session.query(HarvestObject.package_id, model.PackageExtra.value) \
+        .join(HarvestSource, HarvestObject.harvest_source_id == HarvestSource.id) \
+        .join(model.Package, model.Package.id == HarvestObject.package_id) \
+        .outerjoin(model.PackageExtra, (model.PackageExtra.package_id == HarvestObject.package_id) &
+                   (model.PackageExtra.key == MAPPING_VERSION_EXTRA)) \
+        .filter(HarvestSource.type == HARVESTER_ID) \
+        .filter(HarvestObject.current == True) \
+        .filter(model.Package.state == model.State.ACTIVE)
+    outdated = [(package_id, version) for package_id, version in query if version != mapping_version]
+    outdated.sort(key=lambda package: mapping_version_key(package[1]))
 
-    for harvest_object in harvest_job.objects:
-        for extra in harvest_object.extras:
-            if extra.key == 'type' and extra.value == 'reimport':
-                return True
-        return False
+    return [package_id for package_id, version in outdated]
@@ -0,0 +1,222 @@
+# coding: utf-8
+'''
+In-memory lookup index for the import stage of a single harvest job.
+
+`import_stage()` needs to know, for every harvest object, the current harvest
+object with the same guid and the package that carries a given name or id.
+Instead of asking the database for each object, an `ImportIndex` is loaded in
+bulk for the guids and packages of the objects of one job, and kept up to date
+while the job's objects are being imported. Lookups of guids and packages that
+were not loaded (e.g. objects that were added to the job later) fall back to
+the database, once per guid, name or id: the index also remembers which of them
+have no harvest object or package.
+'''
+
+from collections import namedtuple
+import logging
+import threading
+
+from ckan import model
+
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+
+LOG = logging.getLogger(__name__)
+
+IndexedObject = namedtuple('IndexedObject', ['id', 'harvest_job_id', 'metadata_modified_date'])
+IndexedPackage = namedtuple('IndexedPackage', ['id', 'name', 'state'])
+
+# the index of the job that was imported last in the current thread, see ImportIndex.for_job()
+_LOCAL = threading.local()
+
+
+class ImportIndex:
+    '''Lookup tables for the import stage of the harvest job with `harvest_job_id`:
+
+       - guid -> current harvest object
+       - guid -> id of the current harvest object
+       - package name -> package and package id -> package
+       - the ids of the packages that the job deletes
+
+       A value of None means that there is no such harvest object or package.'''
+
+    def __init__(self, harvest_job_id):
+        self.harvest_job_id = harvest_job_id
+        self._previous_objects = {}
+        self._current_object_ids = {}
+        self._packages_by_name = {}
+        self._packages_by_id = {}
+        self._pending_deletions = set()
+
+    @classmethod
+    def load(cls, harvest_job_id):
+        '''Build the index for the objects of the harvest job with `harvest_job_id`
+           with one query per lookup table.'''
+
+        index = cls(harvest_job_id)
+
+        # the guids of the job without a current object are known to be new
+        job_guid_list = model.Session.query(HarvestObject.guid) \
+            .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+            .filter(HarvestObject.guid != None)
+        for (guid,) in job_guid_list:
+            index._previous_objects[guid] = None
+            index._current_object_ids[guid] = None
+
+        job_objects = model.Session.query(HarvestObject.guid, HarvestObject.package_id) \
+            .filter(HarvestObject.harvest_job_id == harvest_job_id)
+        job_guids = job_objects.with_entities(HarvestObject.guid)
+        job_package_ids = job_objects.with_entities(HarvestObject.package_id) \
+            .filter(HarvestObject.package_id != None)
+
+        current_objects = model.Session.query(
+            HarvestObject.guid,
+            HarvestObject.id,
+            HarvestObject.harvest_job_id,
+            HarvestObject.metadata_modified_date) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.guid.in_(job_guids))
+        for guid, object_id, job_id, metadata_modified_date in current_objects:
+            index._object_found(guid, IndexedObject(object_id, job_id, metadata_modified_date))
+
+        current_package_ids = model.Session.query(HarvestObject.package_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.guid.in_(job_guids))
+        packages = model.Session.query(model.Package.id, model.Package.name, model.Package.state) \
+            .filter(model.Package.id.in_(job_package_ids) | model.Package.id.in_(current_package_ids))
+        for package in packages:
+            index._add_package(IndexedPackage(*package))
+        for (package_id,) in job_package_ids:
+            index._packages_by_id.setdefault(package_id, None)
+
+        deletions = model.Session.query(HarvestObject.package_id) \
+            .join(HarvestObjectExtra, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+            .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+            .filter(HarvestObject.package_id != None) \
+            .filter(HarvestObjectExtra.key == 'status') \
+            .filter(HarvestObjectExtra.value == 'delete')
+        for (package_id,) in deletions:
+            index._pending_deletions.add(package_id)
+
+        LOG.info(f"Loaded import index for job {harvest_job_id}: "
+                 f"{len(index._previous_objects)} guids, "
+                 f"{sum(1 for indexed in index._previous_objects.values() if indexed)} current objects, "
+                 f"{sum(1 for package in index._packages_by_id.values() if package)} packages, "
+                 f"{len(index._pending_deletions)} pending deletions")
+
+        return index
+
+    @classmethod
+    def for_job(cls, harvest_job_id):
+        '''Return the index of the harvest job with `harvest_job_id` for the current
+           thread. The index is loaded when the first object of a job is imported
+           in a thread and replaces the index of the job imported before.'''
+        index = getattr(_LOCAL, 'index', None)
+        if index is None or index.harvest_job_id != harvest_job_id:
+            index = cls.load(harvest_job_id)
+            _LOCAL.index = index
+        return index
+
+    def _object_found(self, guid, indexed):
+        self._previous_objects[guid] = indexed
+        self._current_object_ids[guid] = indexed.id
+
+    def _add_package(self, package):
+        self._packages_by_name[package.name] = package
+        self._packages_by_id[package.id] = package
+
+    def _lookup_object(self, guid):
+        '''Look up the current harvest object for a `guid` that was not loaded
+           with the index.'''
+        current_object = model.Session.query(
+            HarvestObject.id,
+            HarvestObject.harvest_job_id,
+            HarvestObject.metadata_modified_date) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.guid == guid) \
+            .first()
+        if current_object:
+            self._object_found(guid, IndexedObject(*current_object))
+        else:
+            self._previous_objects[guid] = None
+            self._current_object_ids[guid] = None
+
+    def _lookup_package(self, criterion):
+        '''Look up a package that was not loaded with the index.'''
+        package = model.Session.query(model.Package.id, model.Package.name, model.Package.state) \
+            .filter(criterion) \
+            .first()
+        if package:
+            package = IndexedPackage(*package)
+            self._add_package(package)
+        return package
+
+    def load_names(self, names):
+        '''Load the packages called one of `names` that are not in the index yet
+           with one query, e.g. the names of the package dicts of a batch of
+           objects before they are imported.'''
+        names = set(name for name in names if name and name not in self._packages_by_name)
+        if not names:
+            return
+        packages = model.Session.query(model.Package.id, model.Package.name, model.Package.state) \
+            .filter(model.Package.name.in_(names))
+        for package in packages:
+            self._add_package(IndexedPackage(*package))
+        for name in names:
+            self._packages_by_name.setdefault(name, None)
+
+    def previous_object(self, guid):
+        '''Return the current harvest object for `guid` as an `IndexedObject`,
+           or None if there is none.'''
+        if guid and guid not in self._previous_objects:
+            self._lookup_object(guid)
+        return self._previous_objects.get(guid)
+
+    def current_object_id(self, guid):
+        '''Return the id of the current harvest object for `guid`, or None.'''
+        if guid and guid not in self._current_object_ids:
+            self._lookup_object(guid)
+        return self._current_object_ids.get(guid)
+
+    def package_by_name(self, name):
+        '''Return the `IndexedPackage` called `name`, or None.'''
+        if name and name not in self._packages_by_name:
+            if not self._lookup_package(model.Package.name == name):
+                self._packages_by_name[name] = None
+        return self._packages_by_name.get(name)
+
+    def package_by_id(self, package_id):
+        '''Return the `IndexedPackage` with `package_id`, or None.'''
+        if package_id and package_id not in self._packages_by_id:
+            if not self._lookup_package(model.Package.id == package_id):
+                self._packages_by_id[package_id] = None
+        return self._packages_by_id.get(package_id)
+
+    def take_pending_deletions(self):
+        '''Return the ids of all packages that the job deletes and which have not
+           been deleted yet, and forget about them.'''
+        package_ids = self._pending_deletions
+        self._pending_deletions = set()
+        return package_ids
+
+    def object_replaced(self, guid):
+        '''Forget the current harvest object for `guid`, because it has been
+           flagged as not current or deleted.'''
+        self._previous_objects[guid] = None
+        self._current_object_ids[guid] = None
+
+    def object_imported(self, harvest_object):
+        '''Record `harvest_object` as the current harvest object for its guid.'''
+        indexed = IndexedObject(harvest_object.id,
+                                harvest_object.harvest_job_id,
+                                harvest_object.metadata_modified_date)
+        self._previous_objects[harvest_object.guid] = indexed
+        self._current_object_ids[harvest_object.guid] = harvest_object.id
+
+    def package_saved(self, package_id, name, state='active'):
+        '''Record that the package with `package_id` is now called `name` and
+           has `state`.'''
+        previous = self._packages_by_id.get(package_id)
+        if previous and self._packages_by_name.get(previous.name) is previous:
+            # the package was renamed, there is no package with its old name
+            self._packages_by_name[previous.name] = None
+        self._add_package(IndexedPackage(package_id, name, state))
@@ -0,0 +1,167 @@
+# coding: utf-8
+'''
+Database tables of ckanext-fisbroker.
+
+`fisbroker_reimport_job` records which harvest jobs were created by a reimport
+(or reprocessing) instead of a regular harvest run, so that these jobs can be
+recognised without looking at their harvest objects. Reimports either get a job
+of their own, or are attached to a rolling reimport job per harvest source and
+day (if the config option `ckanext.fisbroker.reimport.daily_job` is enabled).
+There is at most one rolling reimport job per harvest source and day.
+
+`fisbroker_harvest_watermark` holds the harvest watermark of each harvest
+source: the metadata modified date up to which all records of the source have
+been harvested successfully (see `import_since: watermark`), and the results
+of the job that is currently harvested from the watermark, which are recorded
+while its records are fetched and imported.
+
+The tables are created (and filled with the reimport jobs that already exist)
+by `setup()` when the plugin is configured, i.e. once when CKAN starts.
+'''
+
+import datetime
+import logging
+
+from sqlalchemy import Column, Index, Table, func, or_, select, types
+from sqlalchemy.dialects.postgresql import insert
+
+from ckan import model
+from ckan.model import meta
+
+from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectExtra, harvest_object_table
+
+LOG = logging.getLogger(__name__)
+
+reimport_job_table = Table(
+    'fisbroker_reimport_job', meta.metadata,
+    Column('harvest_job_id', types.UnicodeText, primary_key=True),
+    Column('harvest_source_id', types.UnicodeText, nullable=False, index=True),
+    # only set for the rolling reimport job of a day
+    Column('day', types.Date, nullable=True),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    # one rolling reimport job per harvest source and day (rows without a day
+    # are not affected, as NULLs are distinct)
+    Index('fisbroker_reimport_job_daily_idx', 'harvest_source_id', 'day', unique=True),
+)
+
+harvest_watermark_table = Table(
+    'fisbroker_harvest_watermark', meta.metadata,
+    Column('harvest_source_id', types.UnicodeText, primary_key=True),
+    # all records modified up to this date were harvested successfully
+    Column('modified', types.DateTime, nullable=True),
+    # the job that is harvested from `modified`
+    Column('harvest_job_id', types.UnicodeText, nullable=True),
+    # the latest modified date of the records of the job that were harvested
+    # successfully, below `job_failed_from`
+    Column('job_modified', types.DateTime, nullable=True),
+    # the modified date of the earliest record of the job that failed
+    Column('job_failed_from', types.DateTime, nullable=True),
+    # a record of the job failed before its modified date was known
+    Column('job_failed', types.Boolean, nullable=False, default=False),
+    Column('updated', types.DateTime, default=datetime.datetime.utcnow,
+           onupdate=datetime.datetime.utcnow),
+)
+
+
+def setup():
+    '''Create the tables if they don't exist yet. When the reimport job table
+       is created, fill it with all existing jobs that contain reimported harvest
+       objects.'''
+    engine = model.Session.get_bind()
+    if not harvest_object_table.exists(bind=engine):
+        LOG.debug("FIS-Broker table creation deferred, the harvest tables don't exist yet")
+        return
+    if not harvest_watermark_table.exists(bind=engine):
+        harvest_watermark_table.create(bind=engine, checkfirst=True)
+        LOG.info(f"Created table {harvest_watermark_table.name}")
+    if reimport_job_table.exists(bind=engine):
+        return
+
+    reimport_job_table.create(bind=engine, checkfirst=True)
+    reimport_jobs = model.Session.query(HarvestObject.harvest_job_id, HarvestObject.harvest_source_id) \
+        .join(HarvestObjectExtra, HarvestObjectExtra.harvest_object_id == HarvestObject.id) \
+        .filter(HarvestObjectExtra.key == 'type') \
+        .filter(HarvestObjectExtra.value == 'reimport') \
+        .distinct()
+    rows = [{'harvest_job_id': job_id, 'harvest_source_id': source_id}
+            for job_id, source_id in reimport_jobs]
+    if rows:
+        model.Session.execute(reimport_job_table.insert(), rows)
+    model.Session.commit()
+    LOG.info(f"Created table {reimport_job_table.name} with {len(rows)} existing reimport jobs")
+
+
+def record_reimport_job(harvest_job, day=None):
+    '''Record `harvest_job` as a reimport job, as the rolling reimport job
+       of `day` if `day` is given.'''
+    model.Session.execute(reimport_job_table.insert().values(
+        harvest_job_id=harvest_job.id,
+        harvest_source_id=harvest_job.source_id,
+        day=day))
+
+
+def daily_reimport_job(source_id, day):
+    '''Return the rolling reimport job of harvest source `source_id` for `day`,
+       or None if there is none yet.'''
+    return model.Session.query(HarvestJob) \
+        .join(reimport_job_table, reimport_job_table.c.harvest_job_id == HarvestJob.id) \
+        .filter(reimport_job_table.c.harvest_source_id == source_id) \
+        .filter(reimport_job_table.c.day == day) \
+        .first()
+
+
+def is_reimport_job_id(harvest_job_id):
+    '''Return True if the harvest job with `harvest_job_id` is a reimport job.'''
+    query = model.Session.query(reimport_job_table.c.harvest_job_id) \
+        .filter(reimport_job_table.c.harvest_job_id == harvest_job_id)
+    return model.Session.query(query.exists()).scalar()
+
+def harvest_watermark(source_id):
+    '''Return the watermark of harvest source `source_id` (a row with
+       `modified`, `harvest_job_id` and the results of that job), or None if it
+       has none yet.'''
+    return model.Session.execute(select([harvest_watermark_table])
+        .where(harvest_watermark_table.c.harvest_source_id == source_id)).first()
+
+def set_harvest_watermark(source_id, modified, harvest_job_id):
+    '''Insert or update the watermark of harvest source `source_id`, and start
+       recording the results of the job with `harvest_job_id`, without
+       committing.'''
+    values = {'modified': modified, 'harvest_job_id': harvest_job_id,
+              'job_modified': None, 'job_failed_from': None, 'job_failed': False,
+              'updated': datetime.datetime.utcnow()}
+    statement = insert(harvest_watermark_table) \
+        .values(harvest_source_id=source_id, **values) \
+        .on_conflict_do_update(index_elements=[harvest_watermark_table.c.harvest_source_id],
+                               set_=values)
+    model.Session.execute(statement)
+
+def record_harvest_result(source_id, harvest_job_id, modified, success):
+    '''Record the result of harvesting a record of the job with `harvest_job_id`,
+       which was last modified at `modified` (None if unknown), if the job is
+       harvested from the watermark of harvest source `source_id`. Don't commit.'''
+    table = harvest_watermark_table
+    statement = table.update() \
+        .where(table.c.harvest_source_id == source_id) \
+        .where(table.c.harvest_job_id == harvest_job_id)
+    if success:
+        if modified is None:
+            return
+        statement = statement \
+            .where(or_(table.c.job_failed_from == None, table.c.job_failed_from > modified)) \
+            .values(job_modified=func.greatest(table.c.job_modified, modified))
+    elif modified is None:
+        statement = statement.values(job_failed=True)
+    else:
+        current = harvest_watermark(source_id)
+        if not current or current.harvest_job_id != harvest_job_id:
+            return
+        failed_from = min(filter(None, [current.job_failed_from, modified]))
+        # the successful records of the job below the earliest failure
+        job_modified = model.Session.query(func.max(HarvestObject.metadata_modified_date)) \
+            .filter(HarvestObject.harvest_job_id == harvest_job_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.metadata_modified_date < failed_from) \
+            .scalar()
+        statement = statement.values(job_failed_from=failed_from, job_modified=job_modified)
+    model.Session.execute(statement)
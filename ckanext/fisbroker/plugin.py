@@ -3,22 +3,25 @@
 import logging
 import os
 
-from ckan.plugins import IBlueprint, IClick, IConfigurer, ITemplateHelpers
+from ckan.plugins import IBlueprint, IClick, IConfigurable, IConfigurer, IPackageController, ITemplateHelpers
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
 from ckanext.fisbroker import blueprint
 import ckanext.fisbroker.helper as helpers
 import ckanext.fisbroker.cli as cli
+import ckanext.fisbroker.model as fbmodel
 
 LOG = logging.getLogger(__name__)
 
 class FisbrokerPlugin(plugins.SingletonPlugin):
 
     plugins.implements(IClick)
+    plugins.implements(IConfigurable)
     plugins.implements(IConfigurer)
     plugins.implements(ITemplateHelpers)
     plugins.implements(IBlueprint, inherit=True)
+    plugins.implements(IPackageController, inherit=True)
 
     # IClick
 
@@ -28,6 +31,15 @@ class FisbrokerPlugin(plugins.SingletonPlugin):
         '''
         return cli.get_commands()
 
+    # IConfigurable
+
+    def configure(self, config):
+        '''
+        Implementation of
+        https://docs.ckan.org/en/2.9/extensions/plugin-interfaces.html#ckan.plugins.interfaces.IConfigurable.configure
+        '''
+        fbmodel.setup()
+
     # IConfigurer
 
     def update_config(self, config):
@@ -53,6 +65,7 @@ class FisbrokerPlugin(plugins.SingletonPlugin):
             'berlin_is_fisbroker_package': helpers.is_fisbroker_package,
             'berlin_fisbroker_guid': helpers.fisbroker_guid,
             'berlin_package_object': helpers.get_package_object,
+            'berlin_fisbroker_package_info': helpers.fisbroker_package_info,
             'berlin_is_reimport_job': helpers.is_reimport_job,
         }
 
@@ -65,3 +78,29 @@ class FisbrokerPlugin(plugins.SingletonPlugin):
         """
         return blueprint.reimportapi
 
+    # IPackageController
+
+    def after_create(self, context, pkg_dict):
+        '''
+        Implementation of
+        https://docs.ckan.org/en/2.9/extensions/plugin-interfaces.html#ckan.plugins.interfaces.IPackageController.after_create
+        '''
+        if pkg_dict.get('type') == 'harvest':
+            helpers.invalidate_fisbroker_sources()
+
+    def after_update(self, context, pkg_dict):
+        '''
+        Implementation of
+        https://docs.ckan.org/en/2.9/extensions/plugin-interfaces.html#ckan.plugins.interfaces.IPackageController.after_update
+        '''
+        if pkg_dict.get('type') == 'harvest':
+            helpers.invalidate_fisbroker_sources()
+
+    def after_delete(self, context, pkg_dict):
+        '''
+        Implementation of
+        https://docs.ckan.org/en/2.9/extensions/plugin-interfaces.html#ckan.plugins.interfaces.IPackageController.after_delete
+        '''
+        # the dict of a deleted package doesn't necessarily contain its type
+        helpers.invalidate_fisbroker_sources()
+
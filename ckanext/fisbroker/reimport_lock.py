@@ -0,0 +1,207 @@
+# coding: utf-8
+'''
+Coalescing and concurrency limiting of reimports, shared by all web and job
+worker processes through CKAN's Redis.
+
+- Every package that is being reimported is claimed with a token (the id of
+  the background job, or a random token for reimports inside a web request
+  and bulk reimports). A second reimport of the same package finds the claim
+  and points to the reimport that is already in flight instead of starting
+  another one. Reimports inside a web request record their status under their
+  token, so that it can be reported like the status of a background job.
+- The number of reimports that run at the same time is limited to
+  `ckanext.fisbroker.reimport.max_concurrent` slots. Long-running reimports
+  refresh their slot and claims while they make progress.
+- The rolling reimport job of a harvest source and day is created and finished
+  under a lock per harvest source, and counts the reimports that share it, so
+  that it is only finished by the last of them.
+
+Claims, slots and statuses expire after `ckanext.fisbroker.reimport.lock_timeout`
+seconds, so that a crashed reimport doesn't block others forever. The counter
+of a rolling reimport job is deleted when the job is finished; it only expires
+after JOB_COUNTER_TTL, long after the day of the job.
+'''
+
+import json
+import logging
+import time
+
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+
+LOG = logging.getLogger(__name__)
+KEY_PREFIX = 'ckanext-fisbroker:reimport'
+SLOTS_KEY = f"{KEY_PREFIX}:slots"
+MAX_CONCURRENT_DEFAULT = 4
+LOCK_TIMEOUT_DEFAULT = 600
+# seconds after which the counter of a rolling reimport job expires, if the job
+# was never finished because a reimport crashed
+JOB_COUNTER_TTL = 2 * 24 * 60 * 60
+# seconds between two checks while waiting for a slot
+POLL_INTERVAL = 0.5
+
+# delete a claim only if it is still held by the given token
+RELEASE_SCRIPT = '''
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+'''
+# renew a claim only if it is still held by the given token
+REFRESH_SCRIPT = '''
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+'''
+
+def max_concurrent():
+    '''Return the maximum number of concurrent reimports (0 means no limit).'''
+    return toolkit.asint(toolkit.config.get('ckanext.fisbroker.reimport.max_concurrent',
+                                            MAX_CONCURRENT_DEFAULT))
+
+def lock_timeout():
+    '''Return the number of seconds after which claims and slots expire.'''
+    return toolkit.asint(toolkit.config.get('ckanext.fisbroker.reimport.lock_timeout',
+                                            LOCK_TIMEOUT_DEFAULT))
+
+def _package_key(package_id):
+    return f"{KEY_PREFIX}:package:{package_id}"
+
+def _status_key(token):
+    return f"{KEY_PREFIX}:status:{token}"
+
+def _job_key(harvest_job_id):
+    return f"{KEY_PREFIX}:job:{harvest_job_id}"
+
+def source_lock(source_id):
+    '''Return a lock (to be used as a context manager) for creating, attaching
+       to and finishing the rolling reimport job of harvest source `source_id`.'''
+    return connect_to_redis().lock(f"{KEY_PREFIX}:source-lock:{source_id}",
+                                   timeout=lock_timeout(),
+                                   blocking_timeout=lock_timeout())
+
+def attach_to_job(harvest_job_id):
+    '''Count one more reimport that runs in the shared harvest job with
+       `harvest_job_id`.'''
+    conn = connect_to_redis()
+    key = _job_key(harvest_job_id)
+    pipe = conn.pipeline()
+    pipe.incr(key)
+    pipe.expire(key, JOB_COUNTER_TTL)
+    pipe.execute()
+
+def detach_from_job(harvest_job_id):
+    '''Count one reimport less that runs in the shared harvest job with
+       `harvest_job_id`. Return True if it was the last one, in which case the
+       counter is deleted.'''
+    conn = connect_to_redis()
+    key = _job_key(harvest_job_id)
+    pipe = conn.pipeline()
+    pipe.decr(key)
+    pipe.expire(key, JOB_COUNTER_TTL)
+    if pipe.execute()[0] > 0:
+        return False
+    conn.delete(key)
+    return True
+
+def claim_package(package_id, token, force=False):
+    '''Claim the reimport of `package_id` for `token`. Return None if the claim
+       succeeded, or the token of the reimport that is already in flight. With
+       `force`, take over an existing claim.'''
+    conn = connect_to_redis()
+    key = _package_key(package_id)
+    if force:
+        conn.set(key, token, ex=lock_timeout())
+        return None
+    if conn.set(key, token, nx=True, ex=lock_timeout()):
+        return None
+    in_flight = conn.get(key)
+    if in_flight is None:
+        # the claim expired in the meantime
+        return claim_package(package_id, token)
+    return in_flight.decode('utf-8')
+
+def claim_packages(package_ids, token):
+    '''Claim the reimport of all `package_ids` for `token` at once. Return a dict
+       mapping the ids of the packages that are already being reimported to the
+       tokens of the reimports in flight.'''
+    conn = connect_to_redis()
+    pipe = conn.pipeline()
+    for package_id in package_ids:
+        pipe.set(_package_key(package_id), token, nx=True, ex=lock_timeout())
+    taken = [package_id for package_id, claimed in zip(package_ids, pipe.execute()) if not claimed]
+    in_flight = {}
+    for package_id in taken:
+        other = claim_package(package_id, token)
+        if other:
+            in_flight[package_id] = other
+    return in_flight
+
+def release_package(package_id, token):
+    '''Release the claim of `token` on `package_id`.'''
+    release_packages([package_id], token)
+
+def release_packages(package_ids, token):
+    '''Release the claims of `token` on all `package_ids`.'''
+    conn = connect_to_redis()
+    release = conn.register_script(RELEASE_SCRIPT)
+    pipe = conn.pipeline()
+    for package_id in package_ids:
+        release(keys=[_package_key(package_id)], args=[token], client=pipe)
+    pipe.execute()
+
+def record_status(token, status, **data):
+    '''Record the `status` ('started', 'finished' or 'failed') and further `data`
+       (e.g. the result) of the reimport with `token`, which doesn't run as a
+       background job. The status is kept for `lock_timeout()` seconds after
+       its last update.'''
+    data['status'] = status
+    connect_to_redis().set(_status_key(token), json.dumps(data), ex=lock_timeout())
+
+def get_status(token):
+    '''Return the data recorded with record_status() for the reimport with
+       `token`, or None.'''
+    data = connect_to_redis().get(_status_key(token))
+    return json.loads(data) if data else None
+
+def acquire_slot(token, wait=0):
+    '''Take one of the slots for concurrent reimports for `token`, waiting at
+       most `wait` seconds for a free slot. Return True if a slot was taken,
+       False if all slots are busy.'''
+    limit = max_concurrent()
+    if not limit:
+        return True
+    conn = connect_to_redis()
+    deadline = time.time() + wait
+    while True:
+        now = time.time()
+        pipe = conn.pipeline()
+        pipe.zremrangebyscore(SLOTS_KEY, '-inf', now - lock_timeout())
+        pipe.zadd(SLOTS_KEY, {token: now})
+        pipe.zrank(SLOTS_KEY, token)
+        rank = pipe.execute()[-1]
+        if rank < limit:
+            return True
+        conn.zrem(SLOTS_KEY, token)
+        if time.time() >= deadline:
+            LOG.info(f"All {limit} reimport slots are busy")
+            return False
+        time.sleep(POLL_INTERVAL)
+
+def refresh(token, package_ids=()):
+    '''Renew the slot taken by `token` and its claims on `package_ids`, so that
+       they don't expire while the reimport is still running.'''
+    conn = connect_to_redis()
+    refresh_claim = conn.register_script(REFRESH_SCRIPT)
+    pipe = conn.pipeline()
+    if max_concurrent():
+        pipe.zadd(SLOTS_KEY, {token: time.time()}, xx=True)
+    for package_id in package_ids:
+        refresh_claim(keys=[_package_key(package_id)], args=[token, lock_timeout()], client=pipe)
+    pipe.execute()
+
+def release_slot(token):
+    '''Free the slot taken by `token`.'''
+    if max_concurrent():
+        connect_to_redis().zrem(SLOTS_KEY, token)
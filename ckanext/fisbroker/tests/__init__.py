@@ -25,6 +25,8 @@ from ckanext.harvest.tests import factories as harvest_factories
 
 from ckanext.fisbroker import HARVESTER_ID
 from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
+from ckanext.fisbroker.helper import invalidate_fisbroker_sources
+import ckanext.fisbroker.model as fbmodel
 from ckanext.fisbroker.tests.mock_fis_broker import start_mock_server, reset_mock_server, VALID_GUID, METADATA_OLD
 from ckanext.fisbroker.tests.xml_file_server import serve
 
@@ -59,6 +61,9 @@ def base_context():
     Fixture that provides some basic initialisation.
     '''
     reset_mock_server()
+    # the database is cleaned between tests
+    invalidate_fisbroker_sources()
+    fbmodel.setup()
     # Add sysadmin user
     user_name = u'harvest'
     harvest_user = model.User(name=user_name, password=u'test', sysadmin=True)
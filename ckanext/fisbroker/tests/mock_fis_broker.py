@@ -22,6 +22,9 @@ INVALID_GUID = '65715c6e-bbaf-3def-982b-3b5156272da8'
 METADATA_NOW = '2019-11-25T13:18:43'
 METADATA_OLD = '2019-11-23T13:18:43'
 RECORD_DUMMY_COUNT = 10
+CSW_NAMESPACE = "http://www.opengis.net/cat/csw/2.0.2"
+GMD_NAMESPACE = "http://www.isotc211.org/2005/gmd"
+GCO_NAMESPACE = "http://www.isotc211.org/2005/gco"
 
 LOG = logging.getLogger(__name__)
 
@@ -52,22 +55,75 @@ def read_responses():
 
     # Add a bunch of extra records that are create dynamically by replacing placeholders in a template
     record_dummy_template_file = open(os.path.join(folder_path, f"record_dummy_template.xml"), "r")
-    record_dummy_template = record_dummy_template_file.read()
+    responses['record_dummy_template'] = record_dummy_template_file.read()
     for index in range(RECORD_DUMMY_COUNT):
         guid = f"record_{index:02d}"
         title = f"Nährstoffversorgung des Oberbodens 2015 (Umweltatlas) {index:02d}"
-        record = record_dummy_template.replace('[[GUID]]', guid)
-        record = record.replace('[[TITLE]]', title)
-        responses['records'][guid] = record
+        responses['records'][guid] = dummy_record(responses['record_dummy_template'], guid, title)
 
     return responses
 
+def dummy_record(template, guid, title):
+    """Create a record from the dummy record `template`."""
+
+    return template.replace('[[GUID]]', guid).replace('[[TITLE]]', title)
+
+def add_synthetic_records(count, prefix="synthetic"):
+    """Add `count` records created from the dummy record template. From now on,
+       GetRecords requests are answered with the identifiers of these records
+       (paged), instead of the canned response. Return the guids of the records."""
+
+    guids = []
+    for index in range(count):
+        guid = f"{prefix}_{index:06d}"
+        title = f"Synthetic record {prefix} {index:06d}"
+        RESPONSES['records'][guid] = dummy_record(RESPONSES['record_dummy_template'], guid, title)
+        guids.append(guid)
+    MockFISBroker.synthetic_guids = guids
+    return guids
+
+def synthetic_getrecords_response(start_position, max_records):
+    """Build a brief GetRecords response for a page of the synthetic records."""
+
+    guids = MockFISBroker.synthetic_guids
+    page = guids[start_position:start_position + max_records]
+    next_record = start_position + len(page)
+    if next_record >= len(guids):
+        next_record = 0
+    response = etree.Element(f"{{{CSW_NAMESPACE}}}GetRecordsResponse",
+                             nsmap={'csw': CSW_NAMESPACE, 'gmd': GMD_NAMESPACE, 'gco': GCO_NAMESPACE})
+    etree.SubElement(response, f"{{{CSW_NAMESPACE}}}SearchStatus")
+    results = etree.SubElement(response, f"{{{CSW_NAMESPACE}}}SearchResults", {
+        'elementSet': 'brief',
+        'recordSchema': GMD_NAMESPACE,
+        'nextRecord': str(next_record),
+        'numberOfRecordsMatched': str(len(guids)),
+        'numberOfRecordsReturned': str(len(page)),
+    })
+    for guid in page:
+        metadata = etree.SubElement(results, f"{{{GMD_NAMESPACE}}}MD_Metadata")
+        identifier = etree.SubElement(metadata, f"{{{GMD_NAMESPACE}}}fileIdentifier")
+        etree.SubElement(identifier, f"{{{GCO_NAMESPACE}}}CharacterString").text = guid
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(response, encoding=str)
+
 RESPONSES = read_responses()
 LOG.debug(f"responses: {RESPONSES['records'].keys()}")
 
+def combine_records(records):
+    """Combine the GetRecordById responses in `records` into a single response
+       containing all of their records."""
+
+    response = etree.fromstring(RESPONSES['no_record_found'].encode('utf-8'))
+    for record in records:
+        for metadata in list(etree.fromstring(record.encode('utf-8'))):
+            response.append(metadata)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + etree.tostring(response, encoding=str)
+
 class MockFISBroker(BaseHTTPRequestHandler):
     """A mock FIS-Broker for testing."""
 
+    synthetic_guids = []
+
     def do_GET(self):
         """Implementation of do_GET()"""
 
@@ -92,25 +148,29 @@ class MockFISBroker(BaseHTTPRequestHandler):
                     # exists, it will be served. If it doesn't exist, the 'no_record_found'
                     # response will be served, leading to an error in the harvest job.
                     # This can be used for tests that somehow involve errored harvest jobs.
-                    record_id = query.get('id')
+                    record_ids = query.get('id')
                     LOG.info(f"this is a GetRecordById request: {MockFISBroker.count_get_records}")
-                    if record_id:
-                        record_id = record_id[0]
-                        if record_id not in RESPONSES['records']:
-                            record_id = f"{record_id}_{str(MockFISBroker.count_get_records).rjust(2, '0')}"
-                        LOG.info(f"looking for {record_id}")
-                        if record_id == "cannot_connect_00":
-                            # mock a timeout happening during a GetRecordById request
-                            raise Timeout()
-                        record = RESPONSES['records'].get(record_id)
-                        if record:
-                            response_code = requests.codes.ok
-                            content_type = 'text/xml; charset=utf-8'
-                            response_content = record
+                    if record_ids:
+                        # several ids can be requested at once, separated by commas
+                        records = []
+                        for record_id in record_ids[0].split(','):
+                            if record_id not in RESPONSES['records']:
+                                record_id = f"{record_id}_{str(MockFISBroker.count_get_records).rjust(2, '0')}"
+                            LOG.info(f"looking for {record_id}")
+                            if record_id == "cannot_connect_00":
+                                # mock a timeout happening during a GetRecordById request
+                                raise Timeout()
+                            record = RESPONSES['records'].get(record_id)
+                            if record:
+                                records.append(record)
+                        response_code = requests.codes.ok
+                        # /\ that really is the response code if id is not found...
+                        content_type = 'text/xml; charset=utf-8'
+                        if len(records) == 1:
+                            response_content = records[0]
+                        elif records:
+                            response_content = combine_records(records)
                         else:
-                            response_code = requests.codes.ok
-                            # /\ that really is the response code if id is not found...
-                            content_type = 'text/xml; charset=utf-8'
                             response_content = RESPONSES['no_record_found']
                     else:
                         response_code = requests.codes.bad_request
@@ -146,7 +206,11 @@ class MockFISBroker(BaseHTTPRequestHandler):
         if csw_request == "{http://www.opengis.net/cat/csw/2.0.2}GetRecords":
             MockFISBroker.count_get_records += 1
             LOG.info(f"this is a GetRecords request: {MockFISBroker.count_get_records}")
-            response_content = RESPONSES['csw_getrecords_01']
+            if MockFISBroker.synthetic_guids:
+                response_content = synthetic_getrecords_response(
+                    int(root.get('startPosition', 0)), int(root.get('maxRecords', 10)))
+            else:
+                response_content = RESPONSES['csw_getrecords_01']
             response_code = 200
         else:
             response_code = requests.codes.bad_request
@@ -171,6 +235,8 @@ def start_mock_server(port=PORT):
     mock_server_thread.setDaemon(True)
     mock_server_thread.start()
 
+    return mock_server
+
 def reset_mock_server(counter=0):
     """Reset the mock FIS-Broker."""
 
@@ -6,20 +6,27 @@ import logging
 import pytest
 from urllib.parse import urlparse
 
+from rq import SimpleWorker
+
 from ckan.common import c
+import ckan.lib.jobs as jobs
 from ckan.lib.base import config
 from ckan.logic import NotAuthorized
 from ckan.logic.action.update import package_update
+from ckan.model import Session
 from ckan.model.package import Package
 from ckan.plugins import implements, SingletonPlugin
 from ckan.tests import factories as ckan_factories
 
 from ckanext.harvest.interfaces import IHarvester
+from ckanext.harvest.model import HarvestJob, HarvestObject
 from ckanext.fisbroker import HARVESTER_ID
 import ckanext.fisbroker.blueprint as blueprint
 from ckanext.fisbroker.blueprint import get_error_dict
 import ckanext.fisbroker.exceptions as fb_exceptions 
-from ckanext.fisbroker.tests import FisbrokerTestBase, base_context, FISBROKER_HARVESTER_CONFIG, FISBROKER_PLUGIN
+import ckanext.fisbroker.helper as helpers
+import ckanext.fisbroker.reimport_lock as reimport_lock
+from ckanext.fisbroker.tests import FisbrokerTestBase, base_context, FISBROKER_HARVESTER_CONFIG, FISBROKER_PLUGIN, WFS_FIXTURE
 from ckanext.fisbroker.tests.mock_fis_broker import INVALID_GUID
 
 LOG = logging.getLogger(__name__)
@@ -259,6 +266,319 @@ class TestReimport(FisbrokerTestBase):
         package = Package.get(package_id)
         assert package.state == 'deleted'
 
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.background', 'true')
+    def test_background_reimport_through_api(self, app, base_context):
+        '''If background reimports are enabled, the API responds with an HTTP 202
+           and a job id, and the status endpoint reports the result of the job
+           once it has been run.'''
+        jobs.get_queue().empty()
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(base_context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+
+        response = app.get(
+            url=f"/api/harvest/reimport?id={package_id}",
+            headers={'Accept': 'application/json'},
+            extra_environ={'REMOTE_USER': base_context['user'].encode('ascii')},
+            status=202,
+        )
+        job_id = response.json['job_id']
+        assert response.json['status_url'] == f"/api/harvest/reimport/status/{job_id}"
+
+        user_environ = {'REMOTE_USER': base_context['user'].encode('ascii')}
+        response = app.get(url=f"/api/harvest/reimport/status/{job_id}",
+                           extra_environ=user_environ, status=200)
+        assert response.json['status'] == 'queued'
+        assert response.json['package_id'] == package_id
+        assert response.json['progress'] == {'processed': 0, 'total': 1}
+
+        queue = jobs.get_queue()
+        SimpleWorker([queue], connection=queue.connection).work(burst=True)
+
+        response = app.get(url=f"/api/harvest/reimport/status/{job_id}",
+                           extra_environ=user_environ, status=200)
+        assert response.json['status'] == 'finished'
+        assert response.json['progress'] == {'processed': 1, 'total': 1}
+        assert response.json['result']['success']
+        assert response.json['result']['package_id'] == package_id
+
+        # the status is only reported to users who may reimport the package
+        with pytest.raises(NotAuthorized):
+            app.get(url=f"/api/harvest/reimport/status/{job_id}")
+
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.background', 'true')
+    def test_anonymous_background_reimport_is_not_enqueued(self, app, base_context):
+        '''An anonymous background reimport is rejected before a job is enqueued.'''
+        jobs.get_queue().empty()
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(base_context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+
+        with pytest.raises(NotAuthorized):
+            app.get(
+                url=f"/api/harvest/reimport?id={package_id}",
+                headers={'Accept': 'application/json'},
+            )
+        assert jobs.get_queue().count == 0
+
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.background', 'true')
+    def test_duplicate_background_reimport_attaches_to_queued_job(self, app, base_context):
+        '''Reimporting a package again while its reimport job is still queued
+           returns the queued job instead of enqueuing another one.'''
+        jobs.get_queue().empty()
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(base_context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+
+        first_job_id = blueprint.enqueue_reimport(package_id, base_context['user'])
+        second_job_id = blueprint.enqueue_reimport(fb_dataset_dict['name'], base_context['user'])
+        assert second_job_id == first_job_id
+        assert jobs.get_queue().count == 1
+
+        queue = jobs.get_queue()
+        SimpleWorker([queue], connection=queue.connection).work(burst=True)
+
+        # the finished job released the package
+        third_job_id = blueprint.enqueue_reimport(package_id, base_context['user'])
+        assert third_job_id != first_job_id
+        jobs.get_queue().empty()
+
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.max_concurrent', '1')
+    def test_reimport_fails_if_all_slots_are_busy(self, app, base_context):
+        '''If the maximum number of concurrent reimports is reached, a reimport
+           should result in an HTTP 429 with internal error code 13.'''
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(base_context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+
+        assert reimport_lock.acquire_slot('other-reimport')
+        try:
+            response = app.get(
+                url=f"/api/harvest/reimport?id={package_id}",
+                headers={'Accept': 'application/json'},
+                extra_environ={'REMOTE_USER': base_context['user'].encode('ascii')},
+                status=429,
+            )
+            assert response.json['error']['code'] == fb_exceptions.ERROR_REIMPORT_BUSY
+        finally:
+            reimport_lock.release_slot('other-reimport')
+
+        app.get(
+            url=f"/api/harvest/reimport?id={package_id}",
+            headers={'Accept': 'application/json'},
+            extra_environ={'REMOTE_USER': base_context['user'].encode('ascii')},
+            status=200,
+        )
+
+    def test_reimport_of_package_in_flight_attaches_to_it(self, app, base_context):
+        '''A reimport of a package that is already being reimported in another
+           request doesn't wait for it, but responds with an HTTP 202 and the
+           status handle of the reimport in flight.'''
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        package_update(base_context, fb_dataset_dict)
+        package_id = fb_dataset_dict['id']
+        environ = {'REMOTE_USER': base_context['user'].encode('ascii')}
+
+        assert reimport_lock.claim_package(package_id, 'other-reimport') is None
+        reimport_lock.record_status('other-reimport', 'started', package_id=package_id)
+        try:
+            response = app.get(
+                url=f"/api/harvest/reimport?id={package_id}",
+                headers={'Accept': 'application/json'},
+                extra_environ=environ,
+                status=202,
+            )
+            assert response.json['job_id'] == 'other-reimport'
+            assert response.json['package_id'] == package_id
+
+            status = app.get(url=response.json['status_url'], extra_environ=environ, status=200)
+            assert status.json['status'] == 'started'
+
+            result = {'success': True, 'package_id': package_id}
+            reimport_lock.record_status('other-reimport', 'finished', package_id=package_id,
+                                        processed=1, response_code=200, result=result)
+            status = app.get(url=response.json['status_url'], extra_environ=environ, status=200)
+            assert status.json['status'] == 'finished'
+            assert status.json['result'] == result
+        finally:
+            reimport_lock.release_package(package_id, 'other-reimport')
+
+    def test_bulk_reimport_skips_packages_in_flight(self, app, base_context):
+        '''A bulk reimport doesn't reimport a package that is already being
+           reimported, its line points to the reimport in flight.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=1)
+        busy_id = datasets[0]['id']
+
+        assert reimport_lock.claim_package(busy_id, 'other-reimport') is None
+        try:
+            response = app.post(
+                url="/api/harvest/reimport/bulk",
+                json={'ids': [dataset['id'] for dataset in datasets]},
+                extra_environ={'REMOTE_USER': base_context['user'].encode('ascii')},
+                status=200,
+            )
+        finally:
+            reimport_lock.release_package(busy_id, 'other-reimport')
+        lines = {result['package_id']: result for result in
+                 (json.loads(line) for line in response.body.splitlines())}
+        assert lines[busy_id]['job_id'] == 'other-reimport'
+        assert 'fisbroker_guid' not in lines[busy_id]
+        assert lines[datasets[1]['id']]['fisbroker_guid'] == "record_01"
+        # the bulk reimport released its claims
+        assert reimport_lock.claim_package(datasets[1]['id'], 'next-reimport') is None
+        reimport_lock.release_package(datasets[1]['id'], 'next-reimport')
+
+    def test_stored_csw_record_is_served_with_validators(self, app, base_context):
+        '''The stored CSW record of a package is served with an ETag and a
+           Last-Modified header, a conditional request results in an HTTP 304.'''
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        harvest_object = self._run_job_for_single_document(job, WFS_FIXTURE['object_id'])
+        package_id = harvest_object.package_id
+
+        response = app.get(f"/dataset/{package_id}/csw_record.xml", status=200)
+        assert response.headers['Content-Type'].startswith('application/xml')
+        assert response.body == harvest_object.content
+        etag = response.headers['ETag']
+        assert response.headers['Last-Modified']
+
+        app.get(f"/dataset/{package_id}/csw_record.xml",
+                headers={'If-None-Match': etag}, status=304)
+
+    def test_csw_record_without_stored_content_redirects(self, app, base_context):
+        '''If no CSW record is stored for a package, the request is redirected
+           to the record on FIS-Broker.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        dataset = self._create_mock_data(source, job, first=0, last=0)[0]
+        harvest_object = Session.query(HarvestObject).filter_by(package_id=dataset['id']).one()
+        harvest_object.content = None
+        harvest_object.save()
+
+        response = app.get(f"/dataset/{dataset['id']}/csw_record.xml",
+                           follow_redirects=False, status=307)
+        assert 'request=GetRecordById' in response.location
+        assert 'ID=record_00' in response.location
+
+    def test_reimport_status_unknown_job(self, app):
+        '''Requesting the status of a job that doesn't exist should result in an
+           HTTP 404 with internal error code 12.'''
+        response = app.get(url="/api/harvest/reimport/status/dunk", status=404)
+        assert response.json['error']['code'] == fb_exceptions.ERROR_JOB_NOT_FOUND
+
+    def test_bulk_reimport_streams_results(self, app, base_context):
+        '''A bulk reimport of all datasets of a source streams one line of JSON
+           per reimported dataset.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+
+        response = app.post(
+            url="/api/harvest/reimport/bulk",
+            json={'source_id': source.id},
+            extra_environ={'REMOTE_USER': base_context['user'].encode('ascii')},
+            status=200,
+        )
+        assert response.content_type == 'application/x-ndjson'
+        results = [json.loads(line) for line in response.body.splitlines()]
+        assert [result['package_id'] for result in results] == [dataset['id'] for dataset in datasets]
+        assert all(result['success'] for result in results)
+        assert results[0]['fisbroker_guid'] == "record_00"
+
+    def test_bulk_reimport_continues_after_failed_dataset(self, app, base_context):
+        '''A dataset that cannot be reimported results in a failure line, the
+           other datasets of the bulk reimport are reimported nevertheless.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+        harvest_object = Session.query(HarvestObject).filter_by(package_id=datasets[1]['id']).one()
+        harvest_object.guid = 'dunk'
+        harvest_object.save()
+
+        response = app.post(
+            url="/api/harvest/reimport/bulk",
+            json={'ids': [dataset['id'] for dataset in datasets]},
+            extra_environ={'REMOTE_USER': base_context['user'].encode('ascii')},
+            status=200,
+        )
+        results = {result['package_id']: result for result in
+                   (json.loads(line) for line in response.body.splitlines())}
+        assert set(results) == {dataset['id'] for dataset in datasets}
+        assert results[datasets[0]['id']]['success']
+        assert not results[datasets[1]['id']]['success']
+        assert results[datasets[1]['id']]['error']['code'] == fb_exceptions.ERROR_NOT_FOUND_IN_FISBROKER
+        assert results[datasets[2]['id']]['success']
+
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.max_concurrent', '1')
+    def test_unauthorized_bulk_reimport_does_not_take_a_slot(self, app, base_context):
+        '''An anonymous bulk reimport is rejected before it takes one of the
+           slots for concurrent reimports.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        self._create_mock_data(source, job, first=0, last=1)
+
+        with pytest.raises(NotAuthorized):
+            app.post(url="/api/harvest/reimport/bulk", json={'source_id': source.id})
+
+        assert reimport_lock.acquire_slot('other-reimport')
+        reimport_lock.release_slot('other-reimport')
+
+    def test_bulk_reimport_reports_invalid_ids_per_line(self, app, base_context):
+        '''Invalid package ids in a bulk reimport get an error line each, the
+           valid packages are reimported nevertheless.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        dataset = self._create_mock_data(source, job, first=0, last=0)[0]
+        non_fb_dataset_dict = ckan_factories.Dataset()
+
+        response = app.post(
+            url="/api/harvest/reimport/bulk",
+            json={'ids': ['dunk', non_fb_dataset_dict['id'], dataset['id']]},
+            extra_environ={'REMOTE_USER': base_context['user'].encode('ascii')},
+            status=200,
+        )
+        results = [json.loads(line) for line in response.body.splitlines()]
+        codes = [result['error']['code'] for result in results if not result['success']]
+        assert codes == [fb_exceptions.ERROR_NOT_FOUND_IN_CKAN, fb_exceptions.ERROR_NOT_HARVESTED]
+        assert results[-1]['package_id'] == dataset['id']
+        assert results[-1]['success']
+
+    def test_bulk_reimport_requires_fisbroker_source(self, app, base_context):
+        '''A bulk reimport of a harvest source that doesn't exist or isn't a
+           FIS-Broker source is rejected.'''
+        dataset_dict, source, job = self._harvester_setup({
+            'title': 'Dummy Harvester',
+            'name': 'dummy-harvester',
+            'source_type': 'dummyharvest',
+            'url': "http://test.org/csw"
+        })
+        environ = {'REMOTE_USER': base_context['user'].encode('ascii')}
+
+        response = app.post(url="/api/harvest/reimport/bulk", json={'source_id': 'dunk'},
+                            extra_environ=environ, status=404)
+        assert response.json['error']['code'] == fb_exceptions.ERROR_NOT_A_FISBROKER_SOURCE
+        response = app.post(url="/api/harvest/reimport/bulk", json={'source_id': source.id},
+                            extra_environ=environ, status=422)
+        assert response.json['error']['code'] == fb_exceptions.ERROR_NOT_A_FISBROKER_SOURCE
+
+    def test_closed_reimport_finishes_its_jobs(self, app, base_context):
+        '''The harvest jobs of a batch reimport are only started when it is
+           iterated, and are finished when the iteration is aborted, e.g. when
+           the client of a bulk reimport disconnects.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+
+        def reimport_jobs():
+            return [harvest_job for harvest_job in Session.query(HarvestJob).filter(HarvestJob.source_id == source.id)
+                    if helpers.is_reimport_job(harvest_job)]
+
+        reimported = blueprint.iter_reimport_batch([dataset['id'] for dataset in datasets], base_context)
+        assert not reimport_jobs()
+        # never started, nothing to finish
+        reimported.close()
+        assert not reimport_jobs()
+
+        reimported = blueprint.iter_reimport_batch([dataset['id'] for dataset in datasets], base_context)
+        next(reimported)
+        assert [harvest_job.status != 'Finished' for harvest_job in reimport_jobs()] == [True]
+        reimported.close()
+        assert [harvest_job.status for harvest_job in reimport_jobs()] == ['Finished']
+
     def test_reimport_batch_raise_error_if_no_fb_havester_defined(self, app, base_context):
         '''Calling reimport_batch when there is not FIS-Broker harvester
            defined should result in an error.'''
@@ -325,6 +645,22 @@ class TestReimport(FisbrokerTestBase):
         with pytest.raises(fb_exceptions.NoFisbrokerIdError):
             blueprint.reimport_batch(package_ids, base_context)
 
+    def test_reimport_batch_reports_all_invalid_packages(self, app, base_context):
+        '''A batch reimport containing several packages that cannot be reimported
+           should trigger an InvalidPackageIdsError listing all of them.'''
+
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        non_fb_dataset_dict = ckan_factories.Dataset()
+
+        package_ids = [fb_dataset_dict['id'], 'dunk', non_fb_dataset_dict['id']]
+        with pytest.raises(fb_exceptions.InvalidPackageIdsError) as error:
+            blueprint.reimport_batch(package_ids, base_context)
+
+        errors = error.value.errors
+        assert [invalid.package_id for invalid in errors] == package_ids[1:]
+        assert isinstance(errors[0], fb_exceptions.PackageIdDoesNotExistError)
+        assert isinstance(errors[1], fb_exceptions.PackageNotHarvestedError)
+
     def test_reimport_batch_raises_no_connection_error(self, app, base_context):
         '''A batch reimport show trigger a NoConnectionError if a connection to
            FIS-Broker cannot be established.'''
@@ -356,6 +692,110 @@ class TestReimport(FisbrokerTestBase):
         with pytest.raises(fb_exceptions.NoConnectionError):
             blueprint.reimport_batch(package_ids, base_context)
 
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.batch_size', '2')
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.fetch_workers', '2')
+    def test_reimport_batch_in_concurrent_batches(self, app, base_context):
+        '''A batch reimport fetches the records in several concurrent multi-id
+           requests and imports all of them.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=6)
+        package_ids = [dataset['id'] for dataset in datasets]
+
+        reimported = blueprint.reimport_batch(package_ids, base_context)
+
+        assert list(reimported.keys()) == package_ids
+        for index, package_id in enumerate(package_ids):
+            assert reimported[package_id].identifier == f"record_{index:02d}"
+
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.daily_job', 'true')
+    def test_reimports_of_a_day_share_a_reimport_job(self, app, base_context):
+        '''With the daily reimport job enabled, separate reimports of the same
+           day attach their harvest objects to the same reimport job.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+
+        for dataset in datasets:
+            blueprint.reimport_batch([dataset['id']], base_context)
+
+        current_objects = Session.query(HarvestObject) \
+            .filter(HarvestObject.package_id.in_([dataset['id'] for dataset in datasets])) \
+            .filter(HarvestObject.current == True) \
+            .all()
+        assert len(current_objects) == len(datasets) == 3
+        reimport_jobs = set(harvest_object.job for harvest_object in current_objects)
+        assert len(reimport_jobs) == 1
+        reimport_job = reimport_jobs.pop()
+        assert reimport_job.id != job.id
+        assert reimport_job.status == 'Finished'
+        assert helpers.is_reimport_job(reimport_job)
+        assert not helpers.is_reimport_job(job)
+
+    @pytest.mark.ckan_config('ckanext.fisbroker.reimport.daily_job', 'true')
+    def test_daily_reimport_job_is_finished_by_the_last_reimport(self, app, base_context):
+        '''The rolling reimport job of a day stays running until the last of the
+           reimports that share it has finished.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+
+        first_job = blueprint.start_reimport_job(base_context.copy(), source.id)
+        second_job = blueprint.start_reimport_job(base_context.copy(), source.id)
+        assert first_job.id == second_job.id
+
+        blueprint._finish_reimport_job(first_job)
+        assert first_job.status == 'Running'
+        blueprint._finish_reimport_job(second_job)
+        assert second_job.status == 'Finished'
+
+    def test_reprocess_batch_uses_stored_content(self, app, base_context):
+        '''A batch reprocess imports the stored content of the current harvest
+           object again, in a new job, and makes the new object current.'''
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        harvest_object = self._run_job_for_single_document(job, WFS_FIXTURE['object_id'])
+        package_id = harvest_object.package_id
+
+        reprocessed, errors = blueprint.reprocess_batch([package_id, 'dunk'], base_context, workers=2)
+
+        assert reprocessed == {package_id: WFS_FIXTURE['object_id']}
+        assert isinstance(errors['dunk'], fb_exceptions.PackageIdDoesNotExistError)
+        Session.refresh(harvest_object)
+        assert not harvest_object.current
+        current_object = Session.query(HarvestObject) \
+            .filter(HarvestObject.package_id == package_id) \
+            .filter(HarvestObject.current == True) \
+            .one()
+        assert current_object.harvest_job_id != job.id
+        assert current_object.content == harvest_object.content
+
+    def test_reprocess_batch_reports_package_not_harvested_by_fbharvester(self, app, base_context):
+        '''A package without a current FIS-Broker harvest object is reported
+           as not harvested by ckanext-fisbroker.'''
+        non_fb_dataset_dict = ckan_factories.Dataset()
+        package_id = non_fb_dataset_dict['id']
+
+        reprocessed, errors = blueprint.reprocess_batch([package_id], base_context)
+
+        assert reprocessed == {}
+        assert isinstance(errors[package_id], fb_exceptions.PackageNotHarvestedInFisbrokerError)
+
+    def test_reprocess_batch_in_chunks(self, app, base_context, monkeypatch):
+        '''A batch reprocess handles the packages in chunks, all of them in one
+           reimport job per harvest source.'''
+        monkeypatch.setattr(blueprint, 'REPROCESS_CHUNK_SIZE', 2)
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+        package_ids = [dataset['id'] for dataset in datasets]
+
+        reprocessed, errors = blueprint.reprocess_batch(package_ids + ['dunk'], base_context, workers=1)
+
+        assert sorted(reprocessed.keys()) == sorted(package_ids)
+        assert list(errors.keys()) == ['dunk']
+        current_objects = Session.query(HarvestObject) \
+            .filter(HarvestObject.package_id.in_(package_ids)) \
+            .filter(HarvestObject.current == True) \
+            .all()
+        reimport_jobs = set(harvest_object.job for harvest_object in current_objects)
+        assert len(reimport_jobs) == 1
+        assert reimport_jobs.pop().status == 'Finished'
+
 class DummyHarvester(SingletonPlugin):
     '''A dummy harvester for testing purposes.'''
 
@@ -4,17 +4,22 @@
 import copy
 import json
 import logging
+import os
+import shutil
+import tarfile
 import pytest
 
 from ckan.cli.cli import ckan
 from ckan.logic.action.update import package_update
+from ckan.model import Package, Session
+from ckan.tests import factories as ckan_factories
 
 from ckanext.harvest.queue import gather_stage, fetch_and_import_stages
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestObject, HarvestSource
 
 from ckanext.spatial.tests.conftest import harvest_setup
 
-from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker import HARVESTER_ID, GUID_EXTRA, HARVESTER_TYPE_EXTRA
 from ckanext.fisbroker.cli import fisbroker
 from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
 from ckanext.fisbroker.tests import FisbrokerTestBase, base_context, FISBROKER_HARVESTER_CONFIG, WFS_FIXTURE, FISBROKER_PLUGIN
@@ -98,6 +103,23 @@ class TestCli(FisbrokerTestBase):
         assert wrong_id in result_data
         assert len(result_data[wrong_id]) == 0
 
+    def test_list_datasets_jsonl(self, cli, base_context):
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        self._run_job_for_single_document(job, WFS_FIXTURE['object_id'])
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'list-datasets', '--format', 'jsonl'])
+        assert result.exit_code == 0
+        lines = [json.loads(line) for line in result.stdout.splitlines()]
+        assert len(lines) == 1
+        assert lines[0]['source'] == source.id
+        assert set(lines[0]) == {'source', 'id', 'name', 'title'}
+
+        # the offset is applied by the search index
+        result = cli.invoke(ckan, ['fisbroker', 'list-datasets', '--format', 'jsonl', '--offset', '1'])
+        assert result.exit_code == 0
+        assert result.stdout == ""
+
     def test_harvest_objects_none(self, cli):
         result = cli.invoke(ckan, ['fisbroker', 'harvest-objects'])
         assert result.exit_code == 0
@@ -123,6 +145,33 @@ class TestCli(FisbrokerTestBase):
         assert len(result_data[source.id]) == 1
         assert result_data[source.id][0]['csw_guid'] == WFS_FIXTURE['object_id']
 
+    def test_harvest_objects_formats_and_filters(self, cli, base_context):
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        self._run_job_for_single_document(job, WFS_FIXTURE['object_id'])
+        guid = WFS_FIXTURE['object_id']
+
+        result = cli.invoke(ckan, ['fisbroker', 'harvest-objects', '--format', 'jsonl', '--guid-prefix', guid[:4]])
+        assert result.exit_code == 0
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        assert len(lines) == 1
+        assert lines[0]['source'] == source.id
+        assert lines[0]['csw_guid'] == guid
+
+        result = cli.invoke(ckan, ['fisbroker', 'harvest-objects', '--format', 'csv'])
+        assert result.exit_code == 0
+        rows = result.output.splitlines()
+        assert rows[0] == "source,csw_guid,package_id"
+        assert len(rows) == 2
+        assert rows[1].startswith(f"{source.id},{guid},")
+
+        result = cli.invoke(ckan, ['fisbroker', 'harvest-objects', '--format', 'jsonl', '--guid-prefix', 'no-such-guid'])
+        assert result.exit_code == 0
+        assert result.output == ""
+
+        result = cli.invoke(ckan, ['fisbroker', 'harvest-objects', '--format', 'jsonl', '--status', 'errored'])
+        assert result.exit_code == 0
+        assert result.output == ""
+
     def test_list_datasets_berlinsource_none(self, cli):
         result = cli.invoke(ckan, ['fisbroker', 'list-datasets-berlin-source'])
         assert result.exit_code == 0
@@ -142,6 +191,23 @@ class TestCli(FisbrokerTestBase):
         result_data = json.loads(result.output)
         assert len(result_data) == 1
 
+    def test_list_datasets_berlinsource_filters_in_database(self, cli, base_context):
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        self._run_job_for_single_document(job, WFS_FIXTURE['object_id'])
+        ckan_factories.Dataset(extras=[{'key': 'berlin_source', 'value': 'simplesearch'}])
+
+        result = cli.invoke(ckan, ['fisbroker', 'list-datasets-berlin-source', '--format', 'jsonl'])
+        assert result.exit_code == 0
+        lines = [json.loads(line) for line in result.output.splitlines()]
+        assert len(lines) == 1
+        assert lines[0]['title'] == "Nährstoffversorgung des Oberbodens 2015 (Umweltatlas) - [WFS]"
+
+        result = cli.invoke(ckan, ['fisbroker', 'list-datasets-berlin-source', '-b', 'simplesearch'])
+        assert result.exit_code == 0
+        result_data = json.loads(result.output)
+        assert len(result_data) == 1
+        assert set(result_data[0]) == {'id', 'name', 'title'}
+
     @pytest.mark.parametrize("parameters", [
         'fisbroker last-successful-job',
         'fisbroker last-successful-job --source {}',
@@ -237,3 +303,183 @@ class TestCli(FisbrokerTestBase):
             assert 'fisbroker_guid' in metadata
             assert 'title' in metadata
 
+
+    def test_reimport_cli_continues_after_failure_and_resumes(self, cli, base_context, tmp_path):
+        '''A dataset that cannot be reimported is reported, the other datasets
+           are reimported nevertheless. With --resume, only the datasets that
+           failed are reimported again.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+        missing_dataset = datasets[1]
+        harvest_object = Session.query(HarvestObject).filter_by(package_id=missing_dataset['id']).one()
+        harvest_object.guid = 'dunk'
+        harvest_object.save()
+        checkpoint = str(tmp_path / 'checkpoint.jsonl')
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'reimport-dataset', '--checkpoint', checkpoint])
+
+        assert result.exit_code == 0
+        result_data = json.loads(result.stdout)
+        assert sorted(result_data['datasets'].keys()) == sorted([datasets[0]['id'], datasets[2]['id']])
+        assert len(result_data['errors']) == 1
+        with open(checkpoint) as checkpoint_file:
+            entries = [json.loads(line) for line in checkpoint_file]
+        assert {entry['package_id']: entry['success'] for entry in entries} == {
+            datasets[0]['id']: True,
+            missing_dataset['id']: False,
+            datasets[2]['id']: True,
+        }
+
+        result = cli.invoke(ckan, ['fisbroker', 'reimport-dataset', '--checkpoint', checkpoint, '--resume'])
+
+        assert result.exit_code == 0
+        result_data = json.loads(result.stdout)
+        assert result_data['datasets'] == {}
+        assert len(result_data['errors']) == 1
+        assert 'dunk' in result_data['errors'][0]
+
+    def test_reimport_cli_workers(self, cli, base_context):
+        '''With several workers, the batches are reimported in worker processes,
+           progress and timings are reported on STDERR.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=4)
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'reimport-dataset', '--workers', '2', '--batch-size', '2'])
+
+        assert result.exit_code == 0
+        result_data = json.loads(result.stdout)
+        assert sorted(result_data['datasets'].keys()) == sorted(dataset['id'] for dataset in datasets)
+        assert all('seconds' in metadata for metadata in result_data['datasets'].values())
+        assert "reimported 5/5 datasets (0 errors)" in result.stderr
+        assert "seconds per dataset" in result.stderr
+
+    def test_get_record_batch(self, cli, base_context):
+        '''Several records are fetched with one client and written as JSON Lines
+           in the order of the ids, missing records are reported.'''
+        self._create_source()
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'get-record', '--format', 'iso',
+                                   '-r', 'record_00', '-r', 'dunk', '--records-file', '-'],
+                            input="record_01\n\n")
+
+        assert result.exit_code == 0
+        lines = [json.loads(line) for line in result.stdout.splitlines()]
+        assert [line['guid'] for line in lines] == ['record_00', 'dunk', 'record_01']
+        assert [line['status'] for line in lines] == ['ok', 'not_found', 'ok']
+        assert lines[2]['iso_values']['guid'] == 'record_01'
+
+    def test_get_record_package(self, cli, base_context):
+        '''The package dict of a record carries the record's guid, for a single
+           record as well as for several.'''
+        self._create_source()
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'get-record', '--format', 'package', '-r', 'record_00'])
+
+        assert result.exit_code == 0
+        package_dict = json.loads(result.stdout)
+        extras = {extra['key']: extra['value'] for extra in package_dict['extras']}
+        assert extras[GUID_EXTRA] == 'record_00'
+        assert extras[HARVESTER_TYPE_EXTRA] == HARVESTER_ID
+
+        result = cli.invoke(ckan, ['fisbroker', 'get-record', '--format', 'package',
+                                   '-r', 'record_00', '-r', 'record_01'])
+
+        assert result.exit_code == 0
+        lines = [json.loads(line) for line in result.stdout.splitlines()]
+        assert [line['status'] for line in lines] == ['ok', 'ok']
+        for line in lines:
+            extras = {extra['key']: extra['value'] for extra in line['package']['extras']}
+            assert extras[GUID_EXTRA] == line['guid']
+
+    def test_benchmark(self, cli, base_context):
+        '''The benchmark harvests the synthetic records end to end and removes
+           its harvest source afterwards.'''
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'benchmark', '--records', '3', '--port', '8997', '--yes'])
+
+        assert result.exit_code == 0
+        result_data = json.loads(result.stdout)
+        assert result_data['records'] == 3
+        assert sorted(result_data['stages']) == ['fetch', 'gather', 'import']
+        for stage in result_data['stages'].values():
+            assert stage['records'] == 3
+            assert stage['failures'] == 0
+            assert stage['queries'] > 0
+            assert stage['latency_p95'] >= stage['latency_p50']
+            assert stage['peak_rss_growth_kb'] >= 0
+        assert result_data['process_peak_rss_kb'] > 0
+        assert Session.query(HarvestObject).count() == 0
+
+    def test_benchmark_asks_for_confirmation(self, cli, base_context):
+        '''Without --yes, the benchmark doesn't write anything unless it is
+           confirmed.'''
+        result = cli.invoke(ckan, ['fisbroker', 'benchmark', '--records', '3', '--port', '8997'], input="n\n")
+
+        assert result.exit_code != 0
+        assert Session.query(HarvestSource).count() == 0
+
+    def test_backfill_extras(self, cli, base_context):
+        '''Datasets without the FIS-Broker extras get them from their current
+           harvest object, datasets that have them are left alone.'''
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'backfill-extras'])
+
+        assert result.exit_code == 0
+        assert sorted(json.loads(result.stdout)['datasets']) == sorted(dataset['id'] for dataset in datasets)
+        for index, dataset in enumerate(datasets):
+            package = Package.get(dataset['id'])
+            assert package.extras[GUID_EXTRA] == f"record_{index:02d}"
+            assert package.extras[HARVESTER_TYPE_EXTRA] == HARVESTER_ID
+
+        result = cli.invoke(ckan, ['fisbroker', 'backfill-extras'])
+
+        assert result.exit_code == 0
+        assert json.loads(result.stdout)['datasets'] == []
+
+    def test_reprocess_cli_single_dataset(self, cli, base_context):
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        harvest_object = self._run_job_for_single_document(job, WFS_FIXTURE['object_id'])
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'reprocess-dataset', '--datasetid', harvest_object.package_id])
+
+        assert result.exit_code == 0
+        result_data = json.loads(result.stdout)
+        assert result_data['errors'] == []
+        assert result_data['datasets'] == {
+            harvest_object.package_id: {'fisbroker_guid': WFS_FIXTURE['object_id']}
+        }
+
+    @pytest.mark.parametrize("as_archive", [ False, True ])
+    def test_transform_records(self, cli, tmp_path, as_archive: bool):
+        xml_dir = os.path.join(os.path.dirname(__file__), 'xml')
+        records_dir = tmp_path / 'records'
+        records_dir.mkdir()
+        for filename in ['wfs-open-data.xml', 'wfs-closed-data.xml']:
+            shutil.copy(os.path.join(xml_dir, filename), records_dir / filename)
+        path = records_dir
+        if as_archive:
+            path = tmp_path / 'records.tar.gz'
+            with tarfile.open(path, 'w:gz') as archive:
+                archive.add(records_dir, arcname='records')
+
+        cli.mix_stderr = False
+        result = cli.invoke(ckan, ['fisbroker', 'transform', str(path), '--workers', '2'])
+
+        assert result.exit_code == 0
+        lines = [json.loads(line) for line in result.stdout.splitlines()]
+        assert len(lines) == 2
+        closed, open_data = lines
+        assert closed['file'].endswith('wfs-closed-data.xml')
+        assert closed['status'] == 'skipped'
+        assert open_data['file'].endswith('wfs-open-data.xml')
+        assert open_data['status'] == 'ok'
+        assert open_data['guid'] == WFS_FIXTURE['object_id']
+        assert open_data['package']['name'] == "nahrstoffversorgung-des-oberbodens-2015-umweltatlas-wfs-65715c6e"
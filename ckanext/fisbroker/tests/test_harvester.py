@@ -8,10 +8,11 @@ import os
 import pytest
 
 from owslib.fes import PropertyIsGreaterThanOrEqualTo
+from sqlalchemy import event
 
 from ckan.logic import get_action
 from ckan.logic.action.update import package_update
-from ckan.model import Package, Session
+from ckan.model import Activity, Package, Session
 import ckan.tests.factories as factories
 
 from ckanext.harvest.queue import (
@@ -27,7 +28,7 @@ from ckanext.harvest.tests import factories as harvest_factories
 from ckanext.spatial.harvesters.base import SpatialHarvester
 from ckanext.spatial.harvested_metadata import ISODocument
 
-from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker import HARVESTER_ID, GUID_EXTRA, HARVESTER_TYPE_EXTRA, MAPPING_VERSION, MAPPING_VERSION_EXTRA
 from ckanext.fisbroker.fisbroker_harvester import (
     FisbrokerHarvester,
     marked_as_opendata,
@@ -41,8 +42,9 @@ from ckanext.fisbroker.fisbroker_harvester import (
     TIMEOUT_DEFAULT,
     TIMEDELTA_DEFAULT,
 )
+from ckanext.fisbroker.import_index import ImportIndex
 from ckanext.fisbroker.tests import FisbrokerTestBase, base_context, WFS_FIXTURE, FISBROKER_PLUGIN
-from ckanext.fisbroker.tests.mock_fis_broker import reset_mock_server
+from ckanext.fisbroker.tests.mock_fis_broker import reset_mock_server, VALID_GUID
 
 LOG = logging.getLogger(__name__)
 
@@ -613,6 +615,117 @@ class TestHarvester(FisbrokerTestBase):
         # berlin_source etc.)
         assert package.maintainer == "Hr. Dr. Thelemann"
         assert package.extras['berlin_source'] == 'harvest-fisbroker'
+        assert package.extras[MAPPING_VERSION_EXTRA] == MAPPING_VERSION
+        assert package.extras[GUID_EXTRA] == harvest_object.guid
+        assert package.extras[HARVESTER_TYPE_EXTRA] == HARVESTER_ID
+
+    def test_import_index_is_updated_during_import(self, app, base_context):
+        '''The import index is loaded for the job that is being imported, and it
+           reflects the objects and packages created during the import.'''
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        harvest_object = self._run_job_for_single_document(job, WFS_FIXTURE['object_id'])
+
+        index = ImportIndex.for_job(job.id)
+        assert index.harvest_job_id == job.id
+        assert index.current_object_id(WFS_FIXTURE['object_id']) == harvest_object.id
+        assert index.previous_object(WFS_FIXTURE['object_id']).id == harvest_object.id
+
+        package = index.package_by_id(harvest_object.package_id)
+        assert package.name == "nahrstoffversorgung-des-oberbodens-2015-umweltatlas-wfs-65715c6e"
+        assert index.package_by_name(package.name) == package
+
+    def test_import_index_loads_current_objects(self, app, base_context):
+        '''A freshly loaded import index knows the current objects and packages
+           that are already in the database.'''
+        fb_dataset_dict, source, job = self._harvester_setup()
+        new_job = self._create_job(source.id)
+        harvest_object = harvest_factories.HarvestObjectObj(guid=VALID_GUID,
+                                                            job=new_job,
+                                                            source=source,
+                                                            package_id=fb_dataset_dict['id'])
+
+        index = ImportIndex.load(new_job.id)
+        previous_object = index.previous_object(VALID_GUID)
+        assert previous_object
+        assert previous_object.harvest_job_id == job.id
+        assert index.package_by_name(fb_dataset_dict['name']).id == fb_dataset_dict['id']
+        assert index.package_by_id(fb_dataset_dict['id']).state == 'active'
+        assert index.previous_object('unknown-guid') is None
+
+    def test_import_index_is_limited_to_the_job(self, app, base_context):
+        '''The import index only loads the current objects with the guids of the
+           job's objects, and looks up other guids and packages when they are
+           asked for.'''
+        fb_dataset_dict, source, job = self._harvester_setup()
+        new_job = self._create_job(source.id)
+
+        index = ImportIndex.load(new_job.id)
+        assert VALID_GUID not in index._previous_objects
+        assert fb_dataset_dict['id'] not in index._packages_by_id
+
+        assert index.previous_object(VALID_GUID).harvest_job_id == job.id
+        assert index.package_by_name(fb_dataset_dict['name']).id == fb_dataset_dict['id']
+        assert VALID_GUID in index._previous_objects
+
+    def test_import_index_remembers_misses(self, app, base_context):
+        '''Guids of the job without a current object are known to be new when the
+           index is loaded, and guids and names that were looked up without
+           result are not looked up again.'''
+        fb_dataset_dict, source, job = self._harvester_setup()
+        new_job = self._create_job(source.id)
+        harvest_factories.HarvestObjectObj(guid='new-guid', job=new_job, source=source)
+
+        index = ImportIndex.load(new_job.id)
+        assert 'new-guid' in index._previous_objects
+
+        queries = []
+        listener = lambda *args, **kwargs: queries.append(args)
+        event.listen(Session.get_bind(), 'before_cursor_execute', listener)
+        try:
+            assert index.previous_object('new-guid') is None
+            assert index.current_object_id('new-guid') is None
+            assert index.previous_object('unknown-guid') is None
+            assert index.previous_object('unknown-guid') is None
+            index.load_names(['unknown-name', fb_dataset_dict['name']])
+            assert index.package_by_name('unknown-name') is None
+            assert index.package_by_name(fb_dataset_dict['name']).id == fb_dataset_dict['id']
+        finally:
+            event.remove(Session.get_bind(), 'before_cursor_execute', listener)
+        # one lookup of 'unknown-guid' and one query for the names
+        assert len(queries) == 2
+
+    def test_deleted_packages_are_deleted_in_bulk(self, app, base_context):
+        '''Importing the first delete object of a job deletes the packages of all
+           delete objects of that job and removes them from the search index.'''
+        source, job = self._create_source_and_job()
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+
+        delete_job = self._create_job(source.id)
+        delete_objects = []
+        for index, dataset in enumerate(datasets):
+            harvest_object = HarvestObject(guid=f"record_{index:02d}",
+                                           job=delete_job,
+                                           package_id=dataset['id'],
+                                           extras=[HarvestObjectExtra(key='status', value='delete')])
+            harvest_object.save()
+            delete_objects.append(harvest_object)
+
+        harvester = FisbrokerHarvester()
+        assert harvester.import_stage(delete_objects[0])
+        for dataset in datasets:
+            assert Package.get(dataset['id']).state == 'deleted'
+            result = get_action('package_search')({}, {'q': f"name:{dataset['name']}"})
+            assert result['count'] == 0
+            # like package_delete, the bulk deletion records an activity
+            activities = Session.query(Activity) \
+                .filter(Activity.object_id == dataset['id']) \
+                .filter(Activity.activity_type == 'deleted package') \
+                .count()
+            assert activities == 1
+
+        # the other delete objects have nothing left to do
+        for harvest_object in delete_objects[1:]:
+            assert harvester.import_stage(harvest_object)
 
     def test_empty_config(self):
         '''Test that an empty config just returns unchanged.'''
@@ -816,6 +929,76 @@ class TestHarvester(FisbrokerTestBase):
         # job_a should be the last error free job:
         assert last_error_free_job.id == job_a.id
 
+    def test_last_error_free_job_is_updated_when_a_job_finishes(self, app, base_context):
+        '''The last error-free job is remembered for the source, but a job
+           that finishes afterwards is taken into account.'''
+
+        source, job_a = self._create_source_and_job()
+        job_a.gather_started = datetime.now()
+        job_a.status = 'Finished'
+        job_a.save()
+
+        job_b = self._create_job(source.id)
+        assert FisbrokerHarvester().last_error_free_job(job_b).id == job_a.id
+        assert FisbrokerHarvester().last_error_free_job(job_b).id == job_a.id
+
+        job_b.gather_started = datetime.now()
+        job_b.status = 'Finished'
+        job_b.save()
+
+        new_job = self._create_job(source.id)
+        assert FisbrokerHarvester().last_error_free_job(new_job).id == job_b.id
+
+    def _finish_job_with_objects(self, job, objects):
+        '''Add a harvest object for every (guid, modified date, success) tuple
+           in `objects` to `job`, record its result for the watermark and mark
+           the job as finished.'''
+        for guid, modified, success in objects:
+            harvest_object = harvest_factories.HarvestObjectObj(guid=guid, job=job, source=job.source)
+            harvest_object.metadata_modified_date = modified
+            harvest_object.current = success
+            harvest_object.report_status = 'added' if success else 'errored'
+            harvest_object.save()
+            FisbrokerHarvester.record_watermark_result(harvest_object, success)
+        job.status = 'Finished'
+        job.save()
+
+    def test_watermark_stays_below_failed_records(self, app, base_context):
+        '''With `import_since: watermark`, the import_since date is the latest
+           modified date of the successfully harvested records, but stays below
+           the earliest record that failed until it was harvested successfully.'''
+
+        FisbrokerHarvester().source_config = {'import_since': 'watermark'}
+        source, job_0 = self._create_source_and_job()
+        job_0.gather_started = datetime.utcnow()
+        self._finish_job_with_objects(job_0, [])
+
+        # no watermark yet, fall back to the last error-free job
+        job_1 = self._create_job(source.id)
+        job_1.gather_started = datetime.utcnow()
+        job_1.save()
+        assert FisbrokerHarvester().get_import_since_date(job_1) == \
+            job_0.gather_started.strftime("%Y-%m-%dT%H:%M:%S%z")
+        self._finish_job_with_objects(job_1, [
+            ('a', datetime(2019, 11, 20), True),
+            ('b', datetime(2019, 11, 21), False),
+            ('c', datetime(2019, 11, 22), True),
+        ])
+
+        job_2 = self._create_job(source.id)
+        job_2.gather_started = datetime.utcnow()
+        job_2.save()
+        assert FisbrokerHarvester().get_import_since_date(job_2) == "2019-11-20T00:00:00"
+        self._finish_job_with_objects(job_2, [
+            ('b', datetime(2019, 11, 21), True),
+            ('c', datetime(2019, 11, 22), True),
+        ])
+
+        job_3 = self._create_job(source.id)
+        job_3.gather_started = datetime.utcnow()
+        job_3.save()
+        assert FisbrokerHarvester().get_import_since_date(job_3) == "2019-11-22T00:00:00"
+
     def test_import_since_date_is_none_if_no_jobs(self, base_context):
         '''Test that, if the `import_since` setting is `last_error_free`, but
         no jobs have run successfully (or at all), get_import_since_date()
@@ -9,7 +9,7 @@ from ckan.logic import get_action
 from ckan.model.package import Package
 from ckan.tests import factories as ckan_factories
 
-from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker import HARVESTER_ID, MAPPING_VERSION, MAPPING_VERSION_EXTRA
 from ckanext.fisbroker.helper import (
     normalize_url,
     uniq_resources_by_url,
@@ -18,8 +18,15 @@ from ckanext.fisbroker.helper import (
     harvester_for_package,
     fisbroker_guid,
     get_package_object,
+    harvest_info_for_packages,
+    fisbroker_package_info,
+    fisbroker_sources,
+    get_fisbroker_source,
+    mapping_version_key,
+    outdated_packages,
 )
-from ckanext.fisbroker.tests import FisbrokerTestBase, base_context, FISBROKER_HARVESTER_CONFIG, FISBROKER_PLUGIN
+from ckanext.fisbroker.tests import FisbrokerTestBase, base_context, FISBROKER_HARVESTER_CONFIG, FISBROKER_PLUGIN, WFS_FIXTURE
+from ckanext.fisbroker.tests.mock_fis_broker import VALID_GUID
 
 LOG = logging.getLogger(__name__)
 GETCAPABILITIES_URL_1 = 'https://fbinter.stadt-berlin.de/fb/wfs/data/senstadt/s01_11_07naehr2015?request=getcapabilities&service=wfs&version=2.0.0'
@@ -118,3 +125,77 @@ class TestHelper(FisbrokerTestBase):
 
         assert fisbroker_guid(get_package_object(fb_dataset_dict)) == fisbroker_fixture['object_id']
         assert not fisbroker_guid(get_package_object(non_fb_dataset_dict))
+
+    def test_mapping_version_key(self):
+        """Missing mapping versions come first, then versions are ordered by
+           release and mapping revision."""
+        versions = ['1.10.0+1', '1.5.2+2', None, '1.5.2+1', '1.5.2']
+        assert sorted(versions, key=mapping_version_key) == [None, '1.5.2', '1.5.2+1', '1.5.2+2', '1.10.0+1']
+
+    def test_outdated_packages(self, app, base_context):
+        """Only FIS-Broker packages that were not mapped by the current mapping
+           version are outdated, oldest first."""
+        source, job = self._create_source_and_job(FISBROKER_HARVESTER_CONFIG)
+        datasets = self._create_mock_data(source, job, first=0, last=2)
+        versions = ['0.9.0+1', MAPPING_VERSION, None]
+        for dataset, version in zip(datasets, versions):
+            if version:
+                dataset['extras'] = [{'key': MAPPING_VERSION_EXTRA, 'value': version}]
+                get_action('package_update')(base_context, dataset)
+        ckan_factories.Dataset()
+
+        assert outdated_packages() == [datasets[2]['id'], datasets[0]['id']]
+
+    def test_harvest_info_for_packages(self, app, base_context):
+        """Package ids and names are resolved to the guid and harvest source of
+           their current harvest object, unknown ids are left out."""
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        non_fb_dataset_dict = ckan_factories.Dataset()
+
+        infos = harvest_info_for_packages([fb_dataset_dict['name'], non_fb_dataset_dict['id'], 'dunk'])
+
+        info = infos[fb_dataset_dict['name']]
+        assert info.package_id == fb_dataset_dict['id']
+        assert info.guid == VALID_GUID
+        assert info.source_id == source.id
+        assert info.source_type == HARVESTER_ID
+        assert info.source_url == FISBROKER_HARVESTER_CONFIG['url']
+        assert infos[non_fb_dataset_dict['id']].source_id is None
+        assert 'dunk' not in infos
+
+    def test_fisbroker_package_info_is_memoised_per_request(self, app, base_context):
+        """fisbroker_package_info() returns the harvest info of FIS-Broker packages
+           only, and looks up each package only once per request."""
+        fb_dataset_dict, source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        non_fb_dataset_dict = ckan_factories.Dataset()
+
+        with app.flask_app.test_request_context():
+            info = fisbroker_package_info(fb_dataset_dict['id'])
+            assert info.guid == VALID_GUID
+            assert info.source_type == HARVESTER_ID
+            assert fisbroker_package_info(non_fb_dataset_dict['id']) is None
+
+            # a later change is not seen in the same request
+            source.type = 'dummyharvest'
+            source.save()
+            assert fisbroker_package_info(fb_dataset_dict['id']) is info
+
+        with app.flask_app.test_request_context():
+            assert fisbroker_package_info(fb_dataset_dict['id']) is None
+
+    def test_fisbroker_sources_are_cached_until_a_source_changes(self, app, base_context):
+        """The FIS-Broker sources are cached, creating or deleting a source
+           invalidates the cache."""
+        first_source = self._create_source(WFS_FIXTURE)
+        assert [source['id'] for source in fisbroker_sources()] == [first_source.id]
+        assert fisbroker_sources() is fisbroker_sources()
+
+        fb_dataset_dict, second_source, job = self._harvester_setup(FISBROKER_HARVESTER_CONFIG)
+        assert [source['id'] for source in fisbroker_sources()] == [first_source.id, second_source.id]
+
+        # the source of the package is preferred over the oldest source
+        assert get_fisbroker_source()['id'] == first_source.id
+        assert get_fisbroker_source(fb_dataset_dict['id'])['id'] == second_source.id
+
+        get_action('harvest_source_delete')(base_context.copy(), {'id': first_source.id})
+        assert [source['id'] for source in fisbroker_sources()] == [second_source.id]
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""Tests for transform.py."""
+
+import json
+import logging
+import os
+import pytest
+
+from ckan.model import Package, Session
+
+from ckanext.harvest.model import HarvestObject, HarvestObjectExtra
+
+from ckanext.fisbroker import HARVESTER_ID
+from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
+from ckanext.fisbroker.transform import (
+    DetachedHarvestObject,
+    DetachedMapper,
+    DetachedSource,
+    split_documents,
+    transform_many,
+)
+from ckanext.fisbroker.tests import FisbrokerTestBase, base_context, WFS_FIXTURE, FISBROKER_PLUGIN
+
+LOG = logging.getLogger(__name__)
+
+
+def _xml_fixture(xml_filename):
+    xml_filepath = os.path.join(os.path.dirname(__file__), 'xml', xml_filename)
+    with open(xml_filepath, 'rb') as f:
+        return f.read().decode('utf-8')
+
+
+@pytest.mark.ckan_config('ckan.plugins', f"{HARVESTER_ID} {FISBROKER_PLUGIN} harvest")
+@pytest.mark.usefixtures('with_plugins', 'clean_db', 'clean_index')
+class TestTransform(FisbrokerTestBase):
+    '''Tests for the database-free transformation of ISO documents.'''
+
+    def _detached_object(self, content):
+        return DetachedHarvestObject('object-id', None, content, source=DetachedSource('source-id'))
+
+    def _transform(self, content, owner_org=None):
+        '''Transform `content` with transform_detached() in a worker process.'''
+        return next(transform_many([(self._detached_object(content), owner_org)], workers=1))
+
+    def test_transform_open_data(self):
+        '''An open data service record is mapped to a FIS-Broker package dict.'''
+        result = self._transform(_xml_fixture('wfs-open-data.xml'), owner_org='org-id')
+
+        assert result['error'] is None
+        assert result['valid']
+        assert result['guid'] == WFS_FIXTURE['object_id']
+        package_dict = result['package_dict']
+        assert package_dict['owner_org'] == 'org-id'
+        assert package_dict['name'] == "nahrstoffversorgung-des-oberbodens-2015-umweltatlas-wfs-65715c6e"
+        assert package_dict['title'] == "Nährstoffversorgung des Oberbodens 2015 (Umweltatlas) - [WFS]"
+        assert package_dict['license_id'] == "dl-de-by-2.0"
+
+    def test_mapper_only_answers_the_source_lookup(self):
+        '''The mapper answers the lookup of the harvest source's dataset with its
+           owner organization only while the spatial mapping runs, other lookups
+           and Package.get() afterwards are left alone.'''
+        mapper = DetachedMapper(FisbrokerHarvester(), [], owner_org='org-id')
+        original = vars(Package)['get']
+
+        with mapper._source_dataset_lookup('source-id'):
+            assert Package.get('source-id').owner_org == 'org-id'
+            assert Package.get('unknown-package') is None
+        assert vars(Package)['get'] is original
+
+    def test_transform_closed_data_is_skipped(self):
+        '''A record that is not marked as open data is skipped, and the reason
+           is returned as an extra.'''
+        result = self._transform(_xml_fixture('wfs-closed-data.xml'))
+
+        assert result['error'] is None
+        assert result['package_dict'] == 'skip'
+        key, value = result['extras'][0]
+        assert key == 'error'
+        assert json.loads(value)['code'] == 1
+
+    def test_transform_invalid_document(self):
+        '''A document that cannot be parsed results in an error message.'''
+        result = self._transform("<gmd:MD_Metadata")
+
+        assert result['error'].startswith("Error parsing ISO document for object object-id")
+        assert result['package_dict'] is None
+
+    @pytest.mark.parametrize("xml_filename, num_documents", [
+        ('wfs-open-data.xml', 1),
+        ('65715c6e-bbaf-3def-982b-3b5156272da7.xml', 1),
+        ('csw_getrecords_01.xml', 3),
+    ])
+    def test_split_documents(self, xml_filename, num_documents):
+        '''Single ISO documents and CSW responses wrapping them are split into
+           ISO documents.'''
+        documents = split_documents(_xml_fixture(xml_filename))
+
+        assert len(documents) == num_documents
+        for document in documents:
+            assert document.startswith("<gmd:MD_Metadata")
+
+    def test_import_objects_in_worker_processes(self, app, base_context):
+        '''Harvest objects transformed in worker processes are imported like
+           objects imported through import_stage().'''
+        source, job = self._create_source_and_job(WFS_FIXTURE)
+        harvester = FisbrokerHarvester()
+        content = harvester._get_content_as_unicode(WFS_FIXTURE['url'])
+        harvest_object = HarvestObject(guid=WFS_FIXTURE['object_id'],
+                                       job=job,
+                                       content=content,
+                                       extras=[HarvestObjectExtra(key='status', value='new')])
+        harvest_object.save()
+
+        results = harvester.import_objects([harvest_object], workers=2)
+        assert results[harvest_object.id] is True
+
+        Session.refresh(harvest_object)
+        assert harvest_object.current
+        package = Package.get(harvest_object.package_id)
+        assert package.name == "nahrstoffversorgung-des-oberbodens-2015-umweltatlas-wfs-65715c6e"
@@ -0,0 +1,307 @@
+# coding: utf-8
+'''
+Transformation of FIS-Broker ISO documents into CKAN package dicts.
+
+Parsing the XML, reading the ISO values and mapping them to a package dict
+(`get_package_dict()` of the spatial harvester and all `ISpatialHarvester`
+plugins, including the FIS-Broker mapping) is CPU-bound and needs no database.
+This module provides that transformation as standalone functions, and a runner
+that maps it over many harvest objects in a pool of worker processes, so that
+`FisbrokerHarvester.import_transformed()` only has to write the results to the
+database.
+'''
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import hashlib
+import logging
+import os
+from types import SimpleNamespace
+
+import dateutil.parser
+from lxml import etree
+import six
+
+from ckan import model
+from ckan.lib.munge import munge_title_to_name
+import ckan.plugins as plugins
+
+from ckanext.spatial.harvested_metadata import ISODocument
+from ckanext.spatial.harvesters.base import SpatialHarvester
+from ckanext.spatial.interfaces import ISpatialHarvester
+
+LOG = logging.getLogger(__name__)
+MD_METADATA_TAG = '{http://www.isotc211.org/2005/gmd}MD_Metadata'
+# number of documents per worker that are sent to the pool ahead of the one
+# whose result is needed next
+WINDOW_PER_WORKER = 4
+
+
+class DetachedSource:
+    '''Stand-in for a HarvestSource that can be sent to a worker process.'''
+
+    def __init__(self, id, url=None, title=None, config=None):
+        self.id = id
+        self.url = url
+        self.title = title
+        self.config = config
+
+
+class DetachedJob:
+    '''Stand-in for a HarvestJob that can be sent to a worker process.'''
+
+    def __init__(self, id, source):
+        self.id = id
+        self.source = source
+
+
+class DetachedHarvestObject:
+    '''Stand-in for a HarvestObject that can be sent to a worker process. It
+       carries everything that `get_package_dict()` reads from a harvest object,
+       and collects the extras that are added to it during the mapping.'''
+
+    def __init__(self, id, guid, content, package_id=None, source=None, job=None):
+        self.id = id
+        self.guid = guid
+        self.content = content
+        self.package_id = package_id
+        self.package = None
+        self.source = source
+        self.job = job
+        self.extras = []
+
+    @classmethod
+    def from_harvest_object(cls, harvest_object):
+        '''Copy the relevant attributes of `harvest_object`.'''
+        source = harvest_object.source
+        detached_source = DetachedSource(source.id, source.url, source.title, source.config)
+        return cls(harvest_object.id,
+                   harvest_object.guid,
+                   harvest_object.content,
+                   package_id=harvest_object.package_id,
+                   source=detached_source,
+                   job=DetachedJob(harvest_object.harvest_job_id, detached_source))
+
+
+def split_documents(content):
+    '''Return the ISO documents in the XML `content` (bytes or str) as a list of
+       strings. `content` is either a single `gmd:MD_Metadata` document, or
+       wraps any number of them, like a CSW GetRecordById or GetRecords response.'''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    root = etree.fromstring(content)
+    if root.tag == MD_METADATA_TAG:
+        elements = [root]
+    else:
+        elements = root.iter(MD_METADATA_TAG)
+    return [etree.tostring(element, encoding='unicode') for element in elements]
+
+
+def parse_document(content):
+    '''Parse the ISO document `content`, return its ISO values and XML tree.'''
+    iso_parser = ISODocument(content)
+    return iso_parser.read_values(), iso_parser.xml_tree
+
+
+def effective_guid(guid, iso_values, content):
+    '''Return the guid that a harvest object with `guid` gets for the document
+       `content`: the guid of the document, else `guid`, else a hash of the content.'''
+    if iso_values['guid']:
+        return iso_values['guid']
+    if guid:
+        return guid
+    m = hashlib.md5()
+    m.update(content.encode('utf8', 'ignore'))
+    return m.hexdigest()
+
+
+def metadata_modified_date(iso_values):
+    '''Return the modification date of the document as a datetime, raise
+       ValueError if it cannot be parsed.'''
+    return dateutil.parser.parse(iso_values['metadata-date'], ignoretz=True)
+
+
+def map_document(harvester, context, iso_values, xml_tree, harvest_object):
+    '''Map the ISO values of a document to a package dict, by calling
+       `get_package_dict()` of `harvester` and of all ISpatialHarvester plugins.
+       Return the package dict, 'skip' or None, like `get_package_dict()`.'''
+    package_dict = harvester.get_package_dict(iso_values, harvest_object)
+    for plugin in plugins.PluginImplementations(ISpatialHarvester):
+        package_dict = plugin.get_package_dict(context, {
+            'package_dict': package_dict,
+            'iso_values': iso_values,
+            'xml_tree': xml_tree,
+            'harvest_object': harvest_object,
+        })
+    return package_dict
+
+
+class DetachedMapper:
+    '''Stand-in for the harvester in the mapping and validation of the spatial
+       harvester (`SpatialHarvester.get_package_dict()` and `_validate_document()`)
+       that does not access the database: package names are not checked for
+       uniqueness (the FIS-Broker mapping generates its own names anyway),
+       the owner organization is `owner_org` instead of the one of the harvest
+       source's dataset, and object errors are appended to `errors` as
+       (message, stage) tuples instead of being saved. Everything else is
+       delegated to `harvester`.'''
+
+    extent_template = SpatialHarvester.extent_template
+
+    def __init__(self, harvester, errors, owner_org=None):
+        self.harvester = harvester
+        self.source_config = harvester.source_config
+        self.errors = errors
+        self.owner_org = owner_org
+
+    def get_package_dict(self, iso_values, harvest_object):
+        with self._source_dataset_lookup(harvest_object.source.id):
+            return SpatialHarvester.get_package_dict(self, iso_values, harvest_object)
+
+    @contextlib.contextmanager
+    def _source_dataset_lookup(self, source_id):
+        '''SpatialHarvester.get_package_dict() reads the owner organization with
+           `Package.get()` from the dataset of the harvest source. While the
+           enclosed call runs, answer that lookup with `owner_org`; all other
+           lookups are passed on to the original `Package.get()`, which is
+           restored afterwards.'''
+        original = vars(model.Package).get('get')
+        lookup = model.Package.get
+        owner_org = self.owner_org
+
+        def get(cls, reference, for_update=False):
+            if reference == source_id:
+                return SimpleNamespace(owner_org=owner_org)
+            return lookup(reference, for_update=for_update)
+
+        model.Package.get = classmethod(get)
+        try:
+            yield
+        finally:
+            if original is None:
+                del model.Package.get
+            else:
+                model.Package.get = original
+
+    def validate_document(self, harvest_object):
+        '''Validate the content of `harvest_object`, return True if it is valid.'''
+        is_valid, profile, errors = SpatialHarvester._validate_document(self, harvest_object.content, harvest_object)
+        return is_valid
+
+    def _save_object_error(self, message, harvest_object, stage=u'Fetch', line=None):
+        self.errors.append((message, stage))
+
+    def _gen_new_name(self, title, *args, **kwargs):
+        return munge_title_to_name(title)
+
+    def _get_user_name(self):
+        # only used for the context of `license_list`, which doesn't need a user
+        return ''
+
+    def _get_validator(self):
+        return self.harvester._get_validator()
+
+    def _is_wms(self, url):
+        return self.harvester._is_wms(url)
+
+
+def transform_detached(harvest_object, owner_org=None):
+    '''Transform the content of the DetachedHarvestObject `harvest_object` of a
+       harvest source that belongs to the organization `owner_org` into a package
+       dict, without accessing the database. Only call this in a worker process of
+       `transform_many()`. Return a dict with the following members:
+
+       - `error`: an error message if the document could not be parsed, else None
+       - `valid`: whether the document passed the validation
+       - `validation_errors`: (message, stage) tuples of the validation errors
+       - `guid`: the guid that the harvest object gets
+       - `iso_values`: the ISO values of the document
+       - `package_dict`: the result of the mapping (a dict, 'skip' or None)
+       - `extras`: (key, value) tuples of the extras added during the mapping
+       - `errors`: (message, stage) tuples of the object errors raised during the mapping'''
+
+    from ckanext.fisbroker.fisbroker_harvester import FisbrokerHarvester
+
+    result = {
+        'error': None,
+        'valid': False,
+        'validation_errors': [],
+        'guid': harvest_object.guid,
+        'iso_values': None,
+        'package_dict': None,
+        'extras': [],
+        'errors': [],
+    }
+
+    harvester = FisbrokerHarvester()
+    harvester._set_source_config(harvest_object.source.config)
+
+    result['valid'] = DetachedMapper(harvester, result['validation_errors']).validate_document(harvest_object)
+
+    try:
+        iso_values, xml_tree = parse_document(harvest_object.content)
+    except Exception as e:
+        result['error'] = f"Error parsing ISO document for object {harvest_object.id}: {six.text_type(e)}"
+        return result
+
+    harvest_object.guid = effective_guid(harvest_object.guid, iso_values, harvest_object.content)
+    result['guid'] = harvest_object.guid
+    result['iso_values'] = iso_values
+
+    mapper = DetachedMapper(harvester, result['errors'], owner_org)
+    result['package_dict'] = map_document(mapper, {'model': model}, iso_values, xml_tree, harvest_object)
+    result['extras'] = [(extra.key, extra.value) for extra in harvest_object.extras]
+
+    return result
+
+
+def transform_many(payloads, workers=None):
+    '''Transform all (detached_object, owner_org) tuples in `payloads` with
+       `transform_detached()` in a pool of `workers` worker processes (default:
+       one per CPU). Yield the results in the order of `payloads`. `payloads` is
+       consumed lazily, only a few documents per worker are in flight at any time.'''
+
+    workers = workers or os.cpu_count()
+    window = workers * WINDOW_PER_WORKER
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for payload in payloads:
+            pending.append(executor.submit(transform_detached, *payload))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def transform_objects(harvest_objects, workers=None):
+    '''Transform the content of all `harvest_objects` in a pool of `workers`
+       worker processes (default: one per CPU). Yield (harvest_object, result)
+       tuples in the order of `harvest_objects`, where result is the dict returned
+       by `transform_detached()`, or None for objects without content.
+       `harvest_objects` is consumed lazily, like the payloads of `transform_many()`.'''
+
+    owner_orgs = {}
+    # the objects that were taken from harvest_objects, but not yielded yet
+    pending = deque()
+
+    def payloads():
+        for harvest_object in harvest_objects:
+            pending.append(harvest_object)
+            if harvest_object.content is None:
+                continue
+            source_id = harvest_object.source.id
+            if source_id not in owner_orgs:
+                source_dataset = model.Package.get(source_id)
+                owner_orgs[source_id] = source_dataset.owner_org if source_dataset else None
+            yield DetachedHarvestObject.from_harvest_object(harvest_object), owner_orgs[source_id]
+
+    LOG.info(f"Transforming harvest objects with {workers or 'all'} workers")
+
+    for result in transform_many(payloads(), workers):
+        # objects without content come before the object of the result
+        while pending[0].content is None:
+            yield pending.popleft(), None
+        yield pending.popleft(), result
+    while pending:
+        yield pending.popleft(), None